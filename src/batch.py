@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+# ASIM Reborn - Simple multiplatform 68k IDE
+# Copyright (C) 2024 Francesco Palazzo
+
+# Headless batch runner: assembles, loads and runs every .a68 file of a
+# directory and dumps a JSON report of registers and memory. It must not
+# import PySide6, so that it runs on machines without a display.
+
+import argparse
+import concurrent.futures
+import contextlib
+import io
+import json
+import os
+import os.path
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+from bare68k.consts import CPU_EVENT_NAMES
+
+from compiler import VasmCompiler
+import m68k
+
+SOURCE_EXTENSIONS = (".a68", ".A68")
+
+# bare68k keeps the machine in global state, so every worker process owns
+# exactly one CPU and reuses it for all the programs it is given
+_cpu: Optional[m68k.m68k] = None
+
+
+def parse_dump(arg: str) -> Tuple[int, int]:
+    """ADDRESS:LENGTH in hex, the length defaults to a long"""
+    addr, _, length = arg.partition(":")
+    return int(addr, 16), int(length or "4", 16)
+
+
+def run_program(source: str, max_cycles: int, max_instructions: Optional[int],
+                dumps: List[Tuple[int, int]], use_cache: bool = True) -> Dict:
+    global _cpu
+    report: Dict = {"file": source}
+    start = time.perf_counter()
+    compiler = VasmCompiler(use_cache)
+    result = compiler.compile(source)
+    # a failed build leaves the binary of the last good one in place
+    if not result.ok():
+        report["status"] = "compile error"
+        report["errors"] = compiler.get_error_lines(result.err)
+        report["log"] = result.out + result.err
+        return report
+    binary = result.binary
+    if _cpu is None:
+        _cpu = m68k.m68k()
+    cpu = _cpu
+    with contextlib.redirect_stdout(io.StringIO()):
+        cpu.load_file(binary)
+
+    # counts that don't depend on the host, the report is compared
+    stats = cpu.run_exact(max_cycles, max_instructions)
+    if stats.event is not None:
+        report["status"] = CPU_EVENT_NAMES[stats.event.ev_type].lower()
+    elif stats.halted:
+        report["status"] = "halted"
+    else:
+        report["status"] = "limit"
+    report["cycles"] = stats.cycles
+    report["instructions"] = stats.instructions
+    report["registers"] = cpu.get_regs()
+    memory = {}
+    for addr, length in dumps:
+        try:
+            memory[f"{addr:08X}"] = cpu.get_mem(addr, length).hex()
+        except ValueError:
+            memory[f"{addr:08X}"] = None
+    report["memory"] = memory
+    report["elapsed"] = round(time.perf_counter() - start, 4)
+    return report
+
+
+def find_sources(path: str) -> List[str]:
+    if os.path.isfile(path):
+        return [path]
+    return sorted(os.path.join(path, f) for f in os.listdir(path)
+                  if f.endswith(SOURCE_EXTENSIONS))
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+            description="Assemble and run 68k programs without the IDE")
+    parser.add_argument("paths", nargs="+",
+                        help="source files or directories of .a68 files")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                        help="parallel worker processes")
+    parser.add_argument("--max-cycles", type=int, default=100000000,
+                        help="stop every program after this many cycles")
+    parser.add_argument("--max-instructions", type=int, default=None,
+                        help="stop every program after this many "
+                        "instructions")
+    parser.add_argument("--dump", action="append", default=[],
+                        metavar="ADDR:LEN", type=parse_dump,
+                        help="memory to include in the report, hex")
+    parser.add_argument("-o", "--output", default="-",
+                        help="JSON report file, - for stdout")
+    parser.add_argument("--no-build-cache", action="store_true",
+                        help="always run the assembler, even for sources "
+                        "built before")
+    args = parser.parse_args(argv)
+
+    sources = [s for p in args.paths for s in find_sources(p)]
+    reports = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        futures = [pool.submit(run_program, source, args.max_cycles,
+                               args.max_instructions, args.dump,
+                               not args.no_build_cache)
+                   for source in sources]
+        for source, future in zip(sources, futures):
+            try:
+                reports.append(future.result())
+            except Exception as e:
+                reports.append({"file": source, "status": "crashed",
+                                "log": repr(e)})
+
+    if args.output == "-":
+        json.dump(reports, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as f:
+            json.dump(reports, f, indent=2)
+    return 0 if all(r["status"] != "crashed" for r in reports) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+
+# ASIM Reborn - Simple multiplatform 68k IDE
+# Copyright (C) 2024 Francesco Palazzo
+
+import bisect
+from typing import Any, Callable, Dict, List, Optional
+
+import bare68k as b68k
+from bare68k.consts import CPU_EVENT_BREAKPOINT, MEM_FC_SUPER_MASK, \
+    MEM_FC_USER_MASK
+
+
+class Breakpoint:
+    def __init__(self, line: Optional[int] = None, addr: Optional[int] = None,
+                 condition: str = "", hit_count: int = 0):
+        """Stops the CPU before the instruction at addr, or at the first
+        instruction of a source line once the listing maps it.
+        condition is a python expression on the registers (d0-d7, a0-a7,
+        sp, pc, sr) and memory (b(addr), w(addr), l(addr)). The CPU stops
+        from the hit_count-th time the condition holds"""
+        self.line = line
+        self.addr = addr
+        self.enabled = True
+        self.hits = 0
+        self.hit_count = hit_count
+        self.error = ""
+        self.set_condition(condition)
+
+    def set_condition(self, condition: str):
+        """Raises SyntaxError on an invalid expression"""
+        self.condition = condition.strip()
+        self.code = compile(self.condition, "<breakpoint>", "eval") \
+            if self.condition else None
+
+    def __str__(self) -> str:
+        where = f"line {self.line}" if self.line is not None else ""
+        if self.addr is not None:
+            where += f" (0x{self.addr:08X})" if where else f"0x{self.addr:08X}"
+        if self.condition:
+            where += f" if {self.condition}"
+        if self.hit_count > 1:
+            where += f" after {self.hit_count} hits"
+        return where
+
+
+class BreakpointHit:
+    def __init__(self, addr: int, point: Optional[Breakpoint]):
+        """Same fields as a core event, for the run statistics"""
+        self.ev_type = CPU_EVENT_BREAKPOINT
+        self.addr = addr
+        self.data = point
+
+    def __repr__(self) -> str:
+        return f"BreakpointHit[@${self.addr:08X}, {self.data}]"
+
+
+class Breakpoints:
+    def __init__(self, mem, cpu):
+        """Any number of core breakpoints plus the checks the core can't do.
+        The core raises its event before the instruction but still executes
+        it, so the run loop rewinds the slice and checks conditions and hit
+        counts here, with the CPU stopped before the instruction"""
+        self.mem = mem
+        self.cpu = cpu
+        # what a condition can use, read only if it does: a hot conditional
+        # line is evaluated on every pass
+        self.readers: Dict[str, Callable[[], Any]] = {
+            **{f"d{i}": (lambda i=i: cpu.r_dx(i)) for i in range(8)},
+            **{f"a{i}": (lambda i=i: cpu.r_ax(i)) for i in range(8)},
+            "sp": lambda: cpu.r_ax(7),
+            "pc": cpu.r_pc,
+            "sr": cpu.r_sr,
+            "b": lambda: lambda addr: self.read(addr, 1),
+            "w": lambda: lambda addr: self.read(addr, 2),
+            "l": lambda: lambda addr: self.read(addr, 4),
+        }
+        self.points: List[Breakpoint] = []
+        # enabled breakpoints by address, what the run loop looks up
+        self.by_addr: Dict[int, Breakpoint] = {}
+        # listing: address -> line and the sorted lines with code
+        self.lst: Dict[int, int] = {}
+        self.line_addr: Dict[int, int] = {}
+        self.code_lines: List[int] = []
+        # start address of the program, a plain core breakpoint
+        self.entry: Optional[int] = None
+        self.hit: Optional[Breakpoint] = None
+        # core breakpoints set up by install()
+        self.installed = 0
+
+    def set_listing(self, lst: Dict[int, int]):
+        """Builds the reverse index line -> first address from the
+        address -> line map of the .lst file and maps the line breakpoints"""
+        self.lst = lst
+        self.line_addr = {}
+        for addr, line in lst.items():
+            if line not in self.line_addr or addr < self.line_addr[line]:
+                self.line_addr[line] = addr
+        self.code_lines = sorted(self.line_addr)
+        for point in self.points:
+            if point.line is not None:
+                point.addr = self.address_of(point.line)
+        self.update_index()
+
+    def address_of(self, line: int) -> Optional[int]:
+        """Address of the first line with code from line on"""
+        i = bisect.bisect_left(self.code_lines, line)
+        if i == len(self.code_lines):
+            return None
+        return self.line_addr[self.code_lines[i]]
+
+    def line_of(self, addr: int) -> Optional[int]:
+        return self.lst.get(addr)
+
+    def add(self, line: Optional[int] = None, addr: Optional[int] = None,
+            condition: str = "", hit_count: int = 0) -> Breakpoint:
+        if addr is None and line is not None:
+            addr = self.address_of(line)
+        point = Breakpoint(line, addr, condition, hit_count)
+        self.points.append(point)
+        self.update_index()
+        return point
+
+    def remove(self, point: Breakpoint):
+        self.points.remove(point)
+        self.update_index()
+
+    def clear(self):
+        self.points.clear()
+        self.update_index()
+
+    def at_line(self, line: int) -> Optional[Breakpoint]:
+        for point in self.points:
+            if point.line == line:
+                return point
+        return None
+
+    def update_index(self):
+        self.by_addr = {p.addr: p for p in self.points
+                        if p.enabled and p.addr is not None}
+
+    def install(self):
+        """Sets up the core breakpoints, again after every change and after
+        the runtime is rebuilt"""
+        addrs = list(self.by_addr)
+        if self.entry is not None and self.entry not in self.by_addr:
+            addrs.append(self.entry)
+        b68k.api.tools.setup_breakpoints(max(len(addrs), 1))
+        for i, addr in enumerate(addrs):
+            b68k.api.tools.set_breakpoint(i, addr,
+                                          MEM_FC_SUPER_MASK | MEM_FC_USER_MASK,
+                                          self.by_addr.get(addr))
+        self.installed = len(addrs)
+
+    def enable_core(self, enabled: bool):
+        """Switches the core breakpoints off while the run loop checks
+        every instruction itself, so passing them raises no events"""
+        toggle = b68k.api.tools.enable_breakpoint if enabled \
+            else b68k.api.tools.disable_breakpoint
+        for i in range(self.installed):
+            toggle(i)
+
+    def reset_hits(self):
+        self.hit = None
+        for point in self.points:
+            point.hits = 0
+
+    def read(self, addr: int, size: int) -> int:
+        return int.from_bytes(self.mem.r_block(addr, size), byteorder='big')
+
+    def should_stop(self, point: Breakpoint) -> bool:
+        """Evaluates the condition and the hit count, with the CPU before
+        the instruction of the breakpoint"""
+        if point.code is not None:
+            names: Dict[str, Any] = {name: self.readers[name]()
+                                     for name in point.code.co_names
+                                     if name in self.readers}
+            try:
+                if not eval(point.code, {"__builtins__": {}}, names):
+                    return False
+                point.error = ""
+            except Exception as e:
+                # a broken condition stops, like a plain breakpoint
+                point.error = str(e)
+        point.hits += 1
+        if point.hits < point.hit_count:
+            return False
+        self.hit = point
+        return True
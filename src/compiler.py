@@ -6,15 +6,381 @@
 import re
 import pathlib
 import platform
+import os
 import os.path
+import hashlib
+import json
+import shutil
 import subprocess
 import sys
+import tempfile
+import threading
+from typing import Callable, List, Optional, Tuple
+
+import platformdirs
 
 import path_resolver
 
 
+# "error 2 in line 3 of "prog.a68": unknown mnemonic <mvoe>"
+MESSAGE_RE = re.compile(r'(fatal error|error|warning) (\d+)(?: in line (\d+) of "([^"]*)")?: (.*)')
+
+
+# include "file" and incbin "file", the files a build depends on
+INCLUDE_RE = re.compile(r'^(?:[^\s;*]+)?\s+(include|incbin)\s+["\']?([^"\'\s;]+)',
+                        re.IGNORECASE | re.MULTILINE)
+# builds kept in the cache, the least recently used are dropped
+BUILD_CACHE_ENTRIES = 64
+CACHE_VERSION = 1
+
+
+def default_cache_dir() -> str:
+    return os.path.join(platformdirs.user_cache_dir("asim-reborn"), "builds")
+
+
+class BuildCache:
+    def __init__(self, directory: str, max_entries: int = BUILD_CACHE_ENTRIES):
+        """Outputs of successful builds, keyed on the content of the
+        source and of everything it includes, the assembler and its
+        arguments. Every entry is a directory named after its key, written
+        aside and renamed in place so that parallel builds can share it"""
+        self.directory = directory
+        self.max_entries = max_entries
+
+    def dependencies(self, source: str) -> List[str]:
+        """The source, the files it includes, recursively, and the binaries
+        it incbins, resolved like vasm: from the directory of the includer,
+        then from the current one"""
+        sources = [os.path.abspath(source)]
+        binaries: List[str] = []
+        seen = set(sources)
+        for path in sources:
+            try:
+                with open(path, "rb") as f:
+                    text = f.read().decode(errors="replace")
+            except OSError:
+                continue
+            for kind, name in INCLUDE_RE.findall(text):
+                for base in (os.path.dirname(path), os.getcwd()):
+                    candidate = os.path.abspath(os.path.join(base, name))
+                    if os.path.exists(candidate):
+                        break
+                if candidate in seen:
+                    continue
+                seen.add(candidate)
+                (sources if kind.lower() == "include" else binaries).append(candidate)
+        return sources + binaries
+
+    def key(self, source: str, compiler: str, arguments: Tuple[str, ...]) -> str:
+        digest = hashlib.sha256()
+        digest.update(f"{CACHE_VERSION}\0{' '.join(arguments)}\0".encode())
+        try:
+            stat = os.stat(compiler)
+            digest.update(f"{os.path.abspath(compiler)}\0{stat.st_size}\0{stat.st_mtime_ns}\0".encode())
+        except OSError:
+            digest.update(b"no compiler\0")
+        root = os.path.dirname(os.path.abspath(source))
+        for i, path in enumerate(self.dependencies(source)):
+            # includes by their path relative to the source, so that the
+            # same program in another directory hits the same entry
+            name = "" if i == 0 else os.path.relpath(path, root)
+            digest.update(f"{name}\0".encode())
+            try:
+                with open(path, "rb") as f:
+                    digest.update(hashlib.sha256(f.read()).digest())
+            except OSError:
+                digest.update(b"missing\0")
+        return digest.hexdigest()
+
+    def restore(self, key: str, binary: str, listing: str) -> Optional[Tuple[str, str]]:
+        """Writes the cached outputs to binary and listing, returns the
+        (stdout, stderr) of the build or None on a miss"""
+        entry = os.path.join(self.directory, key)
+        try:
+            with open(os.path.join(entry, "output.json"), "r") as f:
+                output = json.load(f)
+            for name, target in (("program.h68", binary), ("program.lst", listing)):
+                copy_if_changed(os.path.join(entry, name), target)
+            os.utime(entry)
+            return output["out"], output["err"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def store(self, key: str, binary: str, listing: str, out: str, err: str):
+        entry = os.path.join(self.directory, key)
+        if os.path.exists(entry):
+            return
+        temp = f"{entry}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(temp)
+            shutil.copyfile(binary, os.path.join(temp, "program.h68"))
+            shutil.copyfile(listing, os.path.join(temp, "program.lst"))
+            with open(os.path.join(temp, "output.json"), "w") as f:
+                json.dump({"out": out, "err": err}, f)
+            os.rename(temp, entry)
+        except OSError:
+            # full disk or another process stored it first
+            shutil.rmtree(temp, ignore_errors=True)
+            return
+        self.prune()
+
+    def prune(self):
+        try:
+            entries = [os.path.join(self.directory, name)
+                       for name in os.listdir(self.directory) if not name.endswith(".tmp")]
+            entries.sort(key=os.path.getmtime)
+        except OSError:
+            return
+        for entry in entries[:max(len(entries) - self.max_entries, 0)]:
+            shutil.rmtree(entry, ignore_errors=True)
+
+
+def copy_if_changed(source: str, target: str):
+    """Copies unless target has the same content already, so that its
+    mtime only changes with the content"""
+    with open(source, "rb") as f:
+        data = f.read()
+    try:
+        with open(target, "rb") as f:
+            if f.read() == data:
+                return
+    except OSError:
+        pass
+    with open(partial(target), "wb") as f:
+        f.write(data)
+    os.replace(partial(target), target)
+
+
+def partial(path: str) -> str:
+    """Where an output is written until its build is complete"""
+    return f"{path}.part"
+
+
+def commit_outputs(paths: List[str], ok: bool):
+    """Renames the outputs of a build in place if it succeeded, else
+    removes what it wrote, so that a failed or cancelled build never
+    leaves half a binary or listing behind.
+    Raises OSError if an output of a successful build is missing"""
+    for path in paths:
+        if not path:
+            continue
+        if ok:
+            os.replace(partial(path), path)
+        else:
+            try:
+                os.remove(partial(path))
+            except OSError:
+                pass
+
+
+class Message:
+    def __init__(self, kind: str, number: int, line: Optional[int],
+                 file: Optional[str], text: str):
+        """An error or warning of the assembler, line and file are None
+        for messages not about a source line"""
+        self.kind = kind
+        self.number = number
+        self.line = line
+        self.file = file
+        self.text = text
+
+    def is_error(self) -> bool:
+        return self.kind != "warning"
+
+    def __str__(self) -> str:
+        where = f" in line {self.line} of {self.file}" if self.line is not None else ""
+        return f"{self.kind} {self.number}{where}: {self.text}"
+
+
+# lines vasm prints after a message: where a macro was called or a file
+# included from, and the source line itself
+CHAIN_RE = re.compile(r'^\s*(?:called|included) from line (\d+) of "([^"]*)"')
+# tokens vasm quotes in messages, e.g. "unknown mnemonic <mvoe>"
+TOKEN_RE = re.compile(r'<([^<>]+)>')
+
+
+class Diagnostic:
+    def __init__(self, line: int, column: int, length: int, message: str,
+                 is_error: bool = True):
+        """A message placed on the source: line from 1, column from 0"""
+        self.line = line
+        self.column = column
+        self.length = length
+        self.message = message
+        self.is_error = is_error
+
+    def __str__(self) -> str:
+        return f"{self.line}:{self.column + 1}: {self.message}"
+
+
+def parse_diagnostics(output: str, source: str, text: str) -> List[Diagnostic]:
+    """Every message of output placed on the lines of text, the content of
+    source. Messages inside macros or includes go to the line of source
+    that called or included them"""
+    source = os.path.normcase(os.path.abspath(source))
+    lines = text.split("\n")
+    diagnostics = []
+    output_lines = output.splitlines()
+    for i, out_line in enumerate(output_lines):
+        match = MESSAGE_RE.match(out_line)
+        if match is None:
+            continue
+        kind, number, line, file, message = match.groups()
+        places = [(line, file)]
+        for chain_line in output_lines[i + 1:]:
+            chain = CHAIN_RE.match(chain_line)
+            if chain is None:
+                break
+            places.append(chain.groups())
+        row = None
+        for place_line, place_file in places:
+            if place_line is not None and place_file is not None \
+                    and os.path.normcase(os.path.abspath(place_file)) == source:
+                row = int(place_line)
+                break
+        if row is None:
+            # not about the buffer, e.g. a missing file
+            row = 1
+        source_line = lines[row - 1] if 0 < row <= len(lines) else ""
+        column, length = 0, len(source_line)
+        token = TOKEN_RE.search(message)
+        found = source_line.find(token.group(1)) if token else -1
+        if found >= 0:
+            column, length = found, len(token.group(1))
+        else:
+            column = len(source_line) - len(source_line.lstrip())
+            length = len(source_line.rstrip()) - column
+        diagnostics.append(Diagnostic(row, column, max(length, 1),
+                                      f"{kind} {number}: {message.strip()}",
+                                      kind != "warning"))
+    return diagnostics
+
+
+def parse_messages(output: str) -> List[Message]:
+    messages = []
+    for match in MESSAGE_RE.finditer(output):
+        kind, number, line, file, text = match.groups()
+        messages.append(Message(kind, int(number), int(line) if line else None,
+                                file, text.strip()))
+    return messages
+
+
+class CompileResult:
+    def __init__(self, source: str, binary: str, listing: str, returncode: int,
+                 out: str, err: str, cancelled: bool = False):
+        """Outcome of a compile: the output of vasm, its messages and the
+        files it was asked to write"""
+        self.source = source
+        self.binary = binary
+        self.listing = listing
+        self.returncode = returncode
+        self.out = out
+        self.err = err
+        self.cancelled = cancelled
+        # outputs restored from the build cache, vasm didn't run
+        self.cached = False
+        messages = parse_messages(out + err)
+        self.errors = [m for m in messages if m.is_error()]
+        self.warnings = [m for m in messages if not m.is_error()]
+
+    def ok(self) -> bool:
+        return not self.cancelled and self.returncode == 0 and not self.errors
+
+    def cacheable(self) -> bool:
+        """Warnings name the source by its path, a cache hit for the same
+        program in another directory would replay the wrong one"""
+        return self.ok() and not self.warnings
+
+    def error_lines(self) -> List[int]:
+        """Lines of the errors in the source itself, not in its includes"""
+        source = os.path.normcase(os.path.abspath(self.source))
+        return [m.line for m in self.errors if m.line is not None
+                and (m.file is None
+                     or os.path.normcase(os.path.abspath(m.file)) == source)]
+
+
+class CompileJob:
+    def __init__(self, command: List[str], source: str, binary: str, listing: str,
+                 on_output: Callable[[str, bool], None],
+                 on_done: Callable[[CompileResult], None],
+                 cache: Optional[BuildCache] = None, key: Optional[str] = None,
+                 cwd: Optional[str] = None):
+        """Runs the assembler in the background. on_output(text, is_stderr)
+        is called line by line as vasm prints, on_done(result) once when it
+        exits or is cancelled, both on the job's threads. With a cache and
+        the key of the build, a cached build is restored instead and a
+        successful one is stored.
+        Raises OSError if the assembler can't be started"""
+        self.source = source
+        self.binary = binary
+        self.listing = listing
+        self.on_output = on_output
+        self.on_done = on_done
+        self.cache = cache
+        self.key = key
+        self.cancelled = False
+        self.out: List[str] = []
+        self.err: List[str] = []
+        self.process: Optional[subprocess.Popen] = None
+        self.readers: List[threading.Thread] = []
+        cached = cache.restore(key, binary, listing) \
+            if cache is not None and key is not None else None
+        if cached is not None:
+            self.out, self.err = [cached[0]], [cached[1]]
+        else:
+            self.process = subprocess.Popen(command, stdout=subprocess.PIPE,
+                                            stderr=subprocess.PIPE, cwd=cwd)
+            self.readers = [threading.Thread(target=self.read, args=(self.process.stdout, self.out, False)),
+                            threading.Thread(target=self.read, args=(self.process.stderr, self.err, True))]
+        self.waiter = threading.Thread(target=self.wait)
+        for thread in self.readers + [self.waiter]:
+            thread.daemon = True
+            thread.start()
+
+    def read(self, stream, lines: List[str], is_stderr: bool):
+        for raw in iter(stream.readline, b""):
+            text = raw.decode(errors="replace")
+            lines.append(text)
+            self.on_output(text, is_stderr)
+        stream.close()
+
+    def wait(self):
+        if self.process is None:
+            for text, is_stderr in ((self.out[0], False), (self.err[0], True)):
+                for line in text.splitlines(keepends=True):
+                    self.on_output(line, is_stderr)
+            result = CompileResult(self.source, self.binary, self.listing, 0,
+                                   "".join(self.out), "".join(self.err), self.cancelled)
+            result.cached = True
+            self.on_done(result)
+            return
+        for reader in self.readers:
+            reader.join()
+        returncode = self.process.wait()
+        result = CompileResult(self.source, self.binary, self.listing, returncode,
+                               "".join(self.out), "".join(self.err), self.cancelled)
+        try:
+            commit_outputs([self.binary, self.listing], result.ok())
+        except OSError as e:
+            result.err += f"{e}\n"
+            result.returncode = result.returncode or 1
+        if result.cacheable() and self.cache is not None and self.key is not None:
+            self.cache.store(self.key, self.binary, self.listing, result.out, result.err)
+        self.on_done(result)
+
+    def cancel(self):
+        """Kills vasm, on_done still follows with result.cancelled set"""
+        self.cancelled = True
+        if self.process is not None and self.process.poll() is None:
+            self.process.kill()
+
+    def is_running(self) -> bool:
+        return self.waiter.is_alive()
+
+
 class VasmCompiler:
-    def __init__(self):
+    def __init__(self, use_cache: bool = True):
+        self.cache = BuildCache(default_cache_dir()) if use_cache else None
         self.arguments = (
             "-maxerrors=1",
             "-Fsrec",
@@ -23,18 +389,79 @@ class VasmCompiler:
             "-no-opt"
         )
 
-    def compile(self, fpath) -> tuple[str,str]:
-        command_array = [str(path_resolver.compiler_path),
-                              *self.arguments,
-                              "-o", f"{os.path.splitext(fpath)[0]}.h68",
-                              "-L", f"{os.path.splitext(fpath)[0]}.lst",
-                              fpath
-        ]
+    def command(self, fpath) -> List[str]:
+        """vasm writes the outputs aside, see commit_outputs"""
+        return [str(path_resolver.compiler_path),
+                *self.arguments,
+                "-o", partial(f"{os.path.splitext(fpath)[0]}.h68"),
+                "-L", partial(f"{os.path.splitext(fpath)[0]}.lst"),
+                fpath]
+
+    def cache_key(self, fpath) -> Optional[str]:
+        if self.cache is None:
+            return None
+        return self.cache.key(fpath, str(path_resolver.compiler_path), self.arguments)
+
+    def compile(self, fpath) -> CompileResult:
+        """Assembles fpath, the outputs are only written if it succeeds"""
+        base = os.path.splitext(fpath)[0]
+        key = self.cache_key(fpath)
+        if key is not None:
+            cached = self.cache.restore(key, f"{base}.h68", f"{base}.lst")
+            if cached is not None:
+                result = CompileResult(fpath, f"{base}.h68", f"{base}.lst", 0, *cached)
+                result.cached = True
+                return result
+        command_array = self.command(fpath)
         p = subprocess.Popen(command_array, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         out, err = p.communicate()
         #if p.wait() != 0:
         #    raise Exception("Compilation failed")
-        return out.decode(), err.decode()
+        result = CompileResult(fpath, f"{base}.h68", f"{base}.lst", p.returncode,
+                               out.decode(), err.decode())
+        try:
+            commit_outputs([result.binary, result.listing], result.ok())
+        except OSError as e:
+            result.err += f"{e}\n"
+            result.returncode = result.returncode or 1
+        if key is not None and result.cacheable():
+            self.cache.store(key, result.binary, result.listing, result.out, result.err)
+        return result
+
+    def compile_async(self, fpath, on_output: Callable[[str, bool], None],
+                      on_done: Callable[[CompileResult], None]) -> CompileJob:
+        """Same as compile without blocking, see CompileJob"""
+        base = os.path.splitext(fpath)[0]
+        return CompileJob(self.command(fpath), fpath, f"{base}.h68", f"{base}.lst",
+                          on_output, on_done, self.cache, self.cache_key(fpath))
+
+    def check_async(self, text: str, fpath: str,
+                    on_done: Callable[[Optional[List[Diagnostic]]], None]) -> CompileJob:
+        """Assembles text, the unsaved content of fpath, from a temporary
+        copy and reports all its errors and warnings to on_done, None if
+        cancelled. Includes are found next to fpath.
+        Raises OSError if the assembler can't be started"""
+        directory = os.path.dirname(os.path.abspath(fpath)) if fpath else os.getcwd()
+        name = os.path.basename(fpath) if fpath else "untitled.a68"
+        arguments = [arg for arg in self.arguments if not arg.startswith("-maxerrors")]
+        temp = tempfile.mkdtemp(prefix="asim-check-")
+        source = os.path.join(temp, name)
+        command = [str(path_resolver.compiler_path), *arguments, "-maxerrors=0",
+                   f"-I{directory}", "-o", os.path.join(temp, "check.h68"), source]
+
+        def done(result: CompileResult):
+            shutil.rmtree(temp, ignore_errors=True)
+            on_done(None if result.cancelled
+                    else parse_diagnostics(result.out + result.err, source, text))
+        try:
+            with open(source, "w") as f:
+                f.write(text)
+            return CompileJob(command, source, "", "", lambda text, is_stderr: None, done,
+                              cwd=directory)
+        except Exception:
+            # the job never started, nobody else removes the directory
+            shutil.rmtree(temp, ignore_errors=True)
+            raise
 
     def get_error_lines(self, error: str) -> list:
         line_re = r"in line (\d+)"
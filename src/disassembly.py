@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+# ASIM Reborn - Simple multiplatform 68k IDE
+# Copyright (C) 2024 Francesco Palazzo
+
+import bisect
+import re
+from typing import Callable, Dict, List, Optional, Tuple
+
+import bare68k as b68k
+
+# code pages compared on validate(), a changed page is decoded again
+PAGE_SIZE = 256
+# bytes read to check an instruction outside of the loaded segments
+MAX_INSTR_LEN = 10
+# instructions outside of the segments kept, code built at run time
+MAX_OUTSIDE = 4096
+
+# (pc, opcode words, text), what bare68k's disassemble() returns
+Line = Tuple[int, Tuple[int, ...], str]
+
+BRANCH_RE = re.compile(r"^(b|db)[a-z]+(\.[bsw])?\s+(?:\w+,\s*)?([0-9a-f]+)$")
+ADDRESS_RE = re.compile(r"(?<!#)\$([0-9a-fA-F]+)")
+
+
+def disassemble(pc: int, code: Optional[bytes] = None, base: int = 0) -> Line:
+    """Disassembles from code, starting at address base, or from memory"""
+    if code is None:
+        pc, words, text = b68k.api.disasm.disassemble(pc)
+        return pc, tuple(words), text
+    b68k.api.disasm.disassemble_buffer(code, base)
+    try:
+        pc, words, text = b68k.api.disasm.disassemble(pc)
+    finally:
+        b68k.api.disasm.disassemble_memory()
+    return pc, tuple(words), text
+
+
+def targets(text: str) -> List[int]:
+    """Absolute addresses in the operands: branch targets and $ addresses,
+    not immediates"""
+    match = BRANCH_RE.match(text)
+    if match:
+        return [int(match.group(3), 16)]
+    return [int(addr, 16) for addr in ADDRESS_RE.findall(text)]
+
+
+class Segment:
+    def __init__(self, start: int, data: bytes):
+        """Loaded code and the bytes it was decoded from"""
+        self.start = start
+        self.end = start + len(data)
+        self.data = data
+
+
+class Disassembly:
+    def __init__(self, read: Callable[[int, int], bytes]):
+        """Disassembly of the loaded program, decoded once per instruction.
+        validate() compares the code with the bytes it was decoded from and
+        decodes again only the pages written meanwhile, so self-modifying
+        code shows up. read(start, len) raises ValueError on unmapped memory"""
+        self.read = read
+        self.segments: List[Segment] = []
+        self.lines: Dict[int, Line] = {}
+        # sorted addresses of lines
+        self.addrs: List[int] = []
+        # pc -> (code, line) of instructions outside of the segments
+        self.outside: Dict[int, Tuple[bytes, Line]] = {}
+        # bumped whenever lines change, for the views
+        self.generation = 0
+
+    def load(self, segments: List[Tuple[int, bytes]]):
+        self.segments = [Segment(start, data) for start, data in segments if data]
+        self.lines = {}
+        self.outside = {}
+        for segment in self.segments:
+            self.lines.update(self.sweep(segment, segment.start, segment.end))
+        self.addrs = sorted(self.lines)
+        self.generation += 1
+
+    def clear(self):
+        self.load([])
+
+    def sweep(self, segment: Segment, start: int, stop: int,
+              resync: Optional[Dict[int, Line]] = None) -> Dict[int, Line]:
+        """Decodes segment.data from start up to stop, or beyond it up to
+        the first instruction already in resync"""
+        lines: Dict[int, Line] = {}
+        b68k.api.disasm.disassemble_buffer(segment.data, segment.start)
+        try:
+            pc = start
+            while pc < segment.end:
+                if pc >= stop and (resync is None or pc in resync):
+                    break
+                pc, words, text = b68k.api.disasm.disassemble(pc)
+                lines[pc] = (pc, tuple(words), text)
+                pc += max(len(words), 1) * 2
+        finally:
+            b68k.api.disasm.disassemble_memory()
+        return lines
+
+    def segment_of(self, addr: int) -> Optional[Segment]:
+        for segment in self.segments:
+            if segment.start <= addr < segment.end:
+                return segment
+        return None
+
+    def validate(self) -> bool:
+        """Decodes again the pages that changed since they were decoded,
+        returns True if any did"""
+        changed = False
+        for segment in self.segments:
+            try:
+                data = self.read(segment.start, segment.end - segment.start)
+            except ValueError:
+                continue
+            if data == segment.data:
+                continue
+            old = segment.data
+            segment.data = data
+            first = segment.start - segment.start % PAGE_SIZE
+            for page in range(first, segment.end, PAGE_SIZE):
+                lo = max(page, segment.start) - segment.start
+                hi = min(page + PAGE_SIZE, segment.end) - segment.start
+                if data[lo:hi] != old[lo:hi]:
+                    self.redecode(segment, segment.start + lo, segment.start + hi)
+                    changed = True
+        if changed:
+            self.generation += 1
+        return changed
+
+    def redecode(self, segment: Segment, start: int, stop: int):
+        # an instruction of the previous page may run into this one
+        i = bisect.bisect_right(self.addrs, start) - 1
+        if i >= 0 and self.addrs[i] >= segment.start:
+            start = self.addrs[i]
+        lines = self.sweep(segment, start, stop, self.lines)
+        end = start
+        if lines:
+            last = lines[max(lines)]
+            end = last[0] + max(len(last[1]), 1) * 2
+        i = bisect.bisect_left(self.addrs, start)
+        j = bisect.bisect_left(self.addrs, end)
+        for addr in self.addrs[i:j]:
+            del self.lines[addr]
+        self.lines.update(lines)
+        self.addrs[i:j] = sorted(lines)
+
+    def at(self, pc: int) -> Line:
+        """The instruction at pc. Within the segments it is the cached one
+        as of the last validate(), elsewhere it is checked against memory"""
+        line = self.lines.get(pc)
+        if line is not None:
+            return line
+        segment = self.segment_of(pc)
+        if segment is not None:
+            # pc is in the middle of a decoded instruction
+            return disassemble(pc, segment.data, segment.start)
+        try:
+            code = self.read(pc, MAX_INSTR_LEN)
+        except ValueError:
+            return disassemble(pc)
+        cached = self.outside.get(pc)
+        if cached is None or cached[0] != code:
+            if len(self.outside) >= MAX_OUTSIDE:
+                self.outside.clear()
+            cached = (code, disassemble(pc, code, pc))
+            self.outside[pc] = cached
+        return cached[1]
+
+    def index_of(self, pc: int) -> int:
+        """Index in addrs of the instruction containing pc"""
+        return max(bisect.bisect_right(self.addrs, pc) - 1, 0)
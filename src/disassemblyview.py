@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+# ASIM Reborn - Simple multiplatform 68k IDE
+# Copyright (C) 2024 Francesco Palazzo
+
+from typing import Dict, Optional
+
+from PySide6.QtWidgets import QAbstractItemView, QHBoxLayout, QHeaderView, \
+    QLineEdit, QTableView, QVBoxLayout, QWidget
+from PySide6.QtGui import QColor, QFont
+from PySide6.QtCore import QAbstractTableModel, QModelIndex, Qt
+
+import m68k
+from disassembly import targets
+from profiler import Labels
+from memview import PC_COLOR
+
+COLUMNS = ["Address", "Label", "Code", "Instruction"]
+
+BREAKPOINT_COLOR = QColor("#70ff4040")
+
+
+class DisassemblyModel(QAbstractTableModel):
+    def __init__(self, cpu: m68k.m68k, parent=None):
+        """One row per instruction of the disassembly cache of cpu, with the
+        labels of the symbol table"""
+        super().__init__(parent)
+        self.cpu = cpu
+        self.disassembly = cpu.disassembly
+        self.generation = self.disassembly.generation
+        self.labels = Labels({})
+        self.pc = -1
+
+    def rowCount(self, parent=QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(self.disassembly.addrs)
+
+    def columnCount(self, parent=QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(COLUMNS)
+
+    def set_symbols(self, symbols: Dict[str, int]):
+        self.beginResetModel()
+        self.labels = Labels(symbols)
+        self.endResetModel()
+
+    def annotate(self, text: str) -> str:
+        """Appends the labels of the addresses in the operands"""
+        names = [self.labels.by_addr[addr] for addr in targets(text)
+                 if addr in self.labels.by_addr]
+        return f"{text:<32} ; {', '.join(names)}" if names else text
+
+    def data(self, index: QModelIndex, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        addr = self.disassembly.addrs[index.row()]
+        if role == Qt.DisplayRole:
+            pc, words, text = self.disassembly.lines[addr]
+            column = index.column()
+            if column == 0:
+                return f"{pc:08X}"
+            if column == 1:
+                return self.labels.by_addr.get(pc, "")
+            if column == 2:
+                return " ".join(f"{word:04X}" for word in words)
+            return self.annotate(text)
+        if role == Qt.BackgroundRole:
+            if addr == self.pc:
+                return PC_COLOR
+            if addr in self.cpu.breakpoints.by_addr:
+                return BREAKPOINT_COLOR
+        return None
+
+    def headerData(self, section: int, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return COLUMNS[section]
+        return None
+
+    def refresh(self, pc: int) -> bool:
+        """Repaints the rows of the old and new pc, or everything if the
+        cache decoded some code again. Returns True on a reset"""
+        if self.generation != self.disassembly.generation:
+            self.beginResetModel()
+            self.generation = self.disassembly.generation
+            self.pc = pc
+            self.endResetModel()
+            return True
+        old = self.pc
+        self.pc = pc
+        for addr in {old, pc}:
+            if addr in self.disassembly.lines:
+                row = self.disassembly.index_of(addr)
+                self.dataChanged.emit(self.index(row, 0),
+                                      self.index(row, len(COLUMNS) - 1))
+        return False
+
+
+class DisassemblyView(QWidget):
+    def __init__(self, cpu: m68k.m68k, parent=None):
+        super().__init__(parent)
+        self.cpu = cpu
+        self.model = DisassemblyModel(cpu, self)
+
+        self.seekline = QLineEdit()
+        self.seekline.setFont(QFont("MonoLisa"))
+        self.seekline.setPlaceholderText("Jump to address in hex or label")
+        self.seekline.returnPressed.connect(self.seek)
+
+        self.table = QTableView()
+        self.table.setModel(self.model)
+        self.table.setFont(QFont("MonoLisa"))
+        self.table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.table.setSelectionMode(QAbstractItemView.SingleSelection)
+        self.table.verticalHeader().hide()
+        # fixed sizes, so the view never measures rows that are not visible
+        vheader = self.table.verticalHeader()
+        vheader.setSectionResizeMode(QHeaderView.Fixed)
+        vheader.setDefaultSectionSize(self.table.fontMetrics().height() + 4)
+        self.table.horizontalHeader().setStretchLastSection(True)
+        self.model.modelReset.connect(self.table.resizeColumnsToContents)
+
+        seek = QHBoxLayout()
+        seek.addWidget(self.seekline)
+        layout = QVBoxLayout()
+        layout.addLayout(seek)
+        layout.addWidget(self.table)
+        self.setLayout(layout)
+
+    def set_symbols(self, symbols: Dict[str, int]):
+        self.model.set_symbols(symbols)
+
+    def seek(self):
+        text = self.seekline.text().strip()
+        names = self.model.labels.names
+        if text in names:
+            addr = self.model.labels.addrs[names.index(text)]
+        else:
+            try:
+                addr = int(text, 16)
+            except ValueError:
+                return
+        self.jump(addr)
+
+    def jump(self, addr: int, hint=QAbstractItemView.PositionAtTop):
+        if not self.cpu.disassembly.addrs:
+            return
+        index = self.model.index(self.cpu.disassembly.index_of(addr), 0)
+        self.table.scrollTo(index, hint)
+        self.table.setCurrentIndex(index)
+
+    def update_view(self, pc: Optional[int] = None):
+        """Marks the pc, keeping it in view"""
+        if not self.isVisible():
+            return
+        if pc is None:
+            pc = self.cpu.get_state()["pc"]
+        moved = pc != self.model.pc
+        if (self.model.refresh(pc) or moved) and pc in self.cpu.disassembly.lines:
+            index = self.model.index(self.cpu.disassembly.index_of(pc), 0)
+            self.table.scrollTo(index, QAbstractItemView.EnsureVisible)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+# ASIM Reborn - Simple multiplatform 68k IDE
+# Copyright (C) 2024 Francesco Palazzo
+
+from collections import deque
+from typing import Deque, List, Optional, Tuple
+
+from bare68k.consts import M68K_REG_D0, M68K_REG_A0, M68K_REG_PC, \
+    M68K_REG_SR, M68K_REG_USP, M68K_REG_ISP, MEM_ACCESS_W8
+
+# Registers saved for every step. A7 is covered by USP/ISP, and SR comes
+# first because restoring it may swap the stack pointers.
+TRACKED_REGS = (M68K_REG_SR, M68K_REG_USP, M68K_REG_ISP,
+                *range(M68K_REG_D0, M68K_REG_D0 + 8),
+                *range(M68K_REG_A0, M68K_REG_A0 + 7),
+                M68K_REG_PC)
+WRITE_ACCESS = MEM_ACCESS_W8 & 0xF0
+WIDTH_MASK = 0x0F
+
+# rough per-step overhead in bytes of the python objects, for the limit
+STEP_OVERHEAD = 120
+
+
+class Step:
+    def __init__(self, regs: List[Tuple[int, int]]):
+        """Undo record of one instruction: old values of the registers it
+        changed and the old bytes of every memory range it wrote"""
+        self.regs = regs
+        self.writes: List[Tuple[int, bytes]] = []
+
+    def size(self) -> int:
+        return (STEP_OVERHEAD + 16 * len(self.regs)
+                + sum(40 + len(old) for _, old in self.writes))
+
+
+class History:
+    def __init__(self, mem, cpu, max_steps: int = 100000,
+                 max_bytes: int = 16 * 1024 * 1024):
+        """Bounded ring buffer of undo records for reverse stepping.
+        The CPU memory trace fires after the write, so old bytes come from
+        a shadow copy of RAM that is kept in sync step by step"""
+        self.mem = mem
+        self.cpu = cpu
+        self.max_steps = max_steps
+        self.max_bytes = max_bytes
+        self.steps: Deque[Step] = deque()
+        self.used_bytes = 0
+        self.shadow: Optional[bytearray] = None
+        self.ram_size = 0
+        self.current: Optional[Step] = None
+        self.before: List[int] = []
+
+    def clear(self):
+        """Drops the history, e.g. after a free run that was not recorded"""
+        self.steps.clear()
+        self.used_bytes = 0
+        self.shadow = None
+
+    def __len__(self) -> int:
+        return len(self.steps)
+
+    def begin(self, ram_size: int):
+        if self.shadow is None:
+            self.ram_size = ram_size
+            self.shadow = bytearray(self.mem.r_block(0, ram_size))
+        self.before = [self.cpu.r_reg(r) for r in TRACKED_REGS]
+        self.current = Step([])
+        self.mem.set_mem_cpu_trace_func(self.trace)
+
+    def trace(self, access: int, address: int, value: int):
+        if access & WRITE_ACCESS:
+            self.save_old(address, access & WIDTH_MASK)
+
+    def save_old(self, address: int, size: int):
+        end = min(address + size, self.ram_size)
+        if self.current is None or self.shadow is None or address >= end:
+            return
+        self.current.writes.append((address, bytes(self.shadow[address:end])))
+        self.shadow[address:end] = self.mem.r_block(address, end - address)
+
+    def api_write(self, address: int, data: bytes):
+        """Memory written by the debugger or by a device. It is undone with
+        the step in progress, if any, and always kept in the shadow copy"""
+        if self.shadow is None:
+            return
+        end = min(address + len(data), self.ram_size)
+        if address < end:
+            if self.current is not None:
+                self.current.writes.append((address, bytes(self.shadow[address:end])))
+            self.shadow[address:end] = data[:end - address]
+
+    def end(self):
+        self.mem.set_mem_cpu_trace_func(None)
+        step = self.current
+        self.current = None
+        if step is None:
+            return
+        for reg, old in zip(TRACKED_REGS, self.before):
+            if self.cpu.r_reg(reg) != old:
+                step.regs.append((reg, old))
+        self.steps.append(step)
+        self.used_bytes += step.size()
+        while self.steps and (len(self.steps) > self.max_steps
+                              or self.used_bytes > self.max_bytes):
+            self.used_bytes -= self.steps.popleft().size()
+
+    def step_back(self, n: int = 1) -> int:
+        """Undoes the last n steps, returns how many were undone"""
+        done = 0
+        while done < n and self.steps:
+            step = self.steps.pop()
+            self.used_bytes -= step.size()
+            for address, old in reversed(step.writes):
+                self.mem.w_block(address, old)
+                if self.shadow is not None:
+                    self.shadow[address:address+len(old)] = old
+            for reg, old in step.regs:
+                self.cpu.w_reg(reg, old)
+            done += 1
+        return done
@@ -6,18 +6,20 @@
 import os
 import os.path
 from typing import Optional, Union, Callable
-import re
 import sys
 
 from PySide6.QtWidgets import QApplication, QDockWidget, QMainWindow, \
-    QMessageBox, QTextEdit, QPlainTextEdit, QFileDialog, QTabWidget, QWidget
+    QMessageBox, QTextEdit, QPlainTextEdit, QFileDialog, QTabWidget, QWidget, \
+    QInputDialog, QToolTip
 from PySide6.QtGui import QFont, QFontDatabase, QPainter, QSyntaxHighlighter, \
     QTextFormat, QTextCharFormat, QTextCursor, QKeySequence, QKeyEvent, \
     QAction, QColor, QTextDocument, QIcon, QDrag
-from PySide6.QtCore import QFileInfo, QTimer, Qt, QEvent, QSize, QRect
+from PySide6.QtCore import QFileInfo, QTimer, Qt, QEvent, QSize, QRect, QPoint, \
+    Signal
 
-from compiler import VasmCompiler
-import run, opcodes, palettes, path_resolver, help, screen
+from compiler import VasmCompiler, CompileJob, CompileResult, Diagnostic
+import run, palettes, path_resolver, help, screen, srec, profiler, \
+    traceview, listing, tokenizer, symbols, symbolview
 
 class LineNumber(QWidget):
     def __init__(self, editor):
@@ -30,6 +32,9 @@ class LineNumber(QWidget):
     def paintEvent(self, event):
         self.editor.lineNumberAreaPaintEvent(event)
 
+    def mousePressEvent(self, event):
+        self.editor.lineNumberAreaClicked(event)
+
 class M68KHighlighter(QSyntaxHighlighter):
     def __init__(self, parent: QTextDocument, palette: palettes.Palette = palettes.monokai):
         super().__init__(parent)
@@ -50,32 +55,23 @@ class M68KHighlighter(QSyntaxHighlighter):
         comment_format.setFontWeight(QFont.Light)
         character_format = QTextCharFormat()
         character_format.setForeground(QColor(palette.character))
-        opcode_re= re.compile(
-                opcodes.regex_generator(opcodes.opcodes),
-                re.IGNORECASE)
-        directive_re = re.compile(
-                opcodes.regex_generator(opcodes.directives),
-                re.IGNORECASE)
-        registers_re = re.compile(
-                opcodes.regex_generator(opcodes.registers),
-                re.IGNORECASE)
-        comment_re = re.compile('(?<![\'"])[*;]([^\'"]*)(?![\'"])')
-        character_re = re.compile(r"'.'")
-        string_re = re.compile(r'"[^"]*"')
-        self.expr_form_couples = [(opcode_re, opcode_format),
-                                   (directive_re, directive_format),
-                                   (registers_re, registers_format),
-                                   (comment_re, comment_format),
-                                   (character_re, character_format),
-                                   (string_re, character_format)]
+        # token kind -> format, see tokenizer.tokenize
+        self.formats = {tokenizer.OPCODE: opcode_format,
+                        tokenizer.DIRECTIVE: directive_format,
+                        tokenizer.REGISTER: registers_format,
+                        tokenizer.COMMENT: comment_format,
+                        tokenizer.CHARACTER: character_format,
+                        tokenizer.STRING: character_format}
 
 
     def highlightBlock(self, text):
-        for expression, format in self.expr_form_couples:
-            for match in re.finditer(expression, text):
-                start = match.start()
-                length = match.end() - start
-                self.setFormat(start, length, format)
+        for start, length, kind in tokenizer.tokenize(text):
+            self.setFormat(start, length, self.formats[kind])
+
+# extra selection layers of the editor, painted in this order
+OVERLAYS = ("current", "heat", "errors", "diagnostics", "run", "watch")
+# typing pause before the buffer is checked in the background
+CHECK_DELAY_MS = 600
 
 class IDETextEdit(QPlainTextEdit):
     def __init__(self,
@@ -97,6 +93,13 @@ class IDETextEdit(QPlainTextEdit):
         self.setCursorWidth(5)
         self.setLineWrapMode(QPlainTextEdit.WidgetWidth)
         self.lineNumberArea = LineNumber(self)
+        # lines with a breakpoint and what a click in the gutter does
+        self.breakpoint_lines: set[int] = set()
+        self.gutter_clicked: Optional[Callable[[int, bool], None]] = None
+        # layer name -> its extra selections, see set_overlay
+        self.overlays: dict[str, list[QTextEdit.ExtraSelection]] = {}
+        # messages of the last background check, underlined
+        self.diagnostics: list[Diagnostic] = []
         self.blockCountChanged.connect(self.updateLineNumberAreaWidth)
         self.updateRequest.connect(self.updateLineNumberArea)
         self.updateLineNumberAreaWidth(0)
@@ -147,6 +150,9 @@ class IDETextEdit(QPlainTextEdit):
         while block.isValid() and top <= event.rect().bottom():
             if block.isVisible() and bottom >= event.rect().top():
                 number = str(block_number + 1)
+                if block_number + 1 in self.breakpoint_lines:
+                    painter.fillRect(0, int(top), self.lineNumberArea.width(),
+                                     self.fontMetrics().height(), QColor("#c0392b"))
                 painter.setPen(QColor(self.ui_palette.text))
                 painter.drawText(0, int(top), self.lineNumberArea.width(), self.fontMetrics().height(),
                                  Qt.AlignCenter, number)
@@ -155,6 +161,13 @@ class IDETextEdit(QPlainTextEdit):
             bottom = top + self.blockBoundingRect(block).height()
             block_number += 1
 
+    def lineNumberAreaClicked(self, event):
+        """Left click toggles a breakpoint, right click edits it"""
+        if self.gutter_clicked is None:
+            return
+        line = self.cursorForPosition(QPoint(0, int(event.position().y()))).blockNumber() + 1
+        self.gutter_clicked(line, event.button() == Qt.RightButton)
+
     def highlightCurrentLine(self): # currently only highlights cursor's line
         extraSelections = []
 
@@ -165,10 +178,65 @@ class IDETextEdit(QPlainTextEdit):
             selection.cursor = self.textCursor()
             selection.cursor.clearSelection()
             extraSelections.append(selection)
-        self.setExtraSelections(extraSelections)
+        self.set_overlay("current", extraSelections)
+
+    def set_overlay(self, layer: str, selections: list[QTextEdit.ExtraSelection]):
+        """Replaces the selections of a layer, keeping the other layers"""
+        self.overlays[layer] = selections
+        self.setExtraSelections([selection for name in OVERLAYS
+                                 for selection in self.overlays.get(name, [])])
+
+    def set_diagnostics(self, diagnostics: list[Diagnostic]):
+        """Squiggles under the span of every message, see event for the
+        tooltips"""
+        self.diagnostics = diagnostics
+        selections = []
+        for diagnostic in diagnostics:
+            block = self.document().findBlockByLineNumber(diagnostic.line-1)
+            if not block.isValid():
+                continue
+            end = block.position() + block.length() - 1
+            start = min(block.position() + diagnostic.column, end)
+            selection = QTextEdit.ExtraSelection()
+            selection.cursor = QTextCursor(self.document())
+            selection.cursor.setPosition(start)
+            selection.cursor.setPosition(min(start + diagnostic.length, end),
+                                         QTextCursor.KeepAnchor)
+            selection.format.setUnderlineStyle(QTextCharFormat.SpellCheckUnderline)
+            selection.format.setUnderlineColor(
+                    QColor("#ff4040") if diagnostic.is_error else QColor("#e6db74"))
+            selections.append(selection)
+        self.set_overlay("diagnostics", selections)
+
+    def event(self, event):
+        if event.type() == QEvent.ToolTip:
+            cursor = self.cursorForPosition(event.pos())
+            line = cursor.blockNumber() + 1
+            messages = [d.message for d in self.diagnostics if d.line == line]
+            if messages:
+                QToolTip.showText(event.globalPos(), "\n".join(messages), self)
+            else:
+                QToolTip.hideText()
+            return True
+        return super().event(event)
+
+    def line_selection(self, line: int, color: QColor) -> QTextEdit.ExtraSelection:
+        """Full width selection of a line, counted from 1"""
+        selection = QTextEdit.ExtraSelection()
+        selection.format.setBackground(color)
+        selection.format.setProperty(QTextFormat.FullWidthSelection, True)
+        selection.cursor = QTextCursor(self.document().findBlockByLineNumber(line-1))
+        return selection
 
 
 class IDE(QMainWindow):
+    # output and result of the compile with the given serial, from the
+    # job's threads
+    compile_output = Signal(int, str)
+    compile_done = Signal(int, object)
+    # diagnostics of the background check with the given serial
+    check_done = Signal(int, object)
+
     def __init__(self, file: Optional[str] = None, config: dict = {}):
         super().__init__()
         # Config
@@ -184,20 +252,45 @@ class IDE(QMainWindow):
                      QSize(24, 24))
         self.setWindowIcon(icon)
         self.setWindowTitle("ASIM Reborn")
+        debugger_config = config.get("debugger", {})
         # Classes
         self.compiler = VasmCompiler()
-        self.runner = run.Runner()
+        self.compile_job: Optional[CompileJob] = None
+        # serial of the current compile, output of older ones is dropped
+        self.compile_serial = 0
+        self.compile_output.connect(self.on_compile_output)
+        self.compile_done.connect(self.on_compile_done)
+        # background syntax check, started when typing pauses
+        self.check_job: Optional[CompileJob] = None
+        self.check_serial = 0
+        self.check_timer = QTimer(self)
+        self.check_timer.setSingleShot(True)
+        self.check_timer.setInterval(CHECK_DELAY_MS)
+        self.check_timer.timeout.connect(self.start_check)
+        self.check_timer.timeout.connect(self.refresh_outline)
+        self.check_done.connect(self.on_check_done)
+        self.runner = run.Runner(
+                int(debugger_config.get("history-steps", 100000)),
+                int(debugger_config.get("history-size", 16)) * 1024 * 1024)
         self.documentation = help.Help()
         self.about = help.About()
 
         #State
         self.current_file: str = ""
+        self.listing: Optional[listing.ListingIndex] = None
         self.current_lst: dict[int, int] = {}
+        self.current_symbols: dict[str, int] = {}
+        # labels, equates and includes of the buffer, indexed again on the
+        # first lookup after an edit
+        self.symbols = symbols.SymbolIndex()
+        self.symbols_dirty = True
+        # run line and watchpoint hit line are followed after a debug run,
+        # (run line, hit line) painted last
+        self.follow_run = False
+        self.run_lines: Optional[tuple] = None
 
         self.init_ui()
-        self.runner_polling = QTimer()
-        self.runner_polling.timeout.connect(self.runner.update_ui)
-        self.runner_polling.timeout.connect(self.update_highlighted_running_line)
+        self.runner.updated.connect(self.update_highlighted_running_line)
 
         if file:
             self.current_file = file
@@ -214,6 +307,7 @@ class IDE(QMainWindow):
         self.text_edit = IDETextEdit(self.ui_palette, self.font, self.font_size)
         self.setCentralWidget(self.text_edit)
         self.text_edit.textChanged.connect(self.on_text_changed)
+        self.text_edit.gutter_clicked = self.gutter_clicked
         self.highlighter = M68KHighlighter(self.text_edit.document(), self.ui_palette)
 
         self.setGeometry(100, 100, 800, 600)
@@ -240,6 +334,40 @@ class IDE(QMainWindow):
         self.exec_dock.setWidget(self.runner)
         self.addDockWidget(Qt.RightDockWidgetArea, self.exec_dock)
 
+        # Memory browser dock
+        self.memory_dock = QDockWidget("Memory", self)
+        self.memory_dock.setAllowedAreas(Qt.AllDockWidgetAreas)
+        self.memory_dock.setWidget(self.runner.membrowser)
+        self.memory_dock.visibilityChanged.connect(
+                lambda visible: visible and self.runner.membrowser.update_view())
+        self.addDockWidget(Qt.RightDockWidgetArea, self.memory_dock)
+
+        # Disassembly dock
+        self.disasm_dock = QDockWidget("Disassembly", self)
+        self.disasm_dock.setAllowedAreas(Qt.AllDockWidgetAreas)
+        self.disasm_dock.setWidget(self.runner.disasmview)
+        self.disasm_dock.visibilityChanged.connect(
+                lambda visible: visible and self.runner.disasmview.update_view())
+        self.addDockWidget(Qt.RightDockWidgetArea, self.disasm_dock)
+
+        # Trace viewer dock
+        self.trace_view = traceview.TraceView()
+        self.trace_dock = QDockWidget("Trace", self)
+        self.trace_dock.setAllowedAreas(Qt.AllDockWidgetAreas)
+        self.trace_dock.setWidget(self.trace_view)
+        self.addDockWidget(Qt.BottomDockWidgetArea, self.trace_dock)
+        self.trace_dock.hide()
+
+        # Outline dock
+        self.symbol_view = symbolview.SymbolView()
+        self.symbol_view.activated.connect(self.goto_location)
+        self.symbol_dock = QDockWidget("Outline", self)
+        self.symbol_dock.setAllowedAreas(Qt.AllDockWidgetAreas)
+        self.symbol_dock.setWidget(self.symbol_view)
+        self.symbol_dock.visibilityChanged.connect(
+                lambda visible: visible and self.refresh_outline())
+        self.addDockWidget(Qt.RightDockWidgetArea, self.symbol_dock)
+
         # Docs dock
         self.docs_dock = QDockWidget("Documentation", self)
         self.docs_dock.setAllowedAreas(Qt.AllDockWidgetAreas)
@@ -255,6 +383,9 @@ class IDE(QMainWindow):
 
         self.runner.poweroff_btn.clicked.connect(self.stop_highlighting)
 
+        self.tabifyDockWidget(self.exec_dock, self.memory_dock)
+        self.tabifyDockWidget(self.exec_dock, self.disasm_dock)
+        self.tabifyDockWidget(self.exec_dock, self.symbol_dock)
         self.tabifyDockWidget(self.exec_dock, self.docs_dock)
         # self.tabifyDockWidget(self.exec_dock, self.screen_dock)
 
@@ -289,28 +420,81 @@ class IDE(QMainWindow):
         compile_action = QAction('Compile', self)
         compile_action.setShortcut(QKeySequence("F5"))
         compile_action.triggered.connect(self.compile_file)
+        cancel_compile_action = QAction('Cancel compile', self)
+        cancel_compile_action.setShortcut(QKeySequence("Shift+F5"))
+        cancel_compile_action.triggered.connect(self.cancel_compile)
         run_action = QAction('Run', self)
         run_action.triggered.connect(self.runner.run)
         run_action.setShortcut(QKeySequence("F6"))
         run_debug_action = QAction('Run with debug', self)
         run_debug_action.triggered.connect(self.execute_file)
         run_debug_action.setShortcut(QKeySequence("F7"))
+        step_back_action = QAction('Step back', self)
+        step_back_action.triggered.connect(lambda: self.runner.step_back())
+        step_back_action.setShortcut(QKeySequence("Shift+F8"))
+        restart_action = QAction('Restart', self)
+        restart_action.triggered.connect(self.runner.restart)
         step_action = QAction('Step', self)
         step_action.triggered.connect(self.runner.step)
         step_action.setShortcut(QKeySequence("F8"))
+        profile_action = QAction('Run with profiler', self)
+        profile_action.triggered.connect(self.runner.run_profiled)
+        profile_action.setShortcut(QKeySequence("Shift+F6"))
+        show_profile_action = QAction('Show profile', self)
+        show_profile_action.triggered.connect(self.show_profile)
+        hide_profile_action = QAction('Hide profile', self)
+        hide_profile_action.triggered.connect(self.hide_profile)
+        export_profile_action = QAction('Export profile...', self)
+        export_profile_action.triggered.connect(self.export_profile)
+        start_trace_action = QAction('Start trace...', self)
+        start_trace_action.triggered.connect(self.start_trace)
+        stop_trace_action = QAction('Stop trace', self)
+        stop_trace_action.triggered.connect(self.stop_trace)
+        open_trace_action = QAction('Open trace...', self)
+        open_trace_action.triggered.connect(self.open_trace)
         stop_action = QAction('Stop', self)
         stop_action.triggered.connect(self.stop)
         stop_action.setShortcut(QKeySequence("F9"))
         run_menu = self.menuBar().addMenu('Run')
         run_menu.addAction(compile_action)
+        run_menu.addAction(cancel_compile_action)
         run_menu.addAction(run_action)
         run_menu.addAction(run_debug_action)
+        run_menu.addAction(restart_action)
         run_menu.addAction(step_action)
+        run_menu.addAction(step_back_action)
         run_menu.addAction(stop_action)
+        profile_menu = self.menuBar().addMenu('Profile')
+        profile_menu.addAction(profile_action)
+        profile_menu.addAction(show_profile_action)
+        profile_menu.addAction(hide_profile_action)
+        profile_menu.addAction(export_profile_action)
+        trace_menu = self.menuBar().addMenu('Trace')
+        trace_menu.addAction(start_trace_action)
+        trace_menu.addAction(stop_trace_action)
+        trace_menu.addAction(open_trace_action)
+        # Navigate menu
+        definition_action = QAction('Go to definition', self)
+        definition_action.triggered.connect(self.goto_definition)
+        definition_action.setShortcut(QKeySequence("F12"))
+        references_action = QAction('Find references', self)
+        references_action.triggered.connect(self.find_references)
+        references_action.setShortcut(QKeySequence("Shift+F12"))
+        outline_action = QAction('Outline', self)
+        outline_action.triggered.connect(self.show_outline)
+        outline_action.setShortcut(QKeySequence("Ctrl+Shift+O"))
+        navigate_menu = self.menuBar().addMenu('Navigate')
+        navigate_menu.addAction(definition_action)
+        navigate_menu.addAction(references_action)
+        navigate_menu.addAction(outline_action)
         # Window menu
         docks_menu = self.menuBar().addMenu('Window')
         docks_menu.addAction(self.dock.toggleViewAction())
         docks_menu.addAction(self.exec_dock.toggleViewAction())
+        docks_menu.addAction(self.memory_dock.toggleViewAction())
+        docks_menu.addAction(self.disasm_dock.toggleViewAction())
+        docks_menu.addAction(self.trace_dock.toggleViewAction())
+        docks_menu.addAction(self.symbol_dock.toggleViewAction())
         docks_menu.addAction(self.docs_dock.toggleViewAction())
         # window_menu.addAction(self.screen_dock.toggleViewAction())
         # Help menu
@@ -321,11 +505,17 @@ class IDE(QMainWindow):
 
     def on_text_changed(self):
         self.update_window_title(True)
+        self.symbols_dirty = True
+        self.cancel_check()
+        self.check_timer.start()
+        self.text_edit.set_overlay("heat", [])
+        self.text_edit.set_overlay("errors", [])
         self.stop_highlighting()
 
     def new_file(self):
         self.text_edit.clear()
         self.current_file = None
+        self.symbols.clear()
         self.update_window_title(False)
 
     def open_file(self):
@@ -337,16 +527,19 @@ class IDE(QMainWindow):
             self.load_file(fname)
 
     def load_file(self, fname: str):
+        self.symbols.clear()
         with open(fname, 'r') as file:
             self.text_edit.setPlainText(file.read())
         self.current_file = fname
         self.update_window_title(False)
+        self.refresh_outline()
 
     def save_file(self) -> bool:
         if not self.current_file:
             return self.save_as_new()
         with open(self.current_file, 'w') as file:
             file.write(self.text_edit.toPlainText())
+        self.text_edit.document().setModified(False)
         self.update_window_title(False)
         return True
 
@@ -372,57 +565,218 @@ class IDE(QMainWindow):
                     QMessageBox.warning(self, "Error", "Could not save file")
                     return
         #print(f"Compiling {self.current_file}")
-        out, err = self.compiler.compile(self.current_file)
+        self.cancel_compile()
         self.dock.show()
-        self.compiler_widget.setPlainText(out + err)
-        if err != "":
-            errors = self.compiler.get_error_lines(err)
-            #print(f"errors in {errors}")
-            self.highlight_errors(errors)
-
-    def parse_lst(self, path: str, import_vars: bool = True):
-        valid_line_re = re.compile(r'^[0-9A-Fa-f]{2}:[0-9A-Fa-f]{8}$')
-        valid_symbol_re = re.compile(r'.*\s+A:[0-9A-Fa-f]{8}')
-        with open(path, 'r') as file:
-            lines = file.readlines()
-            symbols_mode = False
-            for i, line in enumerate(lines):
-                # pair: address -> line number
-                #print(f"Line {i}: {line}")
-                if line.startswith("Symbols by name"):
-                    symbols_mode = True
-                    continue
-                s = line.split()
-                if symbols_mode:
-                    if line == "\n":
-                        print("End of symbols")
-                        symbols_mode = False
-                        break
-                    if len(s) < 2:
-                        continue
-                    if not valid_symbol_re.match(line):
-                        continue
-                    address = int(s[1][2:], 16)
-                    row = i
-                    #print(f"Address: {address}, line: {row}")
-                    if import_vars:
-                        self.runner.add_var(address, s[0])
-                    continue
-                if len(s) < 3:
-                    continue
-                if not valid_line_re.match(s[0]):
-                    continue
-                address = int(s[0][3:], 16)
-                row = int(s[2][:-1])
-                #print(s[2].lower())
-                #print(f"Address: {address}, line: {row}")
-                self.current_lst[address] = row
+        self.compiler_widget.setPlainText(f"Compiling {self.current_file}...\n")
+        self.compile_serial += 1
+        serial = self.compile_serial
+        try:
+            self.compile_job = self.compiler.compile_async(
+                    self.current_file,
+                    lambda text, _: self.compile_output.emit(serial, text),
+                    lambda result: self.compile_done.emit(serial, result))
+        except OSError as e:
+            self.append_log(f"Could not run the assembler: {e}\n")
+
+    def cancel_compile(self):
+        if self.compile_job is not None:
+            self.compile_job.cancel()
+            self.compile_job = None
+            self.compile_serial += 1
+            self.append_log("Compilation cancelled.\n")
+
+    def on_compile_output(self, serial: int, text: str):
+        if serial == self.compile_serial:
+            self.append_log(text)
+
+    def append_log(self, text: str):
+        self.compiler_widget.moveCursor(QTextCursor.End)
+        self.compiler_widget.insertPlainText(text)
+        self.compiler_widget.ensureCursorVisible()
+
+    def on_compile_done(self, serial: int, result: CompileResult):
+        if serial != self.compile_serial:
+            return
+        self.compile_job = None
+        if not result.ok():
+            self.append_log(f"Compilation failed: {len(result.errors)} errors, "
+                            f"{len(result.warnings)} warnings.\n")
+            self.highlight_errors(result.error_lines())
+            return
+        self.append_log(f"Compiled {result.binary} ({len(result.warnings)} warnings"
+                        f"{', from the build cache' if result.cached else ''}).\n")
+        self.text_edit.set_overlay("errors", [])
+        # index the listing once per build, the runs reuse it
+        if os.path.exists(result.listing):
+            self.load_listing(result.listing)
+
+    def cancel_check(self):
+        if self.check_job is not None:
+            self.check_job.cancel()
+            self.check_job = None
+        self.check_serial += 1
+
+    def start_check(self):
+        """Assembles the buffer as it is, in the background"""
+        self.cancel_check()
+        text = self.text_edit.toPlainText()
+        if not text.strip():
+            self.text_edit.set_diagnostics([])
+            return
+        serial = self.check_serial
+        try:
+            self.check_job = self.compiler.check_async(
+                    text, self.current_file or "",
+                    lambda diagnostics: self.check_done.emit(serial, diagnostics))
+        except OSError:
+            # no assembler, nothing to check with
+            self.check_job = None
+
+    def on_check_done(self, serial: int, diagnostics: Optional[list[Diagnostic]]):
+        if serial != self.check_serial or diagnostics is None:
+            return
+        self.check_job = None
+        self.text_edit.set_diagnostics(diagnostics)
+
+    def index_symbols(self) -> str:
+        """Indexes the buffer if it changed, returns its path"""
+        path = os.path.abspath(self.current_file or "untitled.a68")
+        if self.symbols_dirty:
+            self.symbols.update(path, self.text_edit.toPlainText())
+            self.symbols_dirty = False
+        return path
+
+    def refresh_outline(self):
+        if not self.symbol_dock.isVisible() \
+                or self.symbol_view.title.text() != "Outline":
+            return
+        self.index_symbols()
+        self.symbol_view.show_outline(self.symbols.outline())
+
+    def symbol_under_cursor(self) -> Optional[str]:
+        path = self.index_symbols()
+        cursor = self.text_edit.textCursor()
+        return self.symbols.symbol_at(path, cursor.blockNumber() + 1,
+                                      cursor.positionInBlock())
+
+    def goto_definition(self):
+        name = self.symbol_under_cursor()
+        definition = self.symbols.definition(name) if name else None
+        if definition is not None:
+            self.goto_location(definition.path, definition.line, definition.column)
+
+    def find_references(self):
+        name = self.symbol_under_cursor()
+        if name is None:
+            return
+        locations = self.symbols.references(name)
+        definition = self.symbols.definition(name)
+        if definition is not None:
+            locations = sorted(set(locations) | {definition.location()})
+        current = self.index_symbols()
+        texts = {current: self.text_edit.toPlainText().split("\n")}
+        for path in {path for path, _, _ in locations} - {current}:
+            try:
+                with open(path, "r", errors="replace") as f:
+                    texts[path] = f.read().split("\n")
+            except OSError:
+                pass
+        self.symbol_view.show_references(name, locations, texts)
+        self.symbol_dock.show()
+        self.symbol_dock.raise_()
+
+    def show_outline(self):
+        self.symbol_view.title.setText("Outline")
+        self.symbol_dock.show()
+        self.symbol_dock.raise_()
+        self.refresh_outline()
+
+    def goto_location(self, path: str, line: int, column: int = 0):
+        """Moves the cursor to a place, opening the file if it's another one"""
+        if path != self.index_symbols():
+            if self.text_edit.document().isModified():
+                answer = QMessageBox.question(self, "Open file",
+                        f"Save the changes before opening {os.path.basename(path)}?",
+                        QMessageBox.Save | QMessageBox.Discard | QMessageBox.Cancel)
+                if answer == QMessageBox.Cancel \
+                        or answer == QMessageBox.Save and not self.save_file():
+                    return
+            try:
+                self.load_file(path)
+            except OSError as e:
+                QMessageBox.warning(self, "Error", f"Can't open {path}: {e}")
+                return
+        block = self.text_edit.document().findBlockByNumber(line - 1)
+        if not block.isValid():
+            return
+        cursor = self.text_edit.textCursor()
+        cursor.setPosition(block.position() + min(column, block.length() - 1))
+        self.text_edit.setTextCursor(cursor)
+        self.text_edit.centerCursor()
+        self.text_edit.setFocus()
+
+    def gutter_clicked(self, line: int, edit: bool):
+        cpu = self.runner.main_cpu
+        point = cpu.breakpoints.at_line(line)
+        if not edit:
+            try:
+                if point is None:
+                    cpu.add_breakpoint(line)
+                else:
+                    cpu.remove_breakpoint(point)
+            except RuntimeError as e:
+                QMessageBox.warning(self, "Error", str(e))
+        else:
+            condition, ok = QInputDialog.getText(
+                    self, "Breakpoint condition",
+                    "Stop when (e.g. d0 == 5 and w(0x8100) > 2), empty for always:",
+                    text=point.condition if point is not None else "")
+            if not ok:
+                return
+            hit_count, ok = QInputDialog.getInt(
+                    self, "Breakpoint hit count", "Stop from hit number:",
+                    point.hit_count if point is not None else 1, 1)
+            if not ok:
+                return
+            try:
+                if point is None:
+                    point = cpu.add_breakpoint(line, condition=condition,
+                                               hit_count=hit_count)
+                else:
+                    point.set_condition(condition)
+                    point.hit_count = hit_count
+            except SyntaxError as e:
+                QMessageBox.warning(self, "Error", f"Invalid condition: {e.msg}")
+            except RuntimeError as e:
+                QMessageBox.warning(self, "Error", str(e))
+        self.update_breakpoint_lines()
+
+    def update_breakpoint_lines(self):
+        self.text_edit.breakpoint_lines = {
+                p.line for p in self.runner.main_cpu.breakpoints.points
+                if p.line is not None}
+        self.text_edit.lineNumberArea.update()
+        self.runner.update_points()
+
+    def load_listing(self, path: str, import_vars: bool = False):
+        """Loads the index of the listing, parsed again only when the .lst
+        changed since the last time"""
+        self.listing = listing.load(path, os.path.splitext(path)[0] + ".h68", self.listing)
+        self.current_lst = self.listing.lines
+        self.current_symbols = self.listing.symbols
+        if import_vars:
+            for name, address in self.current_symbols.items():
+                self.runner.add_var(address, name)
 
     def execute_file(self):
         #check is .lst file exists
         if self.current_file == None:
             QMessageBox.warning(self, "Error", "No file to run.")
             return
+        if self.compile_job is not None and self.compile_job.is_running():
+            # the outputs are only in place once the build is done
+            QMessageBox.warning(self, "Error", "Wait for the compilation to finish.")
+            return
         lst = ""
         for ext in (".lst", ".LIS"):
             lst = os.path.splitext(self.current_file)[0] + ext
@@ -432,21 +786,34 @@ class IDE(QMainWindow):
                                      "Do you want to import variables from the lst file?") \
                                 == QMessageBox.Yes
                 print(import_vars)
-                self.parse_lst(lst, import_vars)
-                self.runner_polling.start(500)
+                try:
+                    self.load_listing(lst, import_vars)
+                except OSError as e:
+                    QMessageBox.warning(self, "Error", f"Can't read {lst}: {e}")
+                    self.follow_run = False
+                    return
+                self.runner.main_cpu.breakpoints.set_listing(self.current_lst)
+                self.runner.disasmview.set_symbols(self.current_symbols)
+                self.follow_run = True
+                self.run_lines = None
                 break
         else:
             QMessageBox.warning(self, "Error", "No lst file to run. Line highlighting disabled.")
-            self.runner_polling.stop()
+            self.follow_run = False
         for ext in (".h68", ".H68"):
             bin = os.path.splitext(self.current_file)[0] + ext
             if os.path.exists(bin):
-                self.runner.load_file(bin)
+                try:
+                    self.runner.load_file(bin)
+                except srec.SrecError as e:
+                    QMessageBox.warning(self, "Error", f"Invalid binary file: {e}")
+                    self.follow_run = False
+                    return
                 self.exec_dock.show()
                 break
         else:
             QMessageBox.warning(self, "Error", "No binary file to run.")
-            self.runner_polling.stop()
+            self.follow_run = False
             return
 
     def close_event(self, event):
@@ -458,42 +825,113 @@ class IDE(QMainWindow):
                             f'{"*" if modified else ""}')
 
     def update_highlighted_running_line(self):
-        pc = self.runner.main_cpu.cpu.r_pc()
-        #print("Running line: ", self.current_lst.get(pc, -1))
-        line = self.current_lst.get(pc, 0)-1
-        #print(line)
-        fmt = QTextCharFormat()
-        fmt.setBackground(QColor("#64fffd8d"))
-        #fmt.setUnderlineStyle(QTextCharFormat.SpellCheckUnderline)
-        #cursor = self.text_edit.textCursor()
-        cursor = QTextCursor(self.text_edit.document().findBlockByLineNumber(line))
-        cursor.select(QTextCursor.LineUnderCursor)
-        selection = QTextEdit.ExtraSelection()
-        selection.cursor = cursor
-        selection.format = fmt
-        self.text_edit.setExtraSelections([selection])
-        #cursor.movePosition(QTextCursor.EndOfLine, QTextCursor.KeepAnchor)
+        """Marks the line of the pc and the one of the last watchpoint hit,
+        rebuilt only when they move"""
+        if not self.follow_run or self.listing is None:
+            return
+        pc = self.runner.main_cpu.get_state()["pc"]
+        wps = self.runner.main_cpu.watchpoints
+        lines = (self.listing.line_of(pc),
+                 self.listing.line_of(wps.hit_pc) if wps.hit is not None else None)
+        if lines == self.run_lines:
+            return
+        self.run_lines = lines
+        line, hit_line = lines
+        self.text_edit.set_overlay("run", [] if line is None else [
+            self.text_edit.line_selection(line, QColor("#64fffd8d"))])
+        # the instruction that touched the watched data
+        self.text_edit.set_overlay("watch", [] if hit_line is None else [
+            self.text_edit.line_selection(hit_line, QColor("#64ff9f43"))])
 
     def highlight_errors(self, errors: list[int]):
-        fmt = QTextCharFormat()
-        fmt.setBackground(QColor("#ff6464"))
-        selections = []
-        for line in errors:
-            cursor = QTextCursor(self.text_edit.document().findBlockByLineNumber(line-1))
-            cursor.select(QTextCursor.LineUnderCursor)
-            selection = QTextEdit.ExtraSelection()
-            selection.cursor = cursor
-            selection.format = fmt
-            selections.append(selection)
-        self.text_edit.setExtraSelections(selections)
+        self.text_edit.set_overlay("errors", [
+            self.text_edit.line_selection(line, QColor("#ff6464")) for line in errors])
+
+    def show_profile(self):
+        """Colors the lines by the cycles they took in the last profiled
+        run and writes the hottest routines in the compiler log"""
+        profile = self.runner.main_cpu.profile
+        if profile is None:
+            QMessageBox.warning(self, "Error", "Run with profiler first.")
+            return
+        heat = profiler.heat(profile.by_line(self.current_lst))
+        self.text_edit.set_overlay("heat", [
+            self.text_edit.line_selection(line, QColor(255, 96, 0, int(24 + 160 * level)))
+            for line, level in sorted(heat.items())])
+        self.compiler_widget.setPlainText(profile.report(self.current_symbols))
+        self.dock.show()
+
+    def hide_profile(self):
+        self.text_edit.set_overlay("heat", [])
+
+    def export_profile(self):
+        profile = self.runner.main_cpu.profile
+        if profile is None:
+            QMessageBox.warning(self, "Error", "Run with profiler first.")
+            return
+        fname, chosen = QFileDialog.getSaveFileName(
+                self, 'Export profile', os.path.splitext(self.current_file or "profile")[0],
+                'CSV per address (*.csv);;Collapsed stacks for flame graphs (*.folded)')
+        if not fname:
+            return
+        if chosen.startswith("Collapsed"):
+            if not fname.endswith(".folded"):
+                fname += ".folded"
+            profile.export_collapsed(fname, self.current_symbols)
+        else:
+            if not fname.endswith(".csv"):
+                fname += ".csv"
+            profile.export_csv(fname, self.current_lst, self.current_symbols)
+
+    def start_trace(self):
+        cpu = self.runner.main_cpu
+        if not cpu.get_power_status():
+            QMessageBox.warning(self, "Error", "Load a program first.")
+            return
+        fname, _ = QFileDialog.getSaveFileName(
+                self, 'Start trace', os.path.splitext(self.current_file or "trace")[0] + ".trace",
+                'Instruction trace (*.trace);;All Files (*.*)')
+        if fname:
+            try:
+                cpu.start_trace(fname)
+            except (OSError, RuntimeError) as e:
+                QMessageBox.warning(self, "Error", str(e))
+
+    def stop_trace(self) -> bool:
+        try:
+            self.runner.main_cpu.stop_trace()
+        except RuntimeError as e:
+            QMessageBox.warning(self, "Error", str(e))
+            return False
+        return True
+
+    def open_trace(self):
+        fname, _ = QFileDialog.getOpenFileName(self, 'Open trace', '',
+                                               'Instruction trace (*.trace)'
+                                               ';;All Files (*.*)')
+        if not fname:
+            return
+        # the trace may still be written to
+        if self.runner.main_cpu.tracer is not None \
+                and os.path.abspath(self.runner.main_cpu.tracer.path) == os.path.abspath(fname) \
+                and not self.stop_trace():
+            return
+        try:
+            self.trace_view.open(fname, self.current_symbols)
+        except (OSError, ValueError) as e:
+            QMessageBox.warning(self, "Error", str(e))
+            return
+        self.trace_dock.show()
 
     def stop(self):
         self.stop_highlighting()
         self.runner.poweroff()
 
     def stop_highlighting(self):
-        self.runner_polling.stop()
-        self.text_edit.setExtraSelections([])
+        self.follow_run = False
+        self.run_lines = None
+        self.text_edit.set_overlay("run", [])
+        self.text_edit.set_overlay("watch", [])
 
     def show_about(self):
         self.about.show()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+# ASIM Reborn - Simple multiplatform 68k IDE
+# Copyright (C) 2024 Francesco Palazzo
+
+import bisect
+import json
+import os
+import os.path
+import re
+from typing import Dict, List, Optional, Tuple
+
+# "00:00008000 7200     12: main: moveq #0,d1", code of a source line, and
+# "00:00008006 0BB8", more bytes of the line above
+SOURCE_RE = re.compile(r"^[0-9A-Fa-f]{2}:([0-9A-Fa-f]{8})\s+(?:([0-9A-Fa-f]+)\s+)?(\d+):")
+MORE_RE = re.compile(r"^[0-9A-Fa-f]{2}:[0-9A-Fa-f]{8}\s+([0-9A-Fa-f]+)\s*$")
+# "main                             A:00008000" in "Symbols by name"
+SYMBOL_RE = re.compile(r"^(\S+)\s+A:([0-9A-Fa-f]{8})")
+
+# index files written next to the binary, rebuilt when the listing changes
+INDEX_EXT = ".lstidx"
+INDEX_VERSION = 1
+
+
+class ListingIndex:
+    def __init__(self, entries: List[Tuple[int, int, int]], symbols: Dict[str, int]):
+        """Address <-> source line maps of a vasm listing.
+        entries are (address, bytes, line) of every source line with code,
+        symbols the absolute symbols by name. Lookups by address also find
+        the line of an address in the middle of an instruction"""
+        entries = sorted(entries)
+        self.entries = entries
+        self.starts = [addr for addr, _, _ in entries]
+        self.ends = [addr + size for addr, size, _ in entries]
+        self.line_at = [line for _, _, line in entries]
+        # address -> line of the first byte of each line, the old
+        # IDE.current_lst, and line -> [start, end) of its code
+        self.lines: Dict[int, int] = {addr: line for addr, _, line in entries}
+        self.ranges: Dict[int, Tuple[int, int]] = {}
+        for (addr, _, line), end in zip(entries, self.ends):
+            start, last = self.ranges.get(line, (addr, end))
+            self.ranges[line] = (min(start, addr), max(last, end))
+        self.symbols = symbols
+        pairs = sorted((addr, name) for name, addr in symbols.items())
+        self.symbol_addrs = [addr for addr, _ in pairs]
+        # listing the index was built from
+        self.path = ""
+        self.mtime = 0
+        self.size = 0
+
+    def line_of(self, addr: int) -> Optional[int]:
+        """Source line of the instruction containing addr"""
+        line = self.lines.get(addr)
+        if line is not None:
+            return line
+        i = bisect.bisect_right(self.starts, addr) - 1
+        if i >= 0 and addr < self.ends[i]:
+            return self.line_at[i]
+        return None
+
+    def range_of(self, line: int) -> Optional[Tuple[int, int]]:
+        """[start, end) of the code of a source line"""
+        return self.ranges.get(line)
+
+    def address_of(self, name: str) -> Optional[int]:
+        return self.symbols.get(name)
+
+    def symbol_size(self, name: str) -> Optional[int]:
+        """Bytes from a symbol to the next one, or to the end of the code
+        for the last one"""
+        addr = self.symbols.get(name)
+        if addr is None:
+            return None
+        i = bisect.bisect_right(self.symbol_addrs, addr)
+        if i < len(self.symbol_addrs):
+            return self.symbol_addrs[i] - addr
+        return max(max(self.ends, default=addr) - addr, 0)
+
+    def save(self, path: str):
+        with open(path, "w") as f:
+            json.dump({"version": INDEX_VERSION, "mtime": self.mtime, "size": self.size,
+                       "entries": self.entries, "symbols": self.symbols}, f)
+
+
+def parse(path: str) -> ListingIndex:
+    """Reads a vasm listing (-L): code lines, then "Symbols by name" """
+    entries: List[List[int]] = []
+    symbols: Dict[str, int] = {}
+    with open(path, "r") as file:
+        symbols_mode = False
+        for line in file:
+            if symbols_mode:
+                if line.strip() == "":
+                    break
+                match = SYMBOL_RE.match(line)
+                if match:
+                    symbols[match.group(1)] = int(match.group(2), 16)
+                continue
+            if line.startswith("Symbols by name"):
+                symbols_mode = True
+                continue
+            match = SOURCE_RE.match(line)
+            if match:
+                addr, code, row = match.groups()
+                entries.append([int(addr, 16), len(code or "") // 2, int(row)])
+                continue
+            match = MORE_RE.match(line)
+            if match and entries:
+                entries[-1][1] += len(match.group(1)) // 2
+    return ListingIndex([(addr, size, row) for addr, size, row in entries], symbols)
+
+
+def index_path(binary: str) -> str:
+    return os.path.splitext(binary)[0] + INDEX_EXT
+
+
+def load(lst: str, binary: str, cached: Optional[ListingIndex] = None) -> ListingIndex:
+    """Index of the listing lst: cached if the listing didn't change since,
+    else the one saved next to binary, else parsed again and saved.
+    Raises OSError if lst can't be read"""
+    stat = os.stat(lst)
+    lst = os.path.abspath(lst)
+    if cached is not None and (cached.path, cached.mtime, cached.size) \
+            == (lst, stat.st_mtime_ns, stat.st_size):
+        return cached
+    saved = index_path(binary)
+    try:
+        with open(saved, "r") as f:
+            data = json.load(f)
+        if data["version"] == INDEX_VERSION \
+                and (data["mtime"], data["size"]) == (stat.st_mtime_ns, stat.st_size):
+            index = ListingIndex([tuple(e) for e in data["entries"]], data["symbols"])
+            index.path, index.mtime, index.size = lst, stat.st_mtime_ns, stat.st_size
+            return index
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    index = parse(lst)
+    index.path, index.mtime, index.size = lst, stat.st_mtime_ns, stat.st_size
+    try:
+        index.save(saved)
+    except OSError:
+        # read-only directory, the index is just not persisted
+        pass
+    return index
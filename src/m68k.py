@@ -3,43 +3,132 @@
 # ASIM Reborn - Simple multiplatform 68k IDE
 # Copyright (C) 2024 Francesco Palazzo
 
-import threading
-from typing import Any, Optional, Dict, Tuple, Union # "tuple" works from 3.9 onwards
+import contextlib, threading, time
+from typing import Any, Callable, Optional, Dict, List, Tuple, Union # "tuple" works from 3.9 onwards
 
 import bare68k as b68k
-from bare68k.consts import M68K_CPU_TYPE_68000, MEM_FC_SUPER_MASK
+from bare68k.consts import M68K_CPU_TYPE_68000, CPU_EVENT_BREAKPOINT, \
+    CPU_EVENT_INSTR_HOOK
+
+import srec
+from history import History
+from watchpoints import Watchpoint, Watchpoints
+from breakpoints import Breakpoint, BreakpointHit, Breakpoints
+from profiler import Profile
+from tracer import Tracer, INSTR_BYTES
+from disassembly import Disassembly, Line
 
 cpucfg = b68k.CPUConfig(M68K_CPU_TYPE_68000)
 memcfg = b68k.MemoryConfig()
 # Every page is 64k
-# So, from page 0 to 6 (0x0000 to 0x3FFFF) is RAM
-memcfg.add_ram_range(0, 6)
+# So, from page 0 to 6 (0x0000 to 0x5FFFF) is RAM
+RAM_PAGES = 6
+RAM_SIZE = RAM_PAGES * 0x10000
+memcfg.add_ram_range(0, RAM_PAGES)
 runcfg = b68k.RunConfig()
 
 base = 0x8000
 stack = 0x9200
 
+# Batched execution: every native execute() call runs a slice of cycles whose
+# size adapts so that a slice takes about SLICE_TARGET seconds. Short enough
+# to react quickly to stop requests and IRQ changes, long enough to keep the
+# Python overhead negligible.
+MIN_SLICE_CYCLES = 1000
+MAX_SLICE_CYCLES = 4000000
+SLICE_TARGET = 0.005
+# Single instructions executed before each slice to estimate the average
+# cycles per instruction (the core only counts cycles)
+CPI_SAMPLES = 4
+# Instructions executed one by one after passing a breakpoint, instead of
+# rewinding a whole slice whenever a hot conditional line is reached again
+NEAR_BREAKPOINT_STEPS = 4096
+# Instructions between the checks of a stepped run (stop, timers, IRQs)
+STEPPED_CHECK = 256
+# Seconds between the checks of a stepped run parked in a halt
+PARKED_POLL = 0.01
+# Cycles per native call of run_exact, fixed so that the results do not
+# depend on how fast the host is
+EXACT_SLICE_CYCLES = 1000000
+# Instructions of a free run between two RUNNING changes
+PROGRESS_INSTRUCTIONS = 100000
+
+# state changes reported to on_change
+STEPPED = "stepped"        # single steps, step back, restart, load
+RUNNING = "running"        # progress of a free run
+HALTED = "halted"          # progress of a free run parked in a branch to itself
+BREAKPOINT = "breakpoint"  # a free run stopped by a breakpoint or watchpoint
+STOPPED = "stopped"        # a free run paused or stopped
+
+
+def is_halt(pc: int, words: Tuple[int, ...]) -> bool:
+    """True for a branch to itself, the usual way lab programs end
+    (`stop bra stop`)"""
+    if words[:1] == (0x60FE,) or words[:2] == (0x6000, 0xFFFE):
+        return True
+    return len(words) >= 3 and words[0] == 0x4EF9 \
+        and (words[1] << 16 | words[2]) == pc
+
+
+class CycleTimer:
+    def __init__(self, interval: int, callback: Callable[[], None]):
+        """Calls callback every `interval` emulated cycles, on the thread
+        that is executing the CPU"""
+        self.interval = interval
+        self.callback = callback
+        self.deadline = interval
+
+
+class Snapshot:
+    def __init__(self, context, ram: bytes, pending_irq: Optional[int],
+                 ack_irq: Optional[int]):
+        """Full machine state: the native CPU context (registers, SR, PC,
+        interrupt level) and a copy of the whole RAM"""
+        self.context = context
+        self.ram = ram
+        self.pending_irq = pending_irq
+        self.ack_irq = ack_irq
+
+
+class RunStats:
+    def __init__(self):
+        """Counters of a run.
+        run_batched counts the sampled single steps and estimates the
+        instructions of the bulk slices from the average cycles per
+        instruction, setting estimated; run_stepped and run_exact count
+        every one. The branch to itself of a halted program is not
+        counted, its slices only add cycles and idle_time"""
+        self.cycles = 0
+        self.instructions = 0
+        self.sampled_cycles = 0
+        self.sampled_instructions = 0
+        self.elapsed = 0.0
+        self.idle_time = 0.0
+        self.event = None
+        # instructions and ips() are approximate
+        self.estimated = False
+        # the program sits in a branch to itself
+        self.halted = False
+        # instructions at the last RUNNING change
+        self.reported = 0
+
+    def cpi(self) -> float:
+        if self.sampled_instructions == 0:
+            return 0.0
+        return self.sampled_cycles / self.sampled_instructions
+
+    def ips(self) -> float:
+        """Instructions per second while the program was not halted"""
+        busy = self.elapsed - self.idle_time
+        if busy <= 0:
+            return 0.0
+        return self.instructions / busy
+
+    def __str__(self) -> str:
+        approx = "~" if self.estimated else ""
+        return (f"{approx}{self.instructions} instructions ({self.cycles} cycles) "
+                f"in {self.elapsed:.3f}s, {self.ips()/1e6:.2f} MIPS")
 
-def parse_srec_line(line: str) -> Optional[Union[
-        Tuple[int, bytes, bytes], Tuple[int, bytes]]]:
-    line = line.strip()
-    if line[0] != 'S':
-        return None
-    record_type = int(line[1])
-    bytecount: int = int(line[2:4], 16)
-    if record_type in (1,2,3):
-        addrsize = record_type + 1
-        return (
-                bytecount,
-                bytes.fromhex(line[4:4+addrsize*2]),
-                bytes.fromhex(line[4+addrsize*2:-2])
-        )
-    elif record_type in (7,8,9):
-        return (
-                bytecount,
-                bytes.fromhex(line[4:-2])
-        )
-    return None
 
 class m68k:
     def __init__(self):
@@ -47,66 +136,693 @@ class m68k:
         self.mem = self.runtime.get_mem()
         self.cpu = self.runtime.get_cpu()
         self.new_base = base
-        self.run_thread: Optional[Thread] = None
+        self.run_thread: Optional[threading.Thread] = None
+        self.run_stats = RunStats()
+        self.running = False
+        self.pending_irq: Optional[int] = None
+        # free-run handshake, see run()
+        self.stop_request = threading.Event()
+        self.pause_request = threading.Event()
+        self.paused = threading.Event()
+        self.resumed = threading.Event()
+        # registers published by the run loop after every slice
+        self.last_regs: Dict[str, int] = {}
+        self.timers: List[CycleTimer] = []
+        # emulated clock the run loop is throttled to, None runs flat out
+        self.clock_hz: Optional[int] = None
+        # IRQ level raised with raise_irq, dropped when the CPU acknowledges it
+        self.ack_irq: Optional[int] = None
+        self.cpu.set_int_ack_func(self.int_ack)
+        self.boot_snapshot: Optional[Snapshot] = None
+        self.history: Optional[History] = None
+        self.watchpoints = Watchpoints(self.mem, self.cpu)
+        self.breakpoints = Breakpoints(self.mem, self.cpu)
+        # instructions execute_slice still steps after passing a breakpoint
+        self.near_breakpoint = 0
+        # run() counts every instruction in profile while profiling is set
+        # and records every instruction with the tracer while there is one
+        self.profiling = False
+        self.profile: Optional[Profile] = None
+        self.tracer: Optional[Tracer] = None
+        self.disassembly = Disassembly(self.get_mem)
+        # called with STEPPED, RUNNING... on the thread that changed the
+        # state, the run loop's one while running
+        self.on_change: Optional[Callable[[str], None]] = None
 
     def load_file(self, fname: str):
+        image = srec.load_srec(fname)
         self.reset()
-        b68k.api.tools.setup_breakpoints(1)
-        self.found_new_base = False
+        self.found_new_base = image.start is not None
         self.new_base = base
-        with open(fname, 'r') as f:
-            for line in f.readlines():
-                parsed_line = parse_srec_line(line)
-                #print(parsed_line)
-                if parsed_line == None:
-                    continue
-                address = int.from_bytes(parsed_line[1], "big")
-                if len(parsed_line) == 3:
-                    bytecode: bytes = parsed_line[2]
-                    c = 0
-                    for dec_byte in bytecode:
-                        #print(f"writing {dec_byte:02X} at {address+c:02X}")
-                        self.mem.w8(address+c, dec_byte)
-                        c+=1
-                else:
-                    self.found_new_base = True
-                    self.new_base = address
-                    b68k.api.tools.set_breakpoint(
-                                b68k.api.tools.get_next_free_breakpoint(),
-                                address, MEM_FC_SUPER_MASK, None)
-
-                    #print(f"found start at {self.new_base:02X}")
-                #c+=1
-                #byte = f.read(1)
+        for address, data in image.segments:
+            self.set_mem(address, data)
+        self.disassembly.load(image.segments)
+        if self.found_new_base:
+            self.new_base = image.start
+        self.breakpoints.entry = image.start
+        self.breakpoints.reset_hits()
+        self.breakpoints.install()
+        self.watchpoints.install()
 
         print(f"Starting at {self.new_base:02X} (stack {stack:02X})\n")
         self.runtime.reset(self.new_base, stack)
+        self.boot_snapshot = self.snapshot()
+        self.notify(STEPPED)
+
+    def snapshot(self) -> Snapshot:
+        """Captures the machine state, pausing the run loop meanwhile"""
+        with self.run_paused():
+            return Snapshot(self.cpu.get_cpu_context(),
+                            self.mem.r_block(0, RAM_SIZE),
+                            self.pending_irq, self.ack_irq)
+
+    def restore(self, snapshot: Snapshot):
+        """Brings the machine back to a snapshot without rebuilding the
+        runtime: one bulk RAM write and the CPU context"""
+        self.stop()
+        self.mem.w_block(0, snapshot.ram)
+        self.cpu.set_cpu_context(snapshot.context)
+        self.pending_irq = snapshot.pending_irq
+        self.ack_irq = snapshot.ack_irq
+        self.cpu.clear_info()
+        cycles = self.get_cycles()
+        for timer in self.timers:
+            timer.deadline = cycles + timer.interval
+        if self.history is not None:
+            self.history.clear()
+        self.breakpoints.reset_hits()
+        self.notify(STEPPED)
+
+    def restart(self) -> bool:
+        """Restarts the loaded program from its entry point"""
+        if self.boot_snapshot is None or not self.get_power_status():
+            return False
+        self.restore(self.boot_snapshot)
+        return True
 
     def reset(self):
         self.poweroff()
         self.runtime = b68k.Runtime(cpucfg, memcfg, runcfg)
+        self.cpu.set_int_ack_func(self.int_ack)
+        self.ack_irq = None
+        for timer in self.timers:
+            timer.deadline = timer.interval
+        if self.history is not None:
+            self.history.clear()
 
-    def get_current_line(self):
-        current_line = b68k.api.disasm.disassemble(self.cpu.r_pc()) # returns InstrLine (disassemble.py)
+    def get_current_line(self, pc: Optional[int] = None) -> Line:
+        """Cached disassembly, up to date as of the last
+        disassembly.validate()"""
+        if pc is None:
+            pc = self.cpu.r_pc()
+        current_line = self.disassembly.at(pc) # (pc, words, text)
         return current_line
-        print(current_line)
-        return f"0x{self.cpu.r_pc():08X}: {current_line[2]}"
 
     def step(self):
+        if self.is_running() and not self.is_paused():
+            return False
         if self.get_power_status():
-            self.cpu.execute(1)
+            if self.history is not None:
+                self.history.begin(RAM_SIZE)
+            try:
+                if self.tracer is not None:
+                    pc = self.cpu.r_pc()
+                    code = self.read_code(pc)
+                    self.cpu.execute(1)
+                    self.tracer.record(pc, code, self.cpu.get_done_cycles())
+                else:
+                    self.cpu.execute(1)
+                self.tick_timers()
+            finally:
+                if self.history is not None:
+                    self.history.end()
+            self.notify(STEPPED)
             return True
         return False
 
+    def enable_history(self, max_steps: int, max_bytes: int):
+        """Records an undo record for every single step, see step_back"""
+        self.history = History(self.mem, self.cpu, max_steps, max_bytes)
+
+    def disable_history(self):
+        self.history = None
+
+    def step_back(self, n: int = 1) -> int:
+        """Undoes the last n recorded steps. Free runs are not recorded
+        and clear the history. Returns how many steps were undone"""
+        if self.history is None or not self.get_power_status():
+            return 0
+        if self.is_running() and not self.is_paused():
+            return 0
+        undone = self.history.step_back(n)
+        if undone:
+            self.notify(STEPPED)
+        return undone
+
     def get_power_status(self):
         return b68k.machine.is_initialized()
 
-    # I DON'T KNOW WHY THIS DOESN'T WORK
-    # GUESS I'LL STICK TO USING STEP
-    # def run(self):
-        # self.run_thread = threading.Thread(target=self.runtime.run)
-        # self.run_thread.daemon = True
-        # self.run_thread.start()
+    def is_halted(self) -> bool:
+        """True if the CPU sits in a branch to itself, see is_halt"""
+        pc = self.cpu.r_pc()
+        code = self.read_code(pc)
+        words = tuple(int.from_bytes(code[i:i + 2], "big")
+                      for i in range(0, len(code) - 1, 2))
+        return is_halt(pc, words)
+
+    def halt_addresses(self) -> set:
+        """Branches to themselves in the loaded program"""
+        return {pc for pc, words, _ in self.disassembly.lines.values()
+                if is_halt(pc, words)}
+
+    def execute_slice(self, cycles: int, step_off: bool = False) -> Tuple[int, list]:
+        """Runs at least one instruction and up to `cycles` cycles in a single
+        native call. Returns the cycles done and the events (breakpoints,
+        bus errors, reset...) that cut the slice short.
+        With user breakpoints the CPU stops before their instruction: the
+        one at pc is checked first, unless stepping off it, and a slice that
+        reaches one is rewound and replayed up to it. After passing a
+        breakpoint the CPU steps for a while instead, a hot conditional
+        line would otherwise rewind a slice on every pass"""
+        bps = self.breakpoints
+        if not bps.by_addr:
+            return self.execute_native(cycles)
+        pc = self.cpu.r_pc()
+        point = bps.by_addr.get(pc)
+        if point is not None:
+            if not step_off and bps.should_stop(point):
+                return 0, [BreakpointHit(pc, point)]
+            if not self.near_breakpoint:
+                bps.enable_core(False)
+            self.near_breakpoint = NEAR_BREAKPOINT_STEPS
+        if self.near_breakpoint > 0 or cycles == 1:
+            return self.execute_stepped(cycles)
+        context = self.cpu.get_cpu_context()
+        ram = self.mem.r_block(0, RAM_SIZE)
+        ack_irq = self.ack_irq
+        watched = self.watchpoints.save()
+        done, events = self.execute_native(cycles)
+        if events and events[0].ev_type == CPU_EVENT_BREAKPOINT \
+                and isinstance(events[0].data, Breakpoint):
+            # the core already executed the instruction, go back to the
+            # start of the slice and run the cycles before it again
+            replay = events[0].cycles
+            self.mem.w_block(0, ram)
+            self.cpu.set_cpu_context(context)
+            self.ack_irq = ack_irq
+            self.watchpoints.restore(watched)
+            for timer in self.timers:
+                timer.deadline += done
+            done, events = self.execute_native(replay) if replay else (0, [])
+        return done, events
+
+    def execute_stepped(self, cycles: int) -> Tuple[int, list]:
+        """One instruction per native call, checking the breakpoints before
+        each but the first, which execute_slice checked"""
+        bps = self.breakpoints
+        cpu = self.cpu
+        done = 0
+        pc = cpu.r_pc()
+        while True:
+            if cpu.execute(1):
+                events = [e for e in self.watchpoints.filter(cpu.get_info().events)
+                          if not (e.ev_type == CPU_EVENT_BREAKPOINT and e.addr == pc)]
+                if events:
+                    return done + cpu.get_done_cycles(), events
+            done += cpu.get_done_cycles()
+            if self.near_breakpoint > 0:
+                self.near_breakpoint -= 1
+                if not self.near_breakpoint:
+                    bps.enable_core(True)
+                    return done, []
+            if done >= cycles:
+                return done, []
+            pc = cpu.r_pc()
+            point = bps.by_addr.get(pc)
+            if point is not None:
+                if bps.should_stop(point):
+                    return done, [BreakpointHit(pc, point)]
+                self.near_breakpoint = NEAR_BREAKPOINT_STEPS
+
+    def execute_native(self, cycles: int) -> Tuple[int, list]:
+        num_events = self.cpu.execute(cycles)
+        done = self.cpu.get_done_cycles()
+        if num_events:
+            return done, self.watchpoints.filter(self.cpu.get_info().events)
+        return done, []
+
+    def run_batched(self, stop_requested: Callable[[], bool],
+                    cycle_limit: Optional[int] = None) -> RunStats:
+        """Runs the CPU in adaptive slices until stop_requested() returns True,
+        the core reports an event, e.g. a breakpoint, or cycle_limit cycles
+        are done. The last instruction may end past cycle_limit, and
+        stop_requested() is only checked between slices. Instructions are
+        estimated, run_exact counts them"""
+        stats = RunStats()
+        self.run_stats = stats
+        if self.history is not None:
+            self.history.clear()
+        self.watchpoints.arm()
+        self.breakpoints.hit = None
+        self.running = True
+        slice_cycles = MIN_SLICE_CYCLES
+        start_pc = self.cpu.r_pc()
+        start = time.perf_counter()
+        try:
+            # step off the current instruction first, so that a breakpoint
+            # we are parked on does not stop us right away
+            done, events = self.execute_slice(1, step_off=True)
+            stats.cycles += done
+            stats.instructions += 1
+            events = [e for e in events if not (
+                e.ev_type == CPU_EVENT_BREAKPOINT and e.addr == start_pc)]
+            while not events and self.get_power_status() \
+                    and not stop_requested():
+                if cycle_limit is not None and stats.cycles >= cycle_limit:
+                    break
+                self.apply_pending_irq()
+                budget = slice_cycles
+                if cycle_limit is not None:
+                    budget = min(budget, cycle_limit - stats.cycles)
+                if self.timers:
+                    budget = min(budget, self.cycles_to_next_timer())
+                if self.clock_hz:
+                    budget = min(budget, int(self.clock_hz * SLICE_TARGET))
+                slice_start = time.perf_counter()
+                idle = self.is_halted()
+                if idle:
+                    # the core burns the whole budget in the branch, there
+                    # is nothing to sample or count
+                    done, events = self.execute_slice(max(budget, 1))
+                    stats.cycles += done
+                    if not stats.halted:
+                        stats.halted = True
+                        self.notify(HALTED)
+                else:
+                    stats.halted = False
+                    sampled = stats.sampled_cycles
+                    for _ in range(min(CPI_SAMPLES, budget)):
+                        done, events = self.execute_slice(1)
+                        stats.cycles += done
+                        stats.sampled_cycles += done
+                        stats.sampled_instructions += 1
+                        stats.instructions += 1
+                        if events:
+                            break
+                    else:
+                        done, events = self.execute_slice(
+                                max(budget - stats.sampled_cycles + sampled, 1))
+                        stats.cycles += done
+                        cpi = stats.cpi()
+                        stats.instructions += round(done / cpi) if cpi else 1
+                        stats.estimated = True
+                slice_time = time.perf_counter() - slice_start
+                if idle:
+                    stats.idle_time += slice_time
+                self.tick_timers()
+                if self.clock_hz:
+                    ahead = stats.cycles / self.clock_hz - (time.perf_counter() - start)
+                    if ahead > 0:
+                        time.sleep(ahead)
+                stats.elapsed = time.perf_counter() - start
+                self.publish(stats)
+                if slice_time < SLICE_TARGET / 2:
+                    slice_cycles = min(slice_cycles * 2, MAX_SLICE_CYCLES)
+                elif slice_time > SLICE_TARGET * 2:
+                    slice_cycles = max(slice_cycles // 2, MIN_SLICE_CYCLES)
+            if events:
+                stats.event = events[0]
+        finally:
+            self.running = False
+            stats.elapsed = time.perf_counter() - start
+        return stats
+
+    def run_exact(self, cycle_limit: int,
+                  instruction_limit: Optional[int] = None) -> RunStats:
+        """Deterministic run for batch grading, same machine state and counts
+        on every host: slices of a fixed size and every instruction counted
+        by the core's instruction hook. Stops when the program reaches a
+        branch to itself, before it is counted, after exactly
+        instruction_limit instructions, on a core event, or at the first
+        instruction that ends at or after cycle_limit cycles"""
+        stats = RunStats()
+        self.run_stats = stats
+        halts = self.halt_addresses()
+        count = 0
+
+        def hook(pc: int) -> Optional[bool]:
+            # anything but None raises an event, which ends the slice
+            # after this instruction
+            nonlocal count
+            count += 1
+            if pc in halts:
+                return True
+            if count == instruction_limit:
+                return False
+            return None
+
+        if self.history is not None:
+            self.history.clear()
+        self.watchpoints.arm()
+        self.breakpoints.hit = None
+        self.running = True
+        start = time.perf_counter()
+        b68k.api.cpu.set_instr_hook_func(hook)
+        try:
+            while self.get_power_status() and stats.cycles < cycle_limit:
+                if instruction_limit is not None and count >= instruction_limit:
+                    break
+                self.apply_pending_irq()
+                budget = min(EXACT_SLICE_CYCLES, cycle_limit - stats.cycles)
+                if self.timers:
+                    budget = min(budget, self.cycles_to_next_timer())
+                before = count
+                done, events = self.execute_native(budget)
+                hooked = [e for e in events if e.ev_type == CPU_EVENT_INSTR_HOOK]
+                # the core breakpoint on the entry point is only a marker
+                events = [e for e in events if e.ev_type != CPU_EVENT_INSTR_HOOK
+                          and not (e.ev_type == CPU_EVENT_BREAKPOINT and e.data is None)]
+                if hooked and hooked[0].data:
+                    # the branch ran once after the hook, leaving the
+                    # machine as it was: take back its cycles and count
+                    done = hooked[0].cycles
+                    count -= 1
+                    stats.halted = True
+                elif count == before and not self.timers and self.pending_irq is None:
+                    # stopped by a stop instruction with nothing to wake it
+                    done = 0
+                    stats.halted = True
+                stats.cycles += done
+                self.tick_timers()
+                if events:
+                    stats.event = events[0]
+                if events or stats.halted:
+                    break
+        finally:
+            b68k.api.cpu.set_instr_hook_func(None)
+            self.running = False
+            stats.instructions = stats.sampled_instructions = count
+            stats.sampled_cycles = stats.cycles
+            stats.elapsed = time.perf_counter() - start
+        return stats
+
+    def run_stepped(self, stop_requested: Callable[[], bool],
+                    cycle_limit: Optional[int] = None) -> RunStats:
+        """Same contract as run_batched, but executes one instruction per
+        native call, for the profiler (exact pc and cycles of every
+        instruction in self.profile) and the tracer. Breakpoints are
+        checked here before the instruction, so no slice has to be rewound.
+        A program that halts with no timers ends a run with a cycle_limit,
+        else it is parked, not stepped, until an IRQ or a stop request"""
+        stats = RunStats()
+        self.run_stats = stats
+        profile = None
+        if self.profiling:
+            if self.profile is None:
+                self.profile = Profile()
+            profile = self.profile
+        tracer = self.tracer
+        if self.history is not None:
+            self.history.clear()
+        self.watchpoints.arm()
+        self.breakpoints.hit = None
+        by_addr = self.breakpoints.by_addr
+        self.running = True
+        start = time.perf_counter()
+        events: list = []
+        try:
+            while self.get_power_status():
+                if stats.instructions % STEPPED_CHECK == 0:
+                    if stop_requested():
+                        break
+                    if cycle_limit is not None and stats.cycles >= cycle_limit:
+                        break
+                    self.tick_timers()
+                    self.apply_pending_irq()
+                    if self.clock_hz:
+                        ahead = stats.cycles / self.clock_hz - (time.perf_counter() - start)
+                        if ahead > 0:
+                            time.sleep(ahead)
+                    stats.elapsed = time.perf_counter() - start
+                    self.publish(stats)
+                pc = self.cpu.r_pc()
+                point = by_addr.get(pc)
+                if point is not None and stats.instructions \
+                        and self.breakpoints.should_stop(point):
+                    events = [BreakpointHit(pc, point)]
+                    break
+                code = self.read_code(pc)
+                done, events = self.execute_native(1)
+                if point is not None or not stats.instructions:
+                    # checked above, or the one we are stepping off
+                    events = [e for e in events if not (
+                        e.ev_type == CPU_EVENT_BREAKPOINT and e.addr == pc)]
+                if profile is not None:
+                    profile.record(pc, (code[0] << 8) | code[1], done, self.cpu.r_pc())
+                if tracer is not None:
+                    tracer.record(pc, code, done)
+                stats.cycles += done
+                stats.sampled_cycles += done
+                stats.instructions += 1
+                stats.sampled_instructions += 1
+                if events:
+                    break
+                if self.cpu.r_pc() == pc and not self.timers \
+                        and self.pending_irq is None and self.is_halted():
+                    stats.halted = True
+                    if cycle_limit is not None:
+                        # a bounded run ends here, like run_exact
+                        break
+                    # only an IRQ can move it on: wait for one without
+                    # recording the spin
+                    stats.elapsed = time.perf_counter() - start
+                    self.publish(stats)
+                    self.notify(HALTED)
+                    parked = time.perf_counter()
+                    while not stop_requested() and self.pending_irq is None:
+                        time.sleep(PARKED_POLL)
+                    stats.idle_time += time.perf_counter() - parked
+                    stats.halted = False
+                    if self.pending_irq is None:
+                        break
+                    self.apply_pending_irq()
+            if events:
+                stats.event = events[0]
+        finally:
+            self.running = False
+            stats.elapsed = time.perf_counter() - start
+        return stats
+
+    def publish(self, stats: RunStats):
+        """Registers for get_state, and a RUNNING or HALTED change every
+        PROGRESS_INSTRUCTIONS instructions"""
+        self.last_regs = self.get_regs()
+        if self.on_change is not None \
+                and stats.instructions - stats.reported >= PROGRESS_INSTRUCTIONS:
+            stats.reported = stats.instructions
+            self.on_change(HALTED if self.is_halted() else RUNNING)
+
+    def notify(self, kind: str):
+        if self.on_change is not None:
+            self.on_change(kind)
+
+    def read_code(self, pc: int) -> bytes:
+        """Bytes of the instruction at pc for the tracer, zeros where
+        unmapped"""
+        try:
+            return self.mem.r_block(pc, INSTR_BYTES)
+        except ValueError:
+            try:
+                return self.mem.r_block(pc, 2)
+            except ValueError:
+                return bytes(2)
+
+    def start_trace(self, path: str):
+        """Records every instruction from now on. A free run switches to
+        the stepped loop when it resumes from the pause taken here"""
+        self.stop_trace()
+        if not self.get_power_status():
+            return
+        with self.run_paused():
+            tracer = Tracer(path, self.cpu)
+            tracer.start()
+            self.tracer = tracer
+
+    def stop_trace(self):
+        """Closes the trace file, pausing the run loop meanwhile"""
+        if self.tracer is None:
+            return
+        with self.run_paused():
+            self.tracer.stop()
+            self.tracer = None
+
+    def run(self):
+        """Free-runs the CPU on a worker thread.
+        Runtime.run only returns on a core event, so the worker drives the
+        cycle-budgeted run_batched loop instead, which checks for stop and
+        pause requests between slices"""
+        if self.is_paused():
+            self.resume()
+            return
+        self.stop()
+        if not self.get_power_status():
+            return
+        self.stop_request.clear()
+        self.pause_request.clear()
+        self.paused.clear()
+        self.run_thread = threading.Thread(target=self.run_worker)
+        self.run_thread.daemon = True
+        self.run_thread.start()
+
+    def run_worker(self):
+        while True:
+            stepped = self.profiling or self.tracer is not None
+            run = self.run_stepped if stepped else self.run_batched
+            stats = run(lambda: self.stop_request.is_set()
+                        or self.pause_request.is_set())
+            if stats.event is not None:
+                self.notify(BREAKPOINT)
+                break
+            if self.stop_request.is_set() or not self.get_power_status():
+                self.notify(STOPPED)
+                break
+            if not self.pause_request.is_set():
+                # a pause given up by run_paused
+                continue
+            self.resumed.clear()
+            self.paused.set()
+            self.notify(STOPPED)
+            self.resumed.wait()
+            self.paused.clear()
+            if self.stop_request.is_set():
+                break
+
+    def add_breakpoint(self, line: Optional[int] = None, addr: Optional[int] = None,
+                       condition: str = "", hit_count: int = 0) -> Breakpoint:
+        with self.run_paused():
+            point = self.breakpoints.add(line, addr, condition, hit_count)
+            self.install_breakpoints()
+        return point
+
+    def remove_breakpoint(self, point: Breakpoint):
+        with self.run_paused():
+            self.breakpoints.remove(point)
+            self.install_breakpoints()
+
+    def install_breakpoints(self):
+        """Updates the core breakpoints, pausing the run loop meanwhile"""
+        if not self.get_power_status():
+            return
+        with self.run_paused():
+            self.breakpoints.install()
+
+    def add_watchpoint(self, start: int, length: int, mode: int) -> Watchpoint:
+        with self.run_paused():
+            point = self.watchpoints.add(start, length, mode)
+            self.install_watchpoints()
+        return point
+
+    def remove_watchpoint(self, point: Watchpoint):
+        with self.run_paused():
+            self.watchpoints.remove(point)
+            self.install_watchpoints()
+
+    def clear_watchpoints(self):
+        with self.run_paused():
+            self.watchpoints.clear()
+            self.install_watchpoints()
+
+    def install_watchpoints(self):
+        """Updates the core watchpoints, pausing the run loop meanwhile"""
+        if not self.get_power_status():
+            return
+        with self.run_paused():
+            self.watchpoints.install()
+            self.watchpoints.arm()
+
+    def get_cycles(self) -> int:
+        """Emulated cycles since the last reset"""
+        return self.cpu.get_total_cycles()
+
+    def add_cycle_timer(self, interval: int,
+                        callback: Callable[[], None]) -> CycleTimer:
+        """Calls callback every `interval` emulated cycles. The run loop
+        ends its slices on the timer deadlines, so the timing does not
+        depend on how fast the host runs"""
+        timer = CycleTimer(interval, callback)
+        timer.deadline = self.get_cycles() + interval
+        self.timers.append(timer)
+        return timer
+
+    def remove_cycle_timer(self, timer: CycleTimer):
+        if timer in self.timers:
+            self.timers.remove(timer)
+
+    def cycles_to_next_timer(self) -> int:
+        cycles = self.get_cycles()
+        return max(min(t.deadline for t in self.timers) - cycles, 1)
+
+    def tick_timers(self):
+        cycles = self.get_cycles()
+        for timer in list(self.timers):
+            if cycles >= timer.deadline:
+                # fire once even if we are late by more than an interval
+                timer.deadline = max(timer.deadline + timer.interval,
+                                     cycles + 1)
+                timer.callback()
+
+    def is_running(self) -> bool:
+        return self.run_thread is not None and self.run_thread.is_alive()
+
+    def is_paused(self) -> bool:
+        return self.is_running() and self.paused.is_set()
+
+    def pause(self, timeout: float = 1.0) -> bool:
+        """Asks the run loop to pause and waits until the CPU is idle.
+        Returns True if the CPU is not executing anymore"""
+        if not self.is_running():
+            return True
+        self.pause_request.set()
+        while self.is_running() and not self.paused.wait(0.01):
+            timeout -= 0.01
+            if timeout <= 0:
+                return False
+        return True
+
+    @contextlib.contextmanager
+    def run_paused(self):
+        """Pauses the run loop for the body of the with and resumes it
+        after. Raises RuntimeError, leaving the run as it was, if the CPU
+        doesn't pause in time: the body would race with the run loop"""
+        was_running = self.is_running() and not self.is_paused()
+        if not self.pause():
+            self.resume()
+            raise RuntimeError("The CPU did not pause in time, try again.")
+        try:
+            yield
+        finally:
+            if was_running:
+                self.resume()
+
+    def resume(self):
+        self.pause_request.clear()
+        self.resumed.set()
+
+    def stop(self):
+        """Stops the run loop and waits for the worker thread to exit"""
+        self.stop_request.set()
+        self.resumed.set()
+        if self.run_thread is not None:
+            if self.run_thread is not threading.current_thread():
+                self.run_thread.join()
+            self.run_thread = None
+
+    def get_state(self) -> Dict[str, int]:
+        """Registers snapshot that never blocks: while running returns the
+        copy published by the run loop after the last slice"""
+        if self.running and self.last_regs:
+            return self.last_regs
+        return self.get_regs()
 
     def format_sreg(self, sr: int) -> str:
         mask = 0x8000
@@ -142,25 +858,52 @@ class m68k:
             "sr": self.cpu.r_sr()
         }
 
-    def get_mem(self, start, bytelen) -> bytes:
-        bytearray = b''
-        for i in range(bytelen):
-            bytearray += self.mem.r8(start+i).to_bytes(1, "big")
-        return bytearray
+    def get_mem(self, start: int, bytelen: int) -> bytes:
+        """Reads a whole block with a single native call.
+        Raises ValueError if the block is not entirely mapped"""
+        if bytelen <= 0:
+            return b''
+        return self.mem.r_block(start, bytelen)
 
-    def set_mem(self, start, data: bytes):
-        for i in range(len(data)):
-            self.mem.w8(start+i, data[i])
+    def set_mem(self, start: int, data: Union[bytes, bytearray, memoryview]):
+        """Writes a whole block with a single native call"""
+        if len(data) == 0:
+            return
+        if not isinstance(data, bytes):
+            data = bytes(data)
+        if self.history is not None:
+            self.history.api_write(start, data)
+        self.mem.w_block(start, data)
 
     def set_irq(self, irq: int):
-        print(f"Setting IRQ {irq}")
-        self.cpu.set_irq(irq)
+        if self.running:
+            # the core is not reentrant: the run loop applies it between slices
+            self.pending_irq = irq
+        else:
+            self.cpu.set_irq(irq)
+
+    def raise_irq(self, irq: int):
+        """Raises an interrupt that stays pending until the CPU
+        acknowledges it, like a device clearing its request line"""
+        self.ack_irq = irq
+        self.set_irq(irq)
+
+    def int_ack(self, level: int, pc: int):
+        if level == self.ack_irq:
+            self.ack_irq = None
+            self.cpu.set_irq(0)
+
+    def apply_pending_irq(self):
+        irq = self.pending_irq
+        if irq is not None:
+            self.pending_irq = None
+            self.cpu.set_irq(irq)
 
     def poweroff(self):
+        self.stop()
+        self.stop_trace()
         try:
             self.runtime.shutdown()
-            if self.run_thread:
-                self.run_thread.join()
         except RuntimeError:
             print("Cpu was already shutdown")
 
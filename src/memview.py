@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+# ASIM Reborn - Simple multiplatform 68k IDE
+# Copyright (C) 2024 Francesco Palazzo
+
+from collections import OrderedDict
+from typing import Callable, Optional
+
+from PySide6.QtWidgets import QComboBox, QHBoxLayout, QHeaderView, QLineEdit, \
+    QTableView, QVBoxLayout, QWidget, QAbstractItemView
+from PySide6.QtGui import QColor, QFont, QRegularExpressionValidator
+from PySide6.QtCore import QAbstractTableModel, QModelIndex, \
+    QRegularExpression, Qt
+
+import m68k
+
+PAGE_SIZE = 0x1000
+CACHE_PAGES = 32
+ROW_BYTES = 16
+
+WIDTHS = {"Byte": 1, "Word": 2, "Long": 4}
+
+PC_COLOR = QColor("#70fffd8d")
+SP_COLOR = QColor("#7000ff00")
+
+
+class PageCache:
+    def __init__(self, read: Callable[[int, int], bytes],
+                 page_size: int = PAGE_SIZE, max_pages: int = CACHE_PAGES):
+        """Pages of memory read on demand, the least recently used page is
+        dropped when more than max_pages are cached"""
+        self.read = read
+        self.page_size = page_size
+        self.max_pages = max_pages
+        self.pages: OrderedDict[int, Optional[bytes]] = OrderedDict()
+
+    def get(self, page: int) -> Optional[bytes]:
+        """Returns the page, None if it can't be read"""
+        if page in self.pages:
+            self.pages.move_to_end(page)
+            return self.pages[page]
+        try:
+            data: Optional[bytes] = self.read(page * self.page_size, self.page_size)
+        except ValueError:
+            data = None
+        self.pages[page] = data
+        if len(self.pages) > self.max_pages:
+            self.pages.popitem(last=False)
+        return data
+
+    def invalidate(self):
+        self.pages.clear()
+
+
+class MemoryModel(QAbstractTableModel):
+    def __init__(self, cpu: m68k.m68k, size: int = m68k.RAM_SIZE, parent=None):
+        """The whole RAM as a table of ROW_BYTES per row: one column per
+        byte, word or long and a last column with the ASCII dump.
+        Only the pages of the rows the view asks for are read"""
+        super().__init__(parent)
+        self.cpu = cpu
+        self.size = size
+        self.width = 1
+        self.cache = PageCache(self.read)
+        self.pc = -1
+        self.sp = -1
+
+    def read(self, start: int, bytelen: int) -> bytes:
+        if not self.cpu.get_power_status():
+            raise ValueError("memory is off")
+        return self.cpu.get_mem(start, bytelen)
+
+    def rowCount(self, parent=QModelIndex()) -> int:
+        return 0 if parent.isValid() else self.size // ROW_BYTES
+
+    def columnCount(self, parent=QModelIndex()) -> int:
+        return 0 if parent.isValid() else ROW_BYTES // self.width + 1
+
+    def set_width(self, width: int):
+        self.beginResetModel()
+        self.width = width
+        self.endResetModel()
+
+    def row_bytes(self, row: int) -> Optional[bytes]:
+        addr = row * ROW_BYTES
+        page = self.cache.get(addr // PAGE_SIZE)
+        if page is None:
+            return None
+        offset = addr % PAGE_SIZE
+        return page[offset:offset + ROW_BYTES]
+
+    def cell_address(self, index: QModelIndex) -> int:
+        return index.row() * ROW_BYTES + index.column() * self.width
+
+    def index_of(self, addr: int) -> QModelIndex:
+        return self.index(addr // ROW_BYTES, addr % ROW_BYTES // self.width)
+
+    def data(self, index: QModelIndex, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        ascii_column = index.column() == ROW_BYTES // self.width
+        if role == Qt.DisplayRole:
+            data = self.row_bytes(index.row())
+            if ascii_column:
+                if data is None:
+                    return "." * ROW_BYTES
+                return "".join(chr(b) if 0x20 <= b < 0x7F else "." for b in data)
+            if data is None:
+                return "--" * self.width
+            start = index.column() * self.width
+            return data[start:start + self.width].hex().upper()
+        if role == Qt.BackgroundRole and not ascii_column:
+            addr = self.cell_address(index)
+            if addr <= self.pc < addr + self.width:
+                return PC_COLOR
+            if addr <= self.sp < addr + self.width:
+                return SP_COLOR
+        if role == Qt.TextAlignmentRole:
+            return int(Qt.AlignLeft | Qt.AlignVCenter) if ascii_column \
+                else int(Qt.AlignCenter)
+        return None
+
+    def headerData(self, section: int, orientation, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole:
+            return None
+        if orientation == Qt.Vertical:
+            return f"{section * ROW_BYTES:08X}"
+        if section == ROW_BYTES // self.width:
+            return "ASCII"
+        return f"{section * self.width:X}"
+
+    def refresh(self, pc: int, sp: int):
+        """Drops the cached pages, the view reads the visible ones again"""
+        self.cache.invalidate()
+        self.pc = pc
+        self.sp = sp
+        if self.rowCount():
+            self.dataChanged.emit(self.index(0, 0),
+                                  self.index(self.rowCount() - 1, self.columnCount() - 1))
+
+
+class MemoryBrowser(QWidget):
+    def __init__(self, cpu: m68k.m68k, parent=None):
+        super().__init__(parent)
+        self.cpu = cpu
+        self.model = MemoryModel(cpu, parent=self)
+
+        self.seekline = QLineEdit()
+        self.seekline.setFont(QFont("MonoLisa"))
+        self.seekline.setMaxLength(8)
+        address_regexp = QRegularExpression("^[0-9a-fA-F]{1,8}$")
+        self.seekline.setValidator(QRegularExpressionValidator(address_regexp, self.seekline))
+        self.seekline.setPlaceholderText("Jump to address in hex")
+        self.seekline.returnPressed.connect(
+                lambda: self.jump(int(self.seekline.text() or "0", 16)))
+        self.width_select = QComboBox()
+        self.width_select.addItems(list(WIDTHS))
+        self.width_select.currentTextChanged.connect(
+                lambda text: self.model.set_width(WIDTHS[text]))
+
+        self.table = QTableView()
+        self.table.setModel(self.model)
+        self.table.setFont(QFont("MonoLisa"))
+        self.table.setSelectionMode(QAbstractItemView.SingleSelection)
+        # fixed sizes, so the view never measures rows that are not visible
+        vheader = self.table.verticalHeader()
+        vheader.setSectionResizeMode(QHeaderView.Fixed)
+        vheader.setDefaultSectionSize(self.table.fontMetrics().height() + 4)
+        self.table.horizontalHeader().setStretchLastSection(True)
+        self.model.modelReset.connect(self.table.resizeColumnsToContents)
+        self.table.resizeColumnsToContents()
+
+        seek = QHBoxLayout()
+        seek.addWidget(self.seekline)
+        seek.addWidget(self.width_select)
+        layout = QVBoxLayout()
+        layout.addLayout(seek)
+        layout.addWidget(self.table)
+        self.setLayout(layout)
+
+    def jump(self, addr: int):
+        if not 0 <= addr < self.model.size:
+            return
+        index = self.model.index_of(addr)
+        self.table.scrollTo(index, QAbstractItemView.PositionAtTop)
+        self.table.setCurrentIndex(index)
+
+    def update_view(self, regs: Optional[dict] = None):
+        if not self.isVisible():
+            return
+        if regs is None:
+            regs = self.cpu.get_state()
+        self.model.refresh(regs["pc"], regs["a7"])
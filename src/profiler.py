@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+# ASIM Reborn - Simple multiplatform 68k IDE
+# Copyright (C) 2024 Francesco Palazzo
+
+import bisect
+import csv
+from typing import Dict, List, Tuple
+
+# opcodes that change the call stack
+JSR_MASK, JSR = 0xFFC0, 0x4E80
+BSR_MASK, BSR = 0xFF00, 0x6100
+RETURNS = (0x4E75, 0x4E77) # rts, rtr
+
+
+class Profile:
+    def __init__(self):
+        """Exact counts of a profiled run: executions and cycles of every
+        instruction address, and cycles per call stack. The stack is the
+        list of routine entry addresses entered with JSR/BSR and left with
+        RTS/RTR"""
+        self.hits: Dict[int, int] = {}
+        self.cycles: Dict[int, int] = {}
+        self.stack: List[int] = []
+        self.stack_key: Tuple[int, ...] = ()
+        self.stack_cycles: Dict[Tuple[int, ...], int] = {}
+        self.total_cycles = 0
+        self.instructions = 0
+
+    def record(self, pc: int, opcode: int, cycles: int, next_pc: int):
+        """Called after every instruction, with the opcode it had"""
+        self.hits[pc] = self.hits.get(pc, 0) + 1
+        self.cycles[pc] = self.cycles.get(pc, 0) + cycles
+        key = self.stack_key
+        self.stack_cycles[key] = self.stack_cycles.get(key, 0) + cycles
+        self.total_cycles += cycles
+        self.instructions += 1
+        if opcode & JSR_MASK == JSR or opcode & BSR_MASK == BSR:
+            self.stack.append(next_pc)
+            self.stack_key = tuple(self.stack)
+        elif opcode in RETURNS and self.stack:
+            self.stack.pop()
+            self.stack_key = tuple(self.stack)
+
+    def by_line(self, lst: Dict[int, int]) -> Dict[int, Tuple[int, int]]:
+        """(hits, cycles) per source line, lst maps address -> line"""
+        lines: Dict[int, Tuple[int, int]] = {}
+        for pc, cycles in self.cycles.items():
+            line = lst.get(pc)
+            if line is None:
+                continue
+            hits, total = lines.get(line, (0, 0))
+            lines[line] = (hits + self.hits[pc], total + cycles)
+        return lines
+
+    def by_label(self, symbols: Dict[str, int]) -> Dict[str, Tuple[int, int]]:
+        """(hits, cycles) per routine, the closest label before each address"""
+        labels = Labels(symbols)
+        routines: Dict[str, Tuple[int, int]] = {}
+        for pc, cycles in self.cycles.items():
+            name = labels.containing(pc)
+            hits, total = routines.get(name, (0, 0))
+            routines[name] = (hits + self.hits[pc], total + cycles)
+        return routines
+
+    def report(self, symbols: Dict[str, int], top: int = 20) -> str:
+        lines = [f"{self.instructions} instructions, {self.total_cycles} cycles"]
+        routines = sorted(self.by_label(symbols).items(),
+                          key=lambda item: item[1][1], reverse=True)
+        for name, (hits, cycles) in routines[:top]:
+            share = cycles * 100 / max(self.total_cycles, 1)
+            lines.append(f"{share:6.2f}% {cycles:>10} cycles {hits:>9} instr  {name}")
+        return "\n".join(lines)
+
+    def export_csv(self, path: str, lst: Dict[int, int], symbols: Dict[str, int]):
+        labels = Labels(symbols)
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["address", "line", "label", "hits", "cycles", "percent"])
+            for pc in sorted(self.cycles):
+                writer.writerow([f"{pc:08X}", lst.get(pc, ""), labels.containing(pc),
+                                 self.hits[pc], self.cycles[pc],
+                                 f"{self.cycles[pc] * 100 / max(self.total_cycles, 1):.3f}"])
+
+    def export_collapsed(self, path: str, symbols: Dict[str, int], root: str = "main"):
+        """One "root;caller;callee cycles" line per stack, the input of
+        flamegraph.pl and speedscope"""
+        labels = Labels(symbols)
+        with open(path, "w") as f:
+            for key, cycles in sorted(self.stack_cycles.items()):
+                frames = [root] + [labels.at(addr) for addr in key]
+                f.write(f"{';'.join(frames)} {cycles}\n")
+
+
+class Labels:
+    def __init__(self, symbols: Dict[str, int]):
+        """Symbol table of the listing, name -> address"""
+        pairs = sorted((addr, name) for name, addr in symbols.items())
+        self.addrs = [addr for addr, _ in pairs]
+        self.names = [name for _, name in pairs]
+        self.by_addr = {addr: name for addr, name in reversed(pairs)}
+
+    def at(self, addr: int) -> str:
+        return self.by_addr.get(addr, f"0x{addr:08X}")
+
+    def containing(self, addr: int) -> str:
+        i = bisect.bisect_right(self.addrs, addr) - 1
+        return self.names[i] if i >= 0 else f"0x{addr:08X}"
+
+
+def heat(lines: Dict[int, Tuple[int, int]]) -> Dict[int, float]:
+    """Cycles of each line relative to the hottest one, 0 to 1"""
+    hottest = max((cycles for _, cycles in lines.values()), default=0)
+    if not hottest:
+        return {}
+    return {line: cycles / hottest for line, (_, cycles) in lines.items()}
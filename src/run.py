@@ -3,15 +3,15 @@
 # ASIM Reborn - Simple multiplatform 68k IDE
 # Copyright (C) 2024 Francesco Palazzo
 
-import sys, threading, time
-from typing import Optional, Union, Callable, List
+import sys, time
+from typing import Optional, Union, Callable, Dict, List, Tuple
 import PySide6
 
 from PySide6.QtWidgets import QApplication, QComboBox, QGridLayout, QHBoxLayout, QLabel, QLineEdit, QMainWindow, QPushButton, QPlainTextEdit, QFileDialog, QSizePolicy, QVBoxLayout, QWidget, QScrollArea
-from PySide6.QtGui import QFont, QFontMetrics, QRegularExpressionValidator, QTextCursor, QAction, QTextOption, QValidator
-from PySide6.QtCore import QRegularExpression, Qt
+from PySide6.QtGui import QGuiApplication, QFont, QFontMetrics, QRegularExpressionValidator, QTextCursor, QAction, QTextOption, QValidator
+from PySide6.QtCore import QRegularExpression, Qt, QTimer, Signal
 
-import m68k
+import m68k, memview, watch, watchpoints, disassemblyview
 
 admitted_modes = [
             "Unsigned byte",
@@ -26,11 +26,82 @@ admitted_modes = [
             "ASCII char",
             "Null termined string"]
 
+watchpoint_modes = {
+            "Write": watchpoints.WRITE,
+            "Change": watchpoints.CHANGE,
+            "Read": watchpoints.READ,
+            "Access": watchpoints.READ | watchpoints.WRITE}
+
+# repaint interval when the screen doesn't tell its refresh rate
+FRAME_MS = 16
+
+class MemRows:
+    def __init__(self, step: int = 4):
+        """HTML rows of the memory view. Keeps the window shown last time
+        and re-renders only the rows whose bytes or SP/FP/PC highlighting
+        changed, the rest of the text is reused as is"""
+        self.step = step
+        self.start = -1
+        self.mem = b""
+        self.marks: List[Tuple] = []
+        self.rows: List[str] = []
+
+    def row_marks(self, addr: int, sp: int, fp: int, pc: int, i_len: int) -> Tuple:
+        """What is highlighted in the row starting at addr"""
+        end = addr + self.step
+        return (sp - addr if addr <= sp < end else None,
+                fp - addr if addr <= fp < end else None,
+                (max(pc, addr) - addr, min(pc + i_len, end - 1) - addr)
+                if pc < end and addr <= pc + i_len else None)
+
+    def render(self, addr: int, mem: bytes, marks: Tuple) -> str:
+        sp, fp, pc = marks
+        cells = [f"0x{addr:08X}"]
+        for i in range(len(mem)):
+            byte = f"{mem[i]:02x}"
+            if i == sp:
+                cells.append(f'<b style="background-color: #7000ff00">{byte}</b>')
+            elif i == fp:
+                cells.append(f'<b style="background-color: #70ff0000">{byte}</b>')
+            elif pc is not None and pc[0] <= i <= pc[1]:
+                cells.append(f'<b style="background-color: #70fffd8d">{byte}</b>')
+            else:
+                cells.append(byte)
+        return " ".join(cells)
+
+    def update(self, start: int, mem: bytes, sp: int, fp: int,
+               pc: int, i_len: int) -> bool:
+        """Returns False if the view is unchanged"""
+        step = self.step
+        count = (len(mem) + step - 1) // step
+        moved = start != self.start or count != len(self.rows)
+        if moved:
+            self.rows = [""] * count
+            self.marks = [None] * count
+        changed = moved
+        for row in range(count):
+            i = row * step
+            addr = start + i
+            marks = self.row_marks(addr, sp, fp, pc, i_len)
+            if not moved and marks == self.marks[row] \
+                    and mem[i:i+step] == self.mem[i:i+step]:
+                continue
+            self.rows[row] = self.render(addr, mem[i:i+step], marks)
+            self.marks[row] = marks
+            changed = True
+        self.start = start
+        self.mem = mem
+        return changed
+
+    def text(self) -> str:
+        return "<br>".join(self.rows)
+
 class Variable(QWidget):
     def __init__(self, addr: int, name: str = ""):
         super().__init__()
         self.addr = addr
         self.name = name
+        self.watch: Optional[watch.Watch] = None
         addr_label = QLabel(f"{self.name} 0x{addr:08X}")
         self.val_label = QLabel("0")
         self.mode_select = QComboBox()
@@ -52,18 +123,42 @@ class Variable(QWidget):
 
 
 class Runner(QWidget):
+    # state change of main_cpu, emitted from any thread, see on_cpu_change
+    state_changed = Signal(str)
+    # after the UI was repainted, at most once per frame
+    updated = Signal()
 
-
-    def __init__(self):
+    def __init__(self, history_steps: int = 100000,
+                 history_size: int = 16 * 1024 * 1024):
         super().__init__()
         self.main_cpu = m68k.m68k()
+        self.main_cpu.enable_history(history_steps, history_size)
+        # repaints are coalesced: at most one state_changed queued at a
+        # time and one repaint per frame
+        self.change_queued = False
+        self.last_change = m68k.STEPPED
+        self.last_paint = 0.0
+        screen = QGuiApplication.primaryScreen()
+        rate = screen.refreshRate() if screen is not None else 0
+        self.frame_ms = int(1000 / rate) if rate > 0 else FRAME_MS
+        self.frame_timer = QTimer(self)
+        self.frame_timer.setSingleShot(True)
+        self.frame_timer.timeout.connect(self.paint)
+        self.state_changed.connect(self.on_state_changed)
+        self.main_cpu.on_change = self.on_cpu_change
         self.dregs: List[QLabel] = [QLabel(f"0x{0:08X}") for _ in range(8)]
         self.aregs: List[QLabel] = [QLabel(f"0x{0:08X}") for _ in range(8)]
         self.sreg = QLabel(f"{0:016b}")
         self.pc = QLabel(f"{0:08X}")
+        self.speed = QLabel("")
         self.sreg.setFont(QFont("MonoLisa"))
         self.pc.setFont(QFont("MonoLisa"))
         self.watched_vars: list[Variable]  = []
+        self.watches = watch.WatchEngine(self.main_cpu.get_mem, m68k.RAM_SIZE)
+        self.var_of: Dict[watch.Watch, Variable] = {}
+        self.memrows = MemRows()
+        self.membrowser = memview.MemoryBrowser(self.main_cpu)
+        self.disasmview = disassemblyview.DisassemblyView(self.main_cpu)
 
         self.init_ui()
 
@@ -87,6 +182,7 @@ class Runner(QWidget):
         reglayout.addWidget(self.sreg)
         reglayout.addWidget(QLabel("PC"))
         reglayout.addWidget(self.pc)
+        reglayout.addWidget(self.speed, 9, 0, 1, -1)
         self.frame.addLayout(reglayout, 3, 0, 1, -1)
 
 
@@ -140,16 +236,50 @@ class Runner(QWidget):
         self.frame.addWidget(self.watchvaraddr, 1, 1, 1, 1)
         self.frame.addLayout(watchvarbtns, 2, 1, 1, 1)
 
+        # data watchpoints
+        wpline = QHBoxLayout()
+        self.wpaddr = QLineEdit()
+        self.wpaddr.setFont(QFont("MonoLisa"))
+        wp_regexp = QRegularExpression("^[0-9a-fA-F]{1,8}(:[0-9a-fA-F]{0,3})?$")
+        self.wpaddr.setValidator(QRegularExpressionValidator(wp_regexp, self.wpaddr))
+        self.wpaddr.setPlaceholderText("Watchpoint address[:length] in hex")
+        self.wpaddr.setToolTip(f"Up to {watchpoints.MAX_LENGTH} bytes. Every watched "
+                               "byte is checked on each memory access and slows the run down")
+        self.wpmode = QComboBox()
+        self.wpmode.addItems(list(watchpoint_modes))
+        wp_add_btn = QPushButton('Break on', self)
+        wp_add_btn.clicked.connect(lambda: self.add_watchpoint())
+        wp_clr_btn = QPushButton('Clear', self)
+        wp_clr_btn.clicked.connect(self.clr_watchpoints)
+        wpline.addWidget(self.wpaddr)
+        wpline.addWidget(self.wpmode)
+        wpline.addWidget(wp_add_btn)
+        wpline.addWidget(wp_clr_btn)
+        self.wplabel = QLabel("")
+        self.wplabel.setFont(QFont("MonoLisa"))
+        self.wplabel.setWordWrap(True)
+        self.frame.addLayout(wpline, 5, 0, 1, -1)
+        self.frame.addWidget(self.wplabel, 6, 0, 1, -1)
+
         # step and stop btns
         buttons = QHBoxLayout()
         run_btn = QPushButton('Run', self)
         run_btn.clicked.connect(self.run)
         step_btn = QPushButton('Step', self)
         step_btn.clicked.connect(self.step)
+        back_btn = QPushButton('Step back', self)
+        back_btn.clicked.connect(lambda: self.step_back())
+        pause_btn = QPushButton('Pause', self)
+        pause_btn.clicked.connect(self.pause)
+        restart_btn = QPushButton('Restart', self)
+        restart_btn.clicked.connect(self.restart)
         self.poweroff_btn = QPushButton('Stop', self)
         self.poweroff_btn.clicked.connect(self.poweroff)
+        buttons.addWidget(back_btn)
         buttons.addWidget(step_btn)
         buttons.addWidget(run_btn)
+        buttons.addWidget(pause_btn)
+        buttons.addWidget(restart_btn)
         buttons.addWidget(self.poweroff_btn)
         self.frame.addLayout(buttons, 4, 0, 1, -1)
 
@@ -158,6 +288,8 @@ class Runner(QWidget):
         self.frame.setRowStretch(2, 0)
         self.frame.setRowStretch(3, 0)
         self.frame.setRowStretch(4, 0)
+        self.frame.setRowStretch(5, 0)
+        self.frame.setRowStretch(6, 0)
 
 
         self.setLayout(self.frame)
@@ -166,11 +298,35 @@ class Runner(QWidget):
 
     def load_file(self, fname: str):
         self.main_cpu.load_file(fname)
+
+    def on_cpu_change(self, kind: str):
+        """Called by main_cpu on the thread that changed it"""
+        self.last_change = kind
+        if not self.change_queued:
+            self.change_queued = True
+            self.state_changed.emit(kind)
+
+    def on_state_changed(self, kind: str):
+        self.change_queued = False
+        if self.frame_timer.isActive():
+            return
+        wait = self.last_paint + self.frame_ms / 1000 - time.perf_counter()
+        self.frame_timer.start(max(int(wait * 1000), 0))
+
+    def paint(self):
+        self.last_paint = time.perf_counter()
         self.update_ui()
+        self.updated.emit()
 
     def update_ui(self):
+        # the code may have changed while running
+        self.main_cpu.disassembly.validate()
         self.update_regs()
         self.update_memview()
+        self.update_vars()
+        self.update_points()
+        self.membrowser.update_view()
+        self.disasmview.update_view()
 
     def resizeEvent(self, event):
         #print("Resize event")
@@ -178,118 +334,55 @@ class Runner(QWidget):
         self.update_memview()
 
     def update_regs(self):
-        regs = self.main_cpu.get_regs()
-        pc = self.main_cpu.cpu.r_pc()
+        regs = self.main_cpu.get_state()
+        pc = regs["pc"]
         for i in range(8):
             self.dregs[i].setText(f"0x{regs[f'd{i}']:08X}")
             self.aregs[i].setText(f"0x{regs[f'a{i}']:08X}")
-        self.sreg.setText(f"{self.main_cpu.format_sreg(self.main_cpu.cpu.r_sr())}")
+        self.sreg.setText(f"{self.main_cpu.format_sreg(regs['sr'])}")
         self.pc.setText(f"0x{pc:08X}")
+        stats = self.main_cpu.run_stats
+        if stats.instructions:
+            self.speed.setText(f"{'~' if stats.estimated else ''}{stats.ips()/1e6:.2f} MIPS")
 
 
-    def get_memory_string(self, curr_addr: int, curr_mem: str,
-                          sp: int, fp: int, pc: int, i_len: int) -> str:
-        # print(curr_addr, curr_mem, sp, fp)
-        mem_str = f"0x{curr_addr:08X} "
-        for i in range(0, len(curr_mem), 2):
-            if i//2 == sp-curr_addr:
-                mem_str += f'<b style="background-color: #7000ff00">{curr_mem[i:i+2]}</b> '
-            elif i//2 == fp-curr_addr:
-                mem_str += f'<b style="background-color: #70ff0000">{curr_mem[i:i+2]}</b> '
-            elif pc <= i//2+curr_addr <= pc+i_len:
-                mem_str += f'<b style="background-color: #70fffd8d">{curr_mem[i:i+2]}</b> '
-            else:
-                mem_str += curr_mem[i:i+2] + " "
-        return mem_str.strip()
-
     def update_memview(self):
-        pc = self.main_cpu.cpu.r_pc()
+        regs = self.main_cpu.get_state()
+        current_pc = regs["pc"]
+        pc = current_pc
         if self.seekline.text() != "":
             pc = int(self.seekline.text(), 16)
-        self.memview.clear()
-        #self.memview.adjustSize()
-        #print("Triggering")
-        # text_height = self.memview.sizeHint().height()
-        # frame_height = self.frame.contentsRect().height()
-        # available_height = frame_height//2
-        # lines = available_height//text_height
-        # print(self.frame.contentsMargins().top(), self.frame.contentsMargins().bottom())
-        # print(self.frame.contentsRect().height(), text_height, available_height, lines)
         line_height = QFontMetrics(self.memview.font()).lineSpacing()
         height = int(self.memview.size().height() * .75) #self.size().height()//2
         lines = height//line_height
         lines -= lines%2
-        #print(height,lines)
-        #print(self.frame.contentsRect().height())
-        #print(line_height, label_height, lines)
         diameter = lines*4
         start = max(pc-diameter//2,0)
-        mem = self.main_cpu.get_mem(start, diameter)
-        # print(mem.hex())
-        curr_instr = self.main_cpu.get_current_line()
-        instr_len = len(curr_instr[1]) * 2
-        current_pc = self.main_cpu.cpu.r_pc()
-        # print(curr_instr)
-        # print(f"{curr_instr[0]:08X}: {[hex(i) for i in curr_instr[1]]}")
-
-        step = 4
-        for i in range(0, len(mem), step):
-            current_addr = i+start
-            current_mem = mem[i:i+step].hex()
-            stack_pointer = self.main_cpu.cpu.r_ax(7)
-            frame_pointer = self.main_cpu.cpu.r_ax(6)
-            #self.memview.insertPlainText(f"0x{i+start:08X} {mem[i:i+step].hex()}\n")
-            self.memview.setText("<br>".join([
-                self.memview.text(),
-                self.get_memory_string(current_addr,
-                    current_mem, stack_pointer,
-                    frame_pointer, current_pc, instr_len)
-            ]))
-        for var in self.watched_vars:
-            self.update_var(var)
-
-    def update_var(self, var: Variable) -> bool:
-        val = ""
-        addr = var.addr
-        mode = var.get_mode()
         try:
-            if mode.endswith("byte"):
-                val = int.from_bytes(
-                        self.main_cpu.get_mem(addr, 1),
-                        byteorder='big',
-                        signed=mode.startswith("s"))
-                val = f"{val:02X}" if mode.startswith("h") else str(val)
-            elif mode.endswith("char"):
-                val = self.main_cpu.get_mem(addr, 1).decode('ascii')
-            elif mode.endswith("word"):
-                val = int.from_bytes(
-                        self.main_cpu.get_mem(addr, 2),
-                        byteorder='big',
-                        signed=mode.startswith("s"))
-                val = f"{val:04X}" if mode.startswith("h") else str(val)
-            elif mode.endswith("long"):
-                val = int.from_bytes(
-                        self.main_cpu.get_mem(addr, 4),
-                        byteorder='big',
-                        signed=mode.startswith("S"))
-                val = f"{val:08X}" if mode.startswith("h") else str(val)
-            elif mode.endswith("string"):
-                val = b''
-                offset = 0
-                while True:
-                    c = self.main_cpu.get_mem(addr+offset, 1)
-                    if c == b'\x00':
-                        break
-                    val += c
-                    offset += 1
-                val = val.decode('ascii')
+            mem = self.main_cpu.get_mem(start, diameter)
         except ValueError:
-            val = "ERROR: Invalid address"
-
-        if val != "":
-            var.update_val(val)
-            return True
-        return False
+            mem = b""
+        if self.memrows.update(start, mem, regs["a7"], regs["a6"],
+                               current_pc, self.get_instr_len(current_pc)):
+            self.memview.setText(self.memrows.text())
+
+    def get_instr_len(self, pc: int) -> int:
+        """Length in bytes of the instruction at pc, from the disassembly
+        cache"""
+        if not self.main_cpu.get_power_status():
+            return 0
+        return len(self.main_cpu.get_current_line(pc)[1]) * 2
+
+    def update_vars(self):
+        """Reads all the watches at once and updates only the labels of the
+        values that changed"""
+        for changed in self.watches.poll():
+            self.var_of[changed].update_val(changed.value)
+
+    def update_var(self, var: Variable):
+        self.watches.set_mode(var.watch, var.get_mode())
+        self.watches.refresh(var.watch)
+        var.update_val(var.watch.value)
 
 
     def add_var(self, addr: Optional[int] = None, name: str = ""):
@@ -299,14 +392,19 @@ class Runner(QWidget):
             name = f"userdef_{len(self.watched_vars)}"
         # print(f"Adding var {addr:08X}")
         var = Variable(addr, name)
+        var.watch = self.watches.add(addr, var.get_mode())
+        self.var_of[var.watch] = var
         self.watched_vars.append(var)
         var.mode_select.currentIndexChanged.connect(lambda: self.update_var(var))
         var.del_btn.clicked.connect(lambda: self.del_var(var))
         self.watchvaraddr.clear()
         self.varwatch.addWidget(var)
+        self.update_var(var)
 
     def del_var(self, var: Variable):
         self.watched_vars.remove(var)
+        self.watches.remove(var.watch)
+        del self.var_of[var.watch]
         var.deleteLater()
         self.update_memview()
 
@@ -315,27 +413,78 @@ class Runner(QWidget):
             self.varwatch.removeWidget(var)
             var.deleteLater()
         self.watched_vars.clear()
+        self.watches.clear()
+        self.var_of.clear()
         self.update_memview()
 
+    def add_watchpoint(self, addr: Optional[int] = None, length: int = 1,
+                       mode: Optional[int] = None):
+        if addr is None:
+            text = self.wpaddr.text()
+            if text == "":
+                return
+            addr_text, _, length_text = text.partition(":")
+            addr = int(addr_text, 16)
+            length = int(length_text or "1", 16)
+        if mode is None:
+            mode = watchpoint_modes[self.wpmode.currentText()]
+        try:
+            self.main_cpu.add_watchpoint(addr, length, mode)
+        except (ValueError, RuntimeError) as e:
+            self.wplabel.setText(str(e))
+            return
+        self.wpaddr.clear()
+        self.update_points()
+
+    def clr_watchpoints(self):
+        try:
+            self.main_cpu.clear_watchpoints()
+        except RuntimeError as e:
+            self.wplabel.setText(str(e))
+            return
+        self.update_points()
+
+    def update_points(self):
+        """Lists the watchpoints and what stopped the last run"""
+        wps = self.main_cpu.watchpoints
+        bps = self.main_cpu.breakpoints
+        lines = [f"{'>' if point is wps.hit else ' '} {point} ({point.hits} hits)"
+                 for point in wps.points]
+        lines += [f"{'>' if point is bps.hit else ' '} break at {point} ({point.hits} hits)"
+                  + (f" error: {point.error}" if point.error else "")
+                  for point in bps.points]
+        if wps.points:
+            lines.append(f"{wps.native} watched addresses, checked on every "
+                         "memory access: runs are slower")
+        if wps.hit is not None:
+            lines.append(f"Stopped by {wps.hit} at 0x{wps.hit_pc:08X}")
+        elif bps.hit is not None:
+            lines.append(f"Stopped at breakpoint {bps.hit}")
+        self.wplabel.setText("<br>".join(lines))
+
     def step(self):
         self.main_cpu.step()
-        self.update_ui()
 
-    def step_thread(self):
-        self.thread_active = True
-        while self.thread_active == True and self.main_cpu.step():
-            #print("lessgo")
-            pass
-            #time.sleep(10**-12)
+    def step_back(self, n: int = 1):
+        self.main_cpu.step_back(n)
 
     def run(self):
-        self.thread_active = False
-        try:
-            self.t.join()
-        except AttributeError:
-            pass
-        self.t = threading.Thread(target=self.step_thread)
-        self.t.start()
+        self.main_cpu.profiling = False
+        self.main_cpu.run()
+
+    def run_profiled(self):
+        """Runs counting every instruction, from a fresh profile unless
+        resuming a paused profiled run"""
+        if not (self.main_cpu.profiling and self.main_cpu.is_paused()):
+            self.main_cpu.profile = None
+        self.main_cpu.profiling = True
+        self.main_cpu.run()
+
+    def pause(self):
+        self.main_cpu.pause()
+
+    def restart(self):
+        self.main_cpu.restart()
 
     def debug_registers(self):
         while True:
@@ -3,8 +3,10 @@
 # ASIM Reborn - Simple multiplatform 68k IDE
 # Copyright (C) 2024 Francesco Palazzo
 
-from typing import Optional
+import threading
+from typing import Optional, Tuple
 
+import numpy as np
 from PySide6.QtCore import Qt, QSize, QTimer
 from PySide6.QtGui import QImage, qRgb, QPixmap, QPainter, QResizeEvent
 from PySide6.QtWidgets import QWidget, QVBoxLayout, QPushButton, QLabel, QSizePolicy
@@ -19,6 +21,10 @@ STATUS_OFFSET       = 0x020400
 
 ACK_MASK            = 0b10000000
 FILL_SCREEN_MASK    = 0b01000000
+FRAME_MASK          = 0b00100000
+
+# vblank timing is derived from emulated cycles of an 8 MHz 68000
+CPU_CLOCK_HZ        = 8000000
 
 class Screen(QWidget):
     def __init__(self, cpu: m68k.m68k, addr: int = DEFAULT_ADDRESS, frameswap: bool = False,
@@ -26,7 +32,11 @@ class Screen(QWidget):
         """Emulated screen with WxH pixels and a 16-bit color depth
         memory: addr + sr + w * h - 1
         pixel: 0baarrggbb where a is typically set to 1
-        sr: 0bssrrggbb where s is ab (ack, black screen)"""
+        sr: 0bssrrggbb where s is ab (ack, black screen)
+        frameswap: the program draws in the frame that is not displayed
+        (addr or addr + SECOND_FRAME_OFFSET) and sets ack when done. On the
+        next vblank the screen flips to it, clears ack, reports the
+        displayed frame in FRAME_MASK and raises the vblank IRQ"""
 
         super().__init__(parent)
         frame = QVBoxLayout()
@@ -38,7 +48,24 @@ class Screen(QWidget):
         self.scr_height: int = height
         self.refr_rate = refr_rate
         self.resize(self.scr_width, self.scr_height)
-        self.framebuffer = QImage(self.scr_width, self.scr_height, QImage.Format_RGB32)
+        # the QImage wraps this buffer, so frames are converted in place
+        self.pixels = np.zeros((self.scr_height, self.scr_width), dtype=np.uint32)
+        self.framebuffer = QImage(self.pixels.data, self.scr_width, self.scr_height,
+                                  self.scr_width * 4, QImage.Format_RGB32)
+        # what was converted last time, to repaint only the dirty scanlines
+        self.last_indices: Optional[np.ndarray] = None
+        self.last_palette: Optional[bytes] = None
+        self.lut = np.zeros(256, dtype=np.uint32)
+        self.showing = None
+        # frameswap: vblank runs on the CPU thread, conversion on the render
+        # thread, the GUI thread only uploads the finished image
+        self.front = 0
+        self.vblank_timer: Optional[m68k.CycleTimer] = None
+        self.render_thread: Optional[threading.Thread] = None
+        self.render_cond = threading.Condition()
+        self.next_frame: Optional[Tuple[bytes, bytes]] = None
+        self.rendered: Optional[QImage] = None
+        self.rendering = False
         self.canvas = QLabel(self)
         self.canvas.setAlignment(Qt.AlignCenter)
         self.canvas.setSizePolicy(QSizePolicy.MinimumExpanding, QSizePolicy.MinimumExpanding)
@@ -60,16 +87,38 @@ class Screen(QWidget):
 
     def fill_screen(self, color: int):
         """Fills the screen with a color"""
-        for y in range(self.scr_height):
-            for x in range(self.scr_width):
-                self.framebuffer.setPixel(x, y, color)
+        self.pixels.fill(color)
+        self.last_indices = None
+        self.showing = None
+
+    def read_palette(self, palette: bytes) -> np.ndarray:
+        """Converts the 256 RGB palette entries to a lookup table of RGB32
+        pixels"""
+        rgb = np.frombuffer(palette, dtype=np.uint8).reshape(256, 3).astype(np.uint32)
+        return 0xFF000000 | (rgb[:, 0] << 16) | (rgb[:, 1] << 8) | rgb[:, 2]
 
-    def read_framebuffer(self):
-        """Each pixel is 1 byte in argb format"""
-        for y in range(self.scr_height):
-            for x in range(self.scr_width):
-                color = self.get_color(self.cpu.get_mem(self.addr + x + y * self.scr_width, 1)[0])
-                self.framebuffer.setPixel(x, y, color)
+    def read_framebuffer(self) -> bool:
+        """Each pixel is 1 byte, an index in the palette.
+        Only the scanlines written since the last frame are converted,
+        unless the palette changed. Returns False if nothing changed"""
+        palette = self.cpu.get_mem(self.addr + PALETTE_OFFSET, 256 * 3)
+        frame = self.cpu.get_mem(self.addr, self.scr_width * self.scr_height)
+        return self.convert_frame(frame, palette)
+
+    def convert_frame(self, frame: bytes, palette: bytes) -> bool:
+        indices = np.frombuffer(frame, dtype=np.uint8).reshape(self.scr_height, self.scr_width)
+        if self.last_indices is None or palette != self.last_palette:
+            self.lut = self.read_palette(palette)
+            np.take(self.lut, indices, out=self.pixels)
+        else:
+            dirty = np.flatnonzero((indices != self.last_indices).any(axis=1))
+            if len(dirty) == 0:
+                return False
+            self.pixels[dirty] = self.lut[indices[dirty]]
+        self.last_indices = indices
+        self.last_palette = palette
+        self.showing = "framebuffer"
+        return True
 
     def get_color(self, palette_index: int) -> int:
         """Returns the color at the palette index"""
@@ -79,29 +128,103 @@ class Screen(QWidget):
     def update_image(self):
         """Reads from self.addr WxH argb bytes and updates the image"""
         if not self.cpu.get_power_status():
+            if self.showing == "off":
+                return
             self.fill_screen(qRgb(255,255,255))
+            self.showing = "off"
             self.power_label.setHidden(False)
             self.power_label.setText("CPU and mem are off")
         else:
             fill_flag = self.get_sr()["fill"]
             if fill_flag:
                 color = self.get_color(self.cpu.get_mem(self.addr, 1)[0])
+                if self.showing == ("fill", color):
+                    return
                 self.fill_screen(color)
-            else:
-                self.read_framebuffer()
+                self.showing = ("fill", color)
+            elif not self.read_framebuffer():
+                # unchanged frame, skip the pixmap upload
+                return
         self.update_image_scaled()
 
     def update_image_scaled(self):
         # self.canvas.setPixmap(QPixmap.fromImage(self.framebuffer).scaled(self.size(), Qt.KeepAspectRatio))
         self.canvas.setPixmap(QPixmap.fromImage(self.framebuffer).scaled(self.scr_width, self.scr_height, Qt.KeepAspectRatio))
 
-    def check_ack(self):
-        """Checks if the ack bit is set and updates the image"""
-        print("Checking ack...")
-        if self.get_sr()["ack"]:
-            self.update_image()
-        if self.frameswap:
-            self.cpu.set_irq(self.irq)
+    def vblank(self):
+        """Called on the CPU thread every frame worth of emulated cycles"""
+        status = self.cpu.get_mem(self.addr + STATUS_OFFSET, 1)[0]
+        if status & ACK_MASK:
+            self.front ^= 1
+            status &= ~(ACK_MASK | FRAME_MASK)
+            if self.front:
+                status |= FRAME_MASK
+            self.cpu.set_mem(self.addr + STATUS_OFFSET, bytes([status]))
+            self.submit_frame(status)
+        self.cpu.raise_irq(self.irq)
+
+    def submit_frame(self, status: int):
+        """Copies the displayed frame and hands it to the render thread,
+        dropping a previous frame that was not rendered yet"""
+        size = self.scr_width * self.scr_height
+        frame = self.cpu.get_mem(self.addr + self.front * SECOND_FRAME_OFFSET, size)
+        if status & FILL_SCREEN_MASK:
+            frame = frame[:1] * size
+        palette = self.cpu.get_mem(self.addr + PALETTE_OFFSET, 256 * 3)
+        with self.render_cond:
+            self.next_frame = (frame, palette)
+            self.render_cond.notify()
+
+    def render_worker(self):
+        while True:
+            with self.render_cond:
+                while self.rendering and self.next_frame is None:
+                    self.render_cond.wait()
+                if not self.rendering:
+                    return
+                frame, palette = self.next_frame
+                self.next_frame = None
+            if self.convert_frame(frame, palette):
+                image = self.framebuffer.copy()
+                with self.render_cond:
+                    self.rendered = image
+
+    def present(self):
+        """Uploads the last rendered frame, if there is a new one"""
+        with self.render_cond:
+            image = self.rendered
+            self.rendered = None
+        if image is not None:
+            self.canvas.setPixmap(QPixmap.fromImage(image).scaled(
+                self.scr_width, self.scr_height, Qt.KeepAspectRatio))
+
+    def start_frameswap(self):
+        self.front = 0
+        self.last_indices = None
+        status = self.cpu.get_mem(self.addr + STATUS_OFFSET, 1)[0]
+        status &= ~(ACK_MASK | FRAME_MASK)
+        self.cpu.set_mem(self.addr + STATUS_OFFSET, bytes([status]))
+        self.rendering = True
+        self.render_thread = threading.Thread(target=self.render_worker)
+        self.render_thread.daemon = True
+        self.render_thread.start()
+        self.submit_frame(status)
+        self.vblank_timer = self.cpu.add_cycle_timer(
+            CPU_CLOCK_HZ // self.refr_rate, self.vblank)
+        # a display that refreshes in real time needs a real time CPU
+        self.cpu.clock_hz = CPU_CLOCK_HZ
+
+    def stop_frameswap(self):
+        if self.vblank_timer is not None:
+            self.cpu.remove_cycle_timer(self.vblank_timer)
+            self.vblank_timer = None
+        self.cpu.clock_hz = None
+        with self.render_cond:
+            self.rendering = False
+            self.render_cond.notify()
+        if self.render_thread is not None:
+            self.render_thread.join()
+            self.render_thread = None
 
     def get_sr(self) -> dict:
         """Returns the status register"""
@@ -117,13 +240,15 @@ class Screen(QWidget):
         self.power_label.setHidden(self.power or self.cpu.get_power_status())
         if self.power:
             self.timer = QTimer(self)
-            if self.frameswap:
-                self.timer.timeout.connect(self.check_ack)
+            if self.frameswap and self.cpu.get_power_status():
+                self.start_frameswap()
+                self.timer.timeout.connect(self.present)
             else:
                 self.timer.timeout.connect(self.update_image)
-            self.timer.start(1/self.refr_rate*1000)
+            self.timer.start(1000 // self.refr_rate)
         else:
             self.timer.stop()
+            self.stop_frameswap()
             self.fill_screen(qRgb(0, 0, 0))
 
     def resizeEvent(self, event: QResizeEvent):
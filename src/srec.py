@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+# ASIM Reborn - Simple multiplatform 68k IDE
+# Copyright (C) 2024 Francesco Palazzo
+
+import os
+from typing import Dict, List, Optional, Tuple
+
+# address size in bytes of each record type
+DATA_RECORDS = {1: 2, 2: 3, 3: 4}
+START_RECORDS = {7: 4, 8: 3, 9: 2}
+
+
+class SrecError(ValueError):
+    pass
+
+
+class SrecImage:
+    def __init__(self, segments: List[Tuple[int, bytes]], start: Optional[int]):
+        """Parsed SREC file: contiguous data records merged in segments
+        (address, data) in file order, plus the start address if any"""
+        self.segments = segments
+        self.start = start
+
+
+def parse_srec_line(line: str) -> Optional[Tuple[int, int, bytes]]:
+    """Returns (record type, address, data) of a S1/S2/S3/S7/S8/S9 record,
+    None for other records. Raises SrecError on malformed records or
+    wrong checksums"""
+    line = line.strip()
+    if len(line) < 4 or line[0] != 'S':
+        return None
+    try:
+        record_type = int(line[1])
+    except ValueError:
+        raise SrecError("invalid record type")
+    if record_type in DATA_RECORDS:
+        addrsize = DATA_RECORDS[record_type]
+    elif record_type in START_RECORDS:
+        addrsize = START_RECORDS[record_type]
+    else:
+        return None
+    try:
+        raw = bytes.fromhex(line[2:])
+    except ValueError:
+        raise SrecError("invalid hex digits")
+    if len(raw) != raw[0] + 1 or raw[0] < addrsize + 1:
+        raise SrecError("wrong byte count")
+    if sum(raw) & 0xFF != 0xFF:
+        raise SrecError("wrong checksum")
+    address = int.from_bytes(raw[1:1+addrsize], "big")
+    return record_type, address, raw[1+addrsize:-1]
+
+
+def parse_srec(fname: str) -> SrecImage:
+    segments: List[Tuple[int, bytes]] = []
+    start: Optional[int] = None
+    seg_start = 0
+    seg = bytearray()
+    with open(fname, 'r') as f:
+        for lineno, line in enumerate(f, 1):
+            try:
+                record = parse_srec_line(line)
+            except SrecError as e:
+                raise SrecError(f"{fname}, line {lineno}: {e}")
+            if record is None:
+                continue
+            record_type, address, data = record
+            if record_type in START_RECORDS:
+                start = address
+                continue
+            if seg and address == seg_start + len(seg):
+                seg += data
+                continue
+            if seg:
+                segments.append((seg_start, bytes(seg)))
+            seg_start = address
+            seg = bytearray(data)
+    if seg:
+        segments.append((seg_start, bytes(seg)))
+    return SrecImage(segments, start)
+
+
+# path -> (mtime, size, image)
+_cache: Dict[str, Tuple[int, int, SrecImage]] = {}
+
+
+def load_srec(fname: str) -> SrecImage:
+    """Parses fname, reusing the previous result if the file did not change"""
+    path = os.path.abspath(fname)
+    st = os.stat(path)
+    cached = _cache.get(path)
+    if cached is not None and cached[:2] == (st.st_mtime_ns, st.st_size):
+        return cached[2]
+    image = parse_srec(path)
+    _cache[path] = (st.st_mtime_ns, st.st_size, image)
+    return image
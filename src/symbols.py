@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+
+# ASIM Reborn - Simple multiplatform 68k IDE
+# Copyright (C) 2024 Francesco Palazzo
+
+import os
+import os.path
+import re
+from typing import Dict, List, Optional, Set, Tuple
+
+import tokenizer
+
+# kinds of the symbols defined by a source
+LABEL = "label"
+EQUATE = "equate"
+
+# (path, line from 1, column from 0) of a definition or a use
+Location = Tuple[str, int, int]
+
+# what a line defines, uses and includes, see scan_line
+LineSymbols = Tuple[Optional[Tuple[str, int, str]], List[Tuple[str, int]], Optional[str]]
+
+# "msg.w", absolute short addressing of a symbol
+SIZE_RE = re.compile(r"^([^.].*)\.[bwlsBWLS]$")
+
+# lines scanned so far by content, as in the tokenizer
+CACHE_SIZE = 4096
+cache: Dict[str, LineSymbols] = {}
+
+
+def scan_line(text: str) -> LineSymbols:
+    """(name, column, kind) of the symbol defined by a line of source, if
+    any, the (name, column) of the symbols it uses and the file it includes.
+    Labels start at the first column or end with ":", local labels start
+    with "." and are not qualified yet"""
+    scanned = cache.get(text)
+    if scanned is not None:
+        return scanned
+    words = [(start, lexeme) for start, kind, lexeme in tokenizer.lexemes(text)
+             if kind == "word"]
+    definition = None
+    if words:
+        start, name = words[0]
+        if start == 0 or text[start + len(name):start + len(name) + 1] == ":":
+            definition = (name, start, LABEL)
+            words = words[1:]
+            rest = text[start + len(name):].lstrip(": \t")
+            if rest.startswith("="):
+                definition = (name, start, EQUATE)
+    directive = ""
+    if words and tokenizer.keyword(words[0][1]) in (tokenizer.OPCODE, tokenizer.DIRECTIVE):
+        directive = words[0][1].split(".", 1)[0].lower()
+        words = words[1:]
+    if definition is not None and directive in ("equ", "set"):
+        definition = (definition[0], definition[1], EQUATE)
+    include = None
+    if directive == "include":
+        strings = [lexeme for _, kind, lexeme in tokenizer.lexemes(text)
+                   if kind in ("string", "character")]
+        if strings:
+            include = strings[0].strip("\"'")
+        elif words:
+            include = words[0][1]
+        words = []
+    elif directive == "section":
+        words = []
+    uses = []
+    for start, name in words:
+        if tokenizer.keyword(name) is not None:
+            continue
+        match = SIZE_RE.match(name)
+        uses.append((match.group(1) if match else name, start))
+    scanned = (definition, uses, include)
+    if len(cache) >= CACHE_SIZE:
+        cache.clear()
+    cache[text] = scanned
+    return scanned
+
+
+class Symbol:
+    def __init__(self, name: str, kind: str, path: str, line: int, column: int):
+        """A label or an equate, local labels are named after the label
+        before them, "main.loop" """
+        self.name = name
+        self.kind = kind
+        self.path = path
+        self.line = line
+        self.column = column
+
+    def location(self) -> Location:
+        return (self.path, self.line, self.column)
+
+
+class FileSymbols:
+    def __init__(self, path: str, lines: List[str]):
+        """Symbols defined and used by a source, with the spans of their
+        names line by line for symbol_at"""
+        self.path = path
+        self.definitions: List[Symbol] = []
+        self.uses: Dict[str, List[Location]] = {}
+        # (line, included path as written)
+        self.includes: List[Tuple[int, str]] = []
+        # line -> [(column, end, name)]
+        self.spans: Dict[int, List[Tuple[int, int, str]]] = {}
+        scope = ""
+        for row, text in enumerate(lines, 1):
+            definition, uses, include = scan_line(text)
+            spans = []
+            if definition is not None:
+                name, column, kind = definition
+                if name.startswith("."):
+                    name = scope + name
+                elif kind == LABEL:
+                    scope = name
+                self.definitions.append(Symbol(name, kind, path, row, column))
+                spans.append((column, column + len(definition[0]), name))
+            for name, column in uses:
+                end = column + len(name)
+                if name.startswith("."):
+                    name = scope + name
+                self.uses.setdefault(name, []).append((path, row, column))
+                spans.append((column, end, name))
+            if include is not None:
+                self.includes.append((row, include))
+            if spans:
+                self.spans[row] = spans
+
+
+class SymbolIndex:
+    def __init__(self):
+        """Symbols of a source and of the files it includes, by name.
+        update() scans a file again, reusing the lines it already knows,
+        and swaps its symbols in the maps, so every lookup is a dict one.
+        Included files are read from disk and read again when they change"""
+        self.files: Dict[str, FileSymbols] = {}
+        # name -> its definitions, normally just one
+        self.definitions: Dict[str, List[Symbol]] = {}
+        # name -> path -> its uses in that file
+        self.uses: Dict[str, Dict[str, List[Location]]] = {}
+        # path -> (mtime, size) of the included files read from disk
+        self.stamps: Dict[str, Tuple[int, int]] = {}
+        # files given as text, not read from disk
+        self.edited: Set[str] = set()
+
+    def clear(self):
+        self.__init__()
+
+    def update(self, path: str, text: str):
+        """Indexes the unsaved text of path, then the files it includes"""
+        path = os.path.abspath(path)
+        self.edited.add(path)
+        self.stamps.pop(path, None)
+        self.replace(FileSymbols(path, text.split("\n")))
+        self.follow(path, set())
+
+    def replace(self, symbols: FileSymbols):
+        old = self.files.get(symbols.path)
+        if old is not None:
+            for symbol in old.definitions:
+                found = self.definitions.get(symbol.name, [])
+                found[:] = [s for s in found if s.path != old.path]
+                if not found:
+                    self.definitions.pop(symbol.name, None)
+            for name in old.uses:
+                by_path = self.uses.get(name, {})
+                by_path.pop(old.path, None)
+                if not by_path:
+                    self.uses.pop(name, None)
+        self.files[symbols.path] = symbols
+        for symbol in symbols.definitions:
+            self.definitions.setdefault(symbol.name, []).append(symbol)
+        for name, locations in symbols.uses.items():
+            self.uses.setdefault(name, {})[symbols.path] = locations
+
+    def follow(self, path: str, seen: Set[str]):
+        """Indexes the files included by path that changed on disk"""
+        seen.add(path)
+        directory = os.path.dirname(path)
+        for _, included in self.files[path].includes:
+            target = os.path.abspath(os.path.join(directory, included))
+            if target in seen:
+                continue
+            if target not in self.edited:
+                try:
+                    stat = os.stat(target)
+                except OSError:
+                    continue
+                stamp = (stat.st_mtime_ns, stat.st_size)
+                if self.stamps.get(target) != stamp or target not in self.files:
+                    try:
+                        with open(target, "r", errors="replace") as f:
+                            lines = f.read().split("\n")
+                    except OSError:
+                        continue
+                    self.stamps[target] = stamp
+                    self.replace(FileSymbols(target, lines))
+            self.follow(target, seen)
+
+    def symbol_at(self, path: str, line: int, column: int) -> Optional[str]:
+        """Name of the symbol defined or used at a place of a source"""
+        symbols = self.files.get(os.path.abspath(path))
+        if symbols is None:
+            return None
+        for start, end, name in symbols.spans.get(line, []):
+            if start <= column <= end:
+                return name
+        return None
+
+    def definition(self, name: str) -> Optional[Symbol]:
+        found = self.definitions.get(name)
+        return found[0] if found else None
+
+    def references(self, name: str) -> List[Location]:
+        """Uses of a symbol in every indexed file, by file and line"""
+        locations = []
+        for by_path in self.uses.get(name, {}).values():
+            locations.extend(by_path)
+        return sorted(locations)
+
+    def outline(self, path: Optional[str] = None) -> List[Symbol]:
+        """Definitions of a file, or of every indexed file, in source order"""
+        if path is not None:
+            symbols = self.files.get(os.path.abspath(path))
+            return list(symbols.definitions) if symbols is not None else []
+        return [symbol for symbols in self.files.values() for symbol in symbols.definitions]
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+# ASIM Reborn - Simple multiplatform 68k IDE
+# Copyright (C) 2024 Francesco Palazzo
+
+import os.path
+from typing import Dict, List
+
+from PySide6.QtWidgets import QAbstractItemView, QLabel, QLineEdit, QTreeWidget, \
+    QTreeWidgetItem, QVBoxLayout, QWidget
+from PySide6.QtGui import QFont
+from PySide6.QtCore import Qt, Signal
+
+import symbols
+
+COLUMNS = ["Symbol", "Kind", "Line"]
+
+
+class SymbolView(QWidget):
+    # path and line picked by the user
+    activated = Signal(str, int)
+
+    def __init__(self, parent=None):
+        """Outline of the symbols of the source and its includes, or the
+        references of a symbol, one branch per file"""
+        super().__init__(parent)
+        self.title = QLabel("Outline")
+
+        self.filterline = QLineEdit()
+        self.filterline.setFont(QFont("MonoLisa"))
+        self.filterline.setPlaceholderText("Filter symbols")
+        self.filterline.textChanged.connect(self.apply_filter)
+
+        self.tree = QTreeWidget()
+        self.tree.setFont(QFont("MonoLisa"))
+        self.tree.setHeaderLabels(COLUMNS)
+        self.tree.setSelectionMode(QAbstractItemView.SingleSelection)
+        self.tree.itemActivated.connect(self.on_item_activated)
+
+        layout = QVBoxLayout()
+        layout.addWidget(self.title)
+        layout.addWidget(self.filterline)
+        layout.addWidget(self.tree)
+        self.setLayout(layout)
+
+    def fill(self, rows: Dict[str, List[List[str]]], lines: Dict[str, List[int]]):
+        """One branch per path with its rows, lines are where each row is"""
+        self.tree.clear()
+        for path, texts in rows.items():
+            branch = QTreeWidgetItem([os.path.basename(path)])
+            branch.setToolTip(0, path)
+            for text, line in zip(texts, lines[path]):
+                item = QTreeWidgetItem(text)
+                item.setData(0, Qt.UserRole, (path, line))
+                branch.addChild(item)
+            self.tree.addTopLevelItem(branch)
+            branch.setExpanded(True)
+        self.tree.resizeColumnToContents(0)
+        self.apply_filter()
+
+    def show_outline(self, outline: List[symbols.Symbol]):
+        if self.title.text() != "Outline":
+            self.filterline.clear()
+        self.title.setText("Outline")
+        rows: Dict[str, List[List[str]]] = {}
+        lines: Dict[str, List[int]] = {}
+        for symbol in outline:
+            rows.setdefault(symbol.path, []).append(
+                    [symbol.name, symbol.kind, str(symbol.line)])
+            lines.setdefault(symbol.path, []).append(symbol.line)
+        self.fill(rows, lines)
+
+    def show_references(self, name: str, locations: List[symbols.Location],
+                        texts: Dict[str, List[str]]):
+        """texts are the lines of the files, to show the uses in context"""
+        self.filterline.clear()
+        self.title.setText(f"References of {name}: {len(locations)}")
+        rows: Dict[str, List[List[str]]] = {}
+        lines: Dict[str, List[int]] = {}
+        for path, line, _ in locations:
+            source = texts.get(path, [])
+            text = source[line - 1].strip() if line <= len(source) else ""
+            rows.setdefault(path, []).append([text, "", str(line)])
+            lines.setdefault(path, []).append(line)
+        self.fill(rows, lines)
+
+    def apply_filter(self):
+        text = self.filterline.text().strip().lower()
+        for i in range(self.tree.topLevelItemCount()):
+            branch = self.tree.topLevelItem(i)
+            for j in range(branch.childCount()):
+                item = branch.child(j)
+                item.setHidden(text not in item.text(0).lower())
+
+    def on_item_activated(self, item: QTreeWidgetItem, column: int):
+        place = item.data(0, Qt.UserRole)
+        if place is not None:
+            self.activated.emit(*place)
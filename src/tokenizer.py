@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+# ASIM Reborn - Simple multiplatform 68k IDE
+# Copyright (C) 2024 Francesco Palazzo
+
+import re
+from typing import Dict, List, Optional, Tuple
+
+import opcodes
+
+# kinds of the tokens worth coloring
+OPCODE = "opcode"
+DIRECTIVE = "directive"
+REGISTER = "register"
+COMMENT = "comment"
+CHARACTER = "character"
+STRING = "string"
+
+# (start, length, kind)
+Token = Tuple[int, int, str]
+
+KEYWORDS: Dict[str, str] = {
+    **{word: OPCODE for word in opcodes.opcodes},
+    **{word: DIRECTIVE for word in opcodes.directives},
+    **{word: REGISTER for word in opcodes.registers},
+}
+
+# one alternative per lexeme, tried in a single left to right pass. Numbers
+# are matched only so that "$add" is not taken for the opcode, words are
+# looked up in KEYWORDS without their size suffix
+TOKEN_RE = re.compile(r"""
+    (?P<comment>;.*)
+  | (?P<star>\*)
+  | (?P<string>"[^"]*"?)
+  | (?P<character>'[^']*'?)
+  | (?P<number>\$[0-9A-Fa-f]+|%[01]+|@[0-7]+|\d\w*)
+  | (?P<word>[A-Za-z_.][\w.]*)
+""", re.VERBOSE)
+
+# lines tokenized so far by content, big sources repeat many lines
+CACHE_SIZE = 4096
+cache: Dict[str, List[Token]] = {}
+
+
+def is_comment_star(text: str, pos: int) -> bool:
+    """A * starts a comment as the first thing on the line or after the
+    operands, else it is the location counter or a product ("bra *")"""
+    before = text[:pos]
+    if before.strip() == "":
+        return True
+    return before[-1].isspace() and text[pos + 1:pos + 2].isspace()
+
+
+def lexemes(text: str) -> List[Tuple[int, str, str]]:
+    """(start, kind, text) of every lexeme of a line of source, in order:
+    comment, string, character, number or word. A comment runs to the end
+    of the line"""
+    found = []
+    for match in TOKEN_RE.finditer(text):
+        kind = match.lastgroup
+        start = match.start()
+        if kind == "star":
+            if not is_comment_star(text, start):
+                continue
+            kind = "comment"
+        if kind == "comment":
+            found.append((start, kind, text[start:]))
+            break
+        found.append((start, kind, match.group()))
+    return found
+
+
+def keyword(word: str) -> Optional[str]:
+    """Kind of a word of the language, "move.l" is the opcode move and
+    ".loop" a local label"""
+    return KEYWORDS.get(word.split(".", 1)[0].lower())
+
+
+def tokenize(text: str) -> List[Token]:
+    """Colored tokens of a line of source"""
+    tokens = cache.get(text)
+    if tokens is not None:
+        return tokens
+    tokens = []
+    for start, kind, lexeme in lexemes(text):
+        if kind == "word":
+            found = keyword(lexeme)
+            if found is not None:
+                tokens.append((start, len(lexeme.split(".", 1)[0]), found))
+        elif kind == "comment":
+            tokens.append((start, len(lexeme), COMMENT))
+        elif kind == "string":
+            tokens.append((start, len(lexeme), STRING))
+        elif kind == "character":
+            tokens.append((start, len(lexeme), CHARACTER))
+    if len(cache) >= CACHE_SIZE:
+        cache.clear()
+    cache[text] = tokens
+    return tokens
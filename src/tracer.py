@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+# ASIM Reborn - Simple multiplatform 68k IDE
+# Copyright (C) 2024 Francesco Palazzo
+
+import mmap
+import queue
+import struct
+import threading
+from typing import List, Optional, Tuple
+
+import numpy as np
+from bare68k.consts import M68K_REG_D0, M68K_REG_A0, M68K_REG_SR
+
+# Trace file: a header with the registers before the first instruction, then
+# one fixed-size record per executed instruction:
+# pc, the first 5 opcode words, cycles, mask of the registers it changed and
+# the new values of the first 4 of them (bit 31 of the mask: more changed)
+MAGIC = b"A68TRACE"
+VERSION = 1
+TRACE_REGS = (*range(M68K_REG_D0, M68K_REG_D0 + 8),
+              *range(M68K_REG_A0, M68K_REG_A0 + 8),
+              M68K_REG_SR)
+REG_NAMES = [f"d{i}" for i in range(8)] + [f"a{i}" for i in range(8)] + ["sr"]
+HEADER = struct.Struct(f"<8sHHH{len(TRACE_REGS)}I")
+RECORD = struct.Struct("<I5HHI4I")
+RECORD_DTYPE = np.dtype([("pc", "<u4"), ("words", "<u2", (5,)), ("cycles", "<u2"),
+                         ("mask", "<u4"), ("values", "<u4", (4,))])
+MAX_VALUES = 4
+TRUNCATED = 1 << 31
+WORDS = struct.Struct(">5H")
+INSTR_BYTES = WORDS.size
+
+# ring buffer: CHUNKS chunks of CHUNK_RECORDS records, full chunks are
+# written by the writer thread while the CPU fills the next ones
+CHUNK_RECORDS = 4096
+CHUNKS = 16
+
+
+class Tracer:
+    def __init__(self, path: str, cpu, chunk_records: int = CHUNK_RECORDS,
+                 chunks: int = CHUNKS):
+        """Records every executed instruction to path. The CPU thread only
+        packs records in a preallocated buffer, a writer thread streams the
+        full chunks to disk. The CPU waits only if the disk can't keep up
+        with the whole ring"""
+        self.path = path
+        self.cpu = cpu
+        self.chunk_records = chunk_records
+        self.chunks = chunks
+        self.chunk_size = chunk_records * RECORD.size
+        self.buf = bytearray(self.chunk_size * chunks)
+        self.free = threading.Semaphore(chunks)
+        self.full: queue.Queue = queue.Queue()
+        self.chunk = 0
+        self.pos = 0
+        self.regs: List[int] = []
+        self.count = 0
+        self.file = None
+        self.writer: Optional[threading.Thread] = None
+
+    def start(self):
+        self.regs = self.read_regs()
+        self.file = open(self.path, "wb")
+        self.file.write(HEADER.pack(MAGIC, VERSION, RECORD.size, len(TRACE_REGS), *self.regs))
+        self.writer = threading.Thread(target=self.write_worker)
+        self.writer.daemon = True
+        self.writer.start()
+        self.free.acquire()
+        self.chunk = 0
+        self.pos = 0
+
+    def read_regs(self) -> List[int]:
+        return [self.cpu.r_reg(reg) for reg in TRACE_REGS]
+
+    def record(self, pc: int, code: bytes, cycles: int):
+        """Called after every instruction with its pc and the bytes it had"""
+        regs = self.read_regs()
+        mask = 0
+        values = []
+        for i, (old, new) in enumerate(zip(self.regs, regs)):
+            if old != new:
+                mask |= 1 << i
+                values.append(new)
+        if len(values) > MAX_VALUES:
+            mask |= TRUNCATED
+            values = values[:MAX_VALUES]
+        values += [0] * (MAX_VALUES - len(values))
+        self.regs = regs
+        if len(code) < INSTR_BYTES:
+            code = code + bytes(INSTR_BYTES - len(code))
+        RECORD.pack_into(self.buf, self.chunk * self.chunk_size + self.pos * RECORD.size,
+                         pc, *WORDS.unpack_from(code), min(cycles, 0xFFFF), mask, *values)
+        self.count += 1
+        self.pos += 1
+        if self.pos == self.chunk_records:
+            self.full.put((self.chunk, self.chunk_size))
+            self.chunk = (self.chunk + 1) % self.chunks
+            self.pos = 0
+            self.free.acquire()
+
+    def write_worker(self):
+        while True:
+            item = self.full.get()
+            if item is None:
+                return
+            chunk, size = item
+            start = chunk * self.chunk_size
+            self.file.write(memoryview(self.buf)[start:start + size])
+            self.free.release()
+
+    def stop(self):
+        """Writes the partial chunk and closes the file"""
+        if self.writer is None:
+            return
+        if self.pos:
+            self.full.put((self.chunk, self.pos * RECORD.size))
+        self.full.put(None)
+        self.writer.join()
+        self.writer = None
+        self.file.close()
+
+
+class TraceFile:
+    def __init__(self, path: str):
+        """Read-only view of a trace file, memory mapped so that only the
+        pages that are looked at are read"""
+        self.file = open(path, "rb")
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, record_size, nregs, *regs = HEADER.unpack_from(self.mm)
+        if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+            self.close()
+            raise ValueError(f"{path} is not a trace file")
+        self.initial_regs = regs
+        count = (len(self.mm) - HEADER.size) // RECORD.size
+        self.records = np.frombuffer(self.mm, dtype=RECORD_DTYPE,
+                                     count=count, offset=HEADER.size)
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def __getitem__(self, i: int) -> Tuple[int, bytes, int, List[Tuple[str, Optional[int]]]]:
+        """(pc, opcode bytes, cycles, [(register, new value or None)])"""
+        rec = self.records[i]
+        code = WORDS.pack(*(int(w) for w in rec["words"]))
+        mask = int(rec["mask"])
+        changes: List[Tuple[str, Optional[int]]] = []
+        values = [int(v) for v in rec["values"]]
+        for bit, name in enumerate(REG_NAMES):
+            if mask & (1 << bit):
+                changes.append((name, values.pop(0) if values else None))
+        return int(rec["pc"]), code, int(rec["cycles"]), changes
+
+    def select(self, start: int, end: int) -> np.ndarray:
+        """Indices of the records with start <= pc < end"""
+        pcs = self.records["pc"]
+        return np.flatnonzero((pcs >= start) & (pcs < end))
+
+    def close(self):
+        self.records = None
+        self.mm.close()
+        self.file.close()
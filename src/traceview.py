@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+# ASIM Reborn - Simple multiplatform 68k IDE
+# Copyright (C) 2024 Francesco Palazzo
+
+import re
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import bare68k as b68k
+from PySide6.QtWidgets import QAbstractItemView, QHBoxLayout, QHeaderView, \
+    QLabel, QLineEdit, QTableView, QVBoxLayout, QWidget
+from PySide6.QtGui import QFont
+from PySide6.QtCore import QAbstractTableModel, QModelIndex, Qt
+
+import tracer
+from profiler import Labels
+
+COLUMNS = ["#", "PC", "Label", "Instruction", "Cycles", "Changes"]
+RANGE_RE = re.compile(r"^\s*([0-9a-fA-F]{1,8})\s*-\s*([0-9a-fA-F]{1,8})\s*$")
+
+
+def disassemble(pc: int, code: bytes) -> str:
+    """Disassembles the recorded bytes, not the memory, which may have
+    changed since"""
+    b68k.api.disasm.disassemble_buffer(code, pc)
+    try:
+        return b68k.api.disasm.disassemble(pc)[2]
+    finally:
+        b68k.api.disasm.disassemble_memory()
+
+
+class TraceModel(QAbstractTableModel):
+    def __init__(self, trace: tracer.TraceFile, symbols: Dict[str, int], parent=None):
+        """One row per record of the trace, or per record of the selection.
+        Records are decoded only when the view shows them"""
+        super().__init__(parent)
+        self.trace = trace
+        self.labels = Labels(symbols)
+        self.rows: Optional[np.ndarray] = None
+
+    def rowCount(self, parent=QModelIndex()) -> int:
+        if parent.isValid():
+            return 0
+        return len(self.trace) if self.rows is None else len(self.rows)
+
+    def columnCount(self, parent=QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(COLUMNS)
+
+    def record_index(self, row: int) -> int:
+        return row if self.rows is None else int(self.rows[row])
+
+    def data(self, index: QModelIndex, role=Qt.DisplayRole):
+        if not index.isValid() or role != Qt.DisplayRole:
+            return None
+        i = self.record_index(index.row())
+        column = index.column()
+        if column == 0:
+            return str(i)
+        pc, code, cycles, changes = self.trace[i]
+        if column == 1:
+            return f"{pc:08X}"
+        if column == 2:
+            return self.labels.containing(pc)
+        if column == 3:
+            return disassemble(pc, code)
+        if column == 4:
+            return str(cycles)
+        return " ".join(f"{name}={value:08X}" if value is not None else f"{name}=?"
+                        for name, value in changes)
+
+    def headerData(self, section: int, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return COLUMNS[section]
+        return None
+
+    def set_filter(self, span: Optional[Tuple[int, int]]):
+        self.beginResetModel()
+        self.rows = None if span is None else self.trace.select(*span)
+        self.endResetModel()
+
+
+class TraceView(QWidget):
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.trace: Optional[tracer.TraceFile] = None
+        self.model: Optional[TraceModel] = None
+        self.symbols: Dict[str, int] = {}
+        self.filter = QLineEdit()
+        self.filter.setFont(QFont("MonoLisa"))
+        self.filter.setPlaceholderText("Filter: START-END in hex or a label")
+        self.filter.returnPressed.connect(self.apply_filter)
+        self.info = QLabel("")
+        self.table = QTableView()
+        self.table.setFont(QFont("MonoLisa"))
+        self.table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.table.verticalHeader().hide()
+        self.table.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+        self.table.verticalHeader().setDefaultSectionSize(self.table.fontMetrics().height() + 4)
+        self.table.horizontalHeader().setStretchLastSection(True)
+        top = QHBoxLayout()
+        top.addWidget(self.filter)
+        top.addWidget(self.info)
+        layout = QVBoxLayout()
+        layout.addLayout(top)
+        layout.addWidget(self.table)
+        self.setLayout(layout)
+
+    def open(self, path: str, symbols: Dict[str, int]):
+        """Raises ValueError if path is not a trace file"""
+        trace = tracer.TraceFile(path)
+        self.close_trace()
+        self.trace = trace
+        self.symbols = symbols
+        self.model = TraceModel(trace, symbols, self)
+        self.table.setModel(self.model)
+        self.filter.clear()
+        self.update_info()
+
+    def close_trace(self):
+        if self.trace is None:
+            return
+        self.table.setModel(None)
+        self.model = None
+        self.trace.close()
+        self.trace = None
+
+    def parse_filter(self, text: str) -> Optional[Tuple[int, int]]:
+        """Address range of the filter, a label spans up to the next one.
+        Raises ValueError on unknown labels"""
+        text = text.strip()
+        if text == "":
+            return None
+        match = RANGE_RE.match(text)
+        if match:
+            return int(match.group(1), 16), int(match.group(2), 16) + 1
+        if text not in self.symbols:
+            raise ValueError(f"unknown label {text}")
+        start = self.symbols[text]
+        following = [addr for addr in self.symbols.values() if addr > start]
+        return start, min(following, default=start + 1)
+
+    def apply_filter(self):
+        if self.model is None:
+            return
+        try:
+            span = self.parse_filter(self.filter.text())
+        except ValueError as e:
+            self.info.setText(str(e))
+            return
+        self.model.set_filter(span)
+        self.update_info()
+
+    def update_info(self):
+        if self.model is not None and self.trace is not None:
+            self.info.setText(f"{self.model.rowCount()} of {len(self.trace)} instructions")
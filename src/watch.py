@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+# ASIM Reborn - Simple multiplatform 68k IDE
+# Copyright (C) 2024 Francesco Palazzo
+
+from typing import Callable, List, Optional, Tuple
+
+# strings are shown up to the first NUL or this many bytes
+MAX_STRING_LEN = 256
+# watches closer than this are read with the same block read
+MERGE_GAP = 64
+
+INVALID = "ERROR: Invalid address"
+
+
+def mode_size(mode: str) -> int:
+    if mode.endswith("word"):
+        return 2
+    if mode.endswith("long"):
+        return 4
+    if mode.endswith("string"):
+        return MAX_STRING_LEN
+    return 1
+
+
+def decode(mode: str, raw: bytes) -> str:
+    """Formats the bytes of a watch as the mode of the Runner combobox"""
+    if mode.endswith("char"):
+        return raw[:1].decode('ascii', errors='replace')
+    if mode.endswith("string"):
+        end = raw.find(b'\x00')
+        if end == -1:
+            return raw.decode('ascii', errors='replace') + "..."
+        return raw[:end].decode('ascii', errors='replace')
+    val = int.from_bytes(raw, byteorder='big', signed=mode.startswith("s"))
+    if mode.startswith("h"):
+        return f"{val:0{len(raw)*2}X}"
+    return str(val)
+
+
+class Watch:
+    def __init__(self, addr: int, mode: str):
+        """A watched address. raw holds the bytes decoded last time, so that
+        the value is decoded again only when they change"""
+        self.addr = addr
+        self.mode = mode
+        self.size = mode_size(mode)
+        self.raw: Optional[bytes] = None
+        self.value = ""
+
+
+class WatchEngine:
+    def __init__(self, read: Callable[[int, int], bytes], mem_size: int):
+        """Polls all the watches with as few block reads as possible.
+        read(start, len) raises ValueError on unmapped memory"""
+        self.read = read
+        self.mem_size = mem_size
+        self.watches: List[Watch] = []
+        # (start, end, watches) of each block read, rebuilt when watches change
+        self.ranges: Optional[List[Tuple[int, int, List[Watch]]]] = None
+
+    def add(self, addr: int, mode: str) -> Watch:
+        watch = Watch(addr, mode)
+        self.watches.append(watch)
+        self.ranges = None
+        return watch
+
+    def remove(self, watch: Watch):
+        self.watches.remove(watch)
+        self.ranges = None
+
+    def clear(self):
+        self.watches.clear()
+        self.ranges = None
+
+    def set_mode(self, watch: Watch, mode: str):
+        watch.mode = mode
+        watch.size = mode_size(mode)
+        watch.raw = None
+        self.ranges = None
+
+    def plan(self) -> List[Tuple[int, int, List[Watch]]]:
+        """Merges the watched bytes in sorted, coalesced ranges"""
+        ranges: List[Tuple[int, int, List[Watch]]] = []
+        for watch in sorted(self.watches, key=lambda w: w.addr):
+            end = watch.addr + watch.size
+            if watch.mode.endswith("string"):
+                # a string may stop anywhere, don't let it run out of memory
+                end = max(min(end, self.mem_size), watch.addr + 1)
+            if ranges and watch.addr <= ranges[-1][1] + MERGE_GAP:
+                start, last, group = ranges[-1]
+                ranges[-1] = (start, max(last, end), group + [watch])
+            else:
+                ranges.append((watch.addr, end, [watch]))
+        return ranges
+
+    def poll(self) -> List[Watch]:
+        """Reads the watches and returns the ones whose value changed"""
+        if self.ranges is None:
+            self.ranges = self.plan()
+        changed = []
+        for start, end, group in self.ranges:
+            try:
+                block = self.read(start, end - start)
+            except ValueError:
+                # some watch in the range is unmapped, read them one by one
+                for watch in group:
+                    if self.refresh(watch):
+                        changed.append(watch)
+                continue
+            for watch in group:
+                offset = watch.addr - start
+                if self.update(watch, block[offset:offset + watch.size]):
+                    changed.append(watch)
+        return changed
+
+    def refresh(self, watch: Watch) -> bool:
+        """Reads a single watch, returns True if its value changed"""
+        size = watch.size
+        if watch.mode.endswith("string"):
+            size = max(min(size, self.mem_size - watch.addr), 1)
+        try:
+            raw = self.read(watch.addr, size)
+        except ValueError:
+            raw = b''
+        return self.update(watch, raw)
+
+    def update(self, watch: Watch, raw: bytes) -> bool:
+        if raw == watch.raw:
+            return False
+        watch.raw = raw
+        watch.value = decode(watch.mode, raw) if raw else INVALID
+        return True
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+# ASIM Reborn - Simple multiplatform 68k IDE
+# Copyright (C) 2024 Francesco Palazzo
+
+from typing import Dict, List, Optional, Tuple
+
+import bare68k as b68k
+from bare68k.consts import CPU_EVENT_WATCHPOINT, MEM_ACCESS_R8, MEM_ACCESS_W8
+
+# watchpoint modes, can be or-ed
+READ = 1
+WRITE = 2
+CHANGE = 4
+
+MODE_NAMES = {READ: "read", WRITE: "write", CHANGE: "change",
+              READ | WRITE: "access"}
+
+# the core matches the flags of a point with "and", the width bits are shared
+# by reads and writes so only the direction bits can be used
+READ_FLAG = MEM_ACCESS_R8 & 0xF0
+WRITE_FLAG = MEM_ACCESS_W8 & 0xF0
+WIDTH_MASK = 0x0F
+
+# the core has no range points, every watched byte costs a native point and
+# all of them are scanned on each memory access: 64 bytes already make a
+# memory bound loop about 5 times slower
+MAX_LENGTH = 32
+
+
+class Watchpoint:
+    def __init__(self, start: int, length: int, mode: int):
+        """Stops the run when [start, start+length) is read, written or
+        written with a different value"""
+        self.start = start
+        self.end = start + length
+        self.mode = mode
+        # bytes of the range before the last write, for CHANGE
+        self.old: Optional[bytes] = None
+        self.hits = 0
+
+    def addresses(self) -> List[int]:
+        """Addresses of the accesses that can touch the range: its bytes,
+        plus the word and long accesses that start before it, which are
+        at even addresses on the 68000"""
+        before = [addr for addr in range(max(self.start - 3, 0), self.start)
+                  if addr % 2 == 0]
+        return before + list(range(self.start, self.end))
+
+    def flags(self) -> int:
+        flags = 0
+        if self.mode & READ:
+            flags |= READ_FLAG
+        if self.mode & (WRITE | CHANGE):
+            flags |= WRITE_FLAG
+        return flags
+
+    def __str__(self) -> str:
+        return (f"{MODE_NAMES.get(self.mode, self.mode)} "
+                f"0x{self.start:08X}-0x{self.end - 1:08X}")
+
+
+class Watchpoints:
+    def __init__(self, mem, cpu):
+        """Data watchpoints on top of the core ones. The core only matches the
+        exact address of an access, so every address an access up to a
+        long can start at and touch the range gets a point, see
+        Watchpoint.addresses. Events are then
+        filtered here by range, direction and value"""
+        self.mem = mem
+        self.cpu = cpu
+        self.points: List[Watchpoint] = []
+        # last watchpoint that stopped the CPU and the pc of the instruction
+        self.hit: Optional[Watchpoint] = None
+        self.hit_pc = 0
+        # core points set up by install(), each slows every memory access
+        self.native = 0
+
+    def add(self, start: int, length: int, mode: int) -> Watchpoint:
+        if not 0 < length <= MAX_LENGTH:
+            raise ValueError(f"watchpoint length must be 1 to {MAX_LENGTH}")
+        point = Watchpoint(start, length, mode)
+        self.points.append(point)
+        return point
+
+    def remove(self, point: Watchpoint):
+        self.points.remove(point)
+
+    def clear(self):
+        self.points.clear()
+
+    def install(self):
+        """Sets up the core points, again after every change and after the
+        runtime is rebuilt"""
+        native: Dict[int, Tuple[int, List[Watchpoint]]] = {}
+        for point in self.points:
+            for addr in point.addresses():
+                flags, owners = native.get(addr, (0, []))
+                native[addr] = (flags | point.flags(), owners + [point])
+        self.native = len(native)
+        b68k.api.tools.setup_watchpoints(len(native))
+        # the core keeps the pc of the last instructions natively, PPC is
+        # useless here as it is reset when the slice ends
+        b68k.api.tools.setup_pc_trace(2 if native else 0)
+        for i, (addr, (flags, owners)) in enumerate(native.items()):
+            b68k.api.tools.set_watchpoint(i, addr, flags, tuple(owners))
+
+    def arm(self):
+        """Takes the reference values for CHANGE points before a run"""
+        self.hit = None
+        for point in self.points:
+            if point.mode & CHANGE:
+                try:
+                    point.old = self.mem.r_block(point.start, point.end - point.start)
+                except ValueError:
+                    point.old = None
+
+    def save(self) -> tuple:
+        """What check() changes, for a slice that is rewound"""
+        return [(p.old, p.hits) for p in self.points], self.hit, self.hit_pc
+
+    def restore(self, saved: tuple):
+        points, self.hit, self.hit_pc = saved
+        for point, (old, hits) in zip(self.points, points):
+            point.old = old
+            point.hits = hits
+
+    def check(self, event) -> bool:
+        """True if a watchpoint event must stop the CPU. It arrives after
+        the access, so CHANGE compares the memory with the value before"""
+        width = event.flags & WIDTH_MASK
+        for point in event.data or ():
+            if not (event.addr < point.end and event.addr + width > point.start):
+                continue
+            hit = False
+            if event.flags & READ_FLAG and point.mode & READ:
+                hit = True
+            elif event.flags & WRITE_FLAG:
+                if point.mode & WRITE:
+                    hit = True
+                elif point.mode & CHANGE:
+                    new = self.mem.r_block(point.start, point.end - point.start)
+                    hit = new != point.old
+                    point.old = new
+            if hit:
+                point.hits += 1
+                self.hit = point
+                trace = b68k.api.tools.get_pc_trace()
+                self.hit_pc = trace[-1] if trace else self.cpu.r_pc()
+                return True
+        return False
+
+    def filter(self, events: list) -> list:
+        """Drops the watchpoint events that don't stop the CPU"""
+        return [e for e in events
+                if e.ev_type != CPU_EVENT_WATCHPOINT or self.check(e)]
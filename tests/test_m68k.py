@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+# ASIM Reborn - Simple multiplatform 68k IDE
+# Copyright (C) 2024 Francesco Palazzo
+
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import m68k
+
+# moveq #0,d0 / loop: addq.l #1,d0 / cmp.l #1000,d0 / bne.s loop / bra *
+COUNTER = ("S1118000700052800C80000003E866F660FEFB\n"
+           "S90380007C\n")
+COUNTER_INSTRUCTIONS = 1 + 1000 * 3
+
+
+class RunSteppedTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # the core can be set up once per process
+        cls.cpu = m68k.m68k()
+
+    def load(self, srec: str):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "prog.h68")
+            with open(path, "w") as f:
+                f.write(srec)
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.cpu.load_file(path)
+
+    def test_bounded_run_ends_on_halt(self):
+        self.load(COUNTER)
+        result = []
+        worker = threading.Thread(target=lambda: result.append(
+                self.cpu.run_stepped(lambda: False, cycle_limit=200000)))
+        worker.daemon = True
+        worker.start()
+        worker.join(10)
+        self.assertFalse(worker.is_alive(), "bounded stepped run parked on the halt")
+        stats = result[0]
+        self.assertTrue(stats.halted)
+        self.assertFalse(stats.estimated)
+        self.assertEqual(stats.instructions, COUNTER_INSTRUCTIONS + 1)
+        self.assertEqual(self.cpu.cpu.r_dx(0), 1000)
+        self.assertTrue(self.cpu.is_halted())
+
+    def test_batched_counts_are_estimated(self):
+        self.load(COUNTER)
+        stats = self.cpu.run_batched(lambda: False, cycle_limit=200000)
+        self.assertTrue(stats.estimated)
+        self.assertTrue(str(stats).startswith("~"))
+        self.assertEqual(self.cpu.cpu.r_dx(0), 1000)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+
+# ASIM Reborn - Simple multiplatform 68k IDE
+# Copyright (C) 2024 Francesco Palazzo
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from watchpoints import WRITE, Watchpoint
+
+
+class AddressesTest(unittest.TestCase):
+    def test_even_start(self):
+        # long at 0x8FFE reaches 0x9001, a byte at 0x8FFF does not
+        self.assertEqual(Watchpoint(0x9000, 2, WRITE).addresses(),
+                         [0x8FFE, 0x9000, 0x9001])
+
+    def test_odd_start(self):
+        self.assertEqual(Watchpoint(0x9003, 1, WRITE).addresses(),
+                         [0x9000, 0x9002, 0x9003])
+
+    def test_bottom_of_memory(self):
+        self.assertEqual(Watchpoint(1, 1, WRITE).addresses(), [0, 1])
+
+
+if __name__ == "__main__":
+    unittest.main()